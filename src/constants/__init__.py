@@ -5,6 +5,9 @@ for c in ["J", "Q", "K"]:
     card_values[c] = 10
 card_values["A"] = 1
 
+# fixed order of actions wherever moves are encoded as integers.
+moves = ["stay", "hit", "double", "split", "surrender"]
+
 rules_common = {
     "dealerHitSoft17": False,
     "pushDealer22": False,
@@ -13,3 +16,13 @@ rules_common = {
     "reducedBlackjackPayout": False,
     "allowLateSurrender": True,
 }
+
+# weights of each card value (Ace == 1) as it's seen. Running count is the sum
+# of these weights over the cards dealt so far.
+count_systems = {
+    "hi_lo": {1: -1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 0, 8: 0, 9: 0, 10: -1},
+    "ko": {1: -1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1, 8: 0, 9: 0, 10: -1},
+    "hi_opt_2": {1: 0, 2: 1, 3: 1, 4: 2, 5: 2, 6: 1, 7: 1, 8: 0, 9: 0, 10: -2},
+    "omega_2": {1: 0, 2: 1, 3: 1, 4: 2, 5: 2, 6: 2, 7: 1, 8: 0, 9: -1, 10: -2},
+    "zen": {1: -1, 2: 1, 3: 1, 4: 2, 5: 2, 6: 2, 7: 1, 8: 0, 9: 0, 10: -2},
+}
@@ -1,3 +1,4 @@
 from .net import Net
-from .replay import ReplayBuffer
+from .replay import PrioritizedReplayBuffer, ReplayBuffer
 from .train import Trainer
+from .actor_learner import ActorLearner, SharedReplayBuffer
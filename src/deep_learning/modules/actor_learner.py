@@ -0,0 +1,480 @@
+from __future__ import annotations
+
+import multiprocessing as mp
+import time
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+from src.deep_learning.modules.net import Net
+from src.deep_learning.modules.replay import ReplayBuffer
+from src.deep_learning.utils.replay_buffer import update_replay_buffer
+from src.modules.game import Game
+from src.modules.observation import ObservationEncoder
+from src.utils.executor import spawn_seeds
+
+if TYPE_CHECKING:
+    # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
+    from src.deep_learning.modules import Trainer
+
+"""
+Actor / learner training of a DQN across processes.
+
+K actor processes each own a Game and a copy of the online network, and keep playing
+rounds (update_replay_buffer), writing transitions into a replay buffer that lives
+in shared memory. Meanwhile, the learner (the calling process) keeps running
+Trainer.train_epoch() on it.
+
+    - replay : SharedReplayBuffer, split into a ring segment per actor, so actors
+        never contend for a cursor. The learner samples uniformly over every filled row.
+        A row only counts as filled once written, but once a segment wraps around, a
+        sampled row can be mid overwrite (like Ape-X, this is tolerated).
+    - weights : every sync_every updates, the learner publishes the online network's
+        parameters to shared memory and bumps a version. Actors load them when the
+        version changed, checked every refresh_every rounds.
+    - metrics() : actor throughput, learner updates per second, and weight staleness
+        (how many versions behind the learner each actor plays with).
+
+Processes are spawned (not forked), so actors start with a fresh torch runtime,
+limited to 1 thread each.
+# noqa: E501
+"""
+
+# name -> (trailing shape, dtype) of each shared replay array.
+# obs / obs_next get a trailing obs_dim.
+_FIELDS = {
+    "obs": (True, np.float32),
+    "action_mask": (False, np.int64),
+    "move": (False, np.int64),
+    "reward": (False, np.float32),
+    "done": (False, np.float32),
+    "obs_next": (True, np.float32),
+    "action_mask_next": (False, np.int64),
+}
+
+
+def _layout(
+    capacity: int, obs_dim: int, n_segments: int
+) -> Tuple[Dict[str, Tuple[int, tuple, np.dtype]], int]:
+    """offset, shape and dtype of every shared array, and the total bytes"""
+    layout = {}
+    offset = 0
+    specs = [
+        (name, (capacity, obs_dim) if has_dim else (capacity,), dtype)
+        for name, (has_dim, dtype) in _FIELDS.items()
+    ]
+    # per segment cursor, filled rows and transitions ever written.
+    specs.append(("segments", (n_segments, 3), np.int64))
+    for name, shape, dtype in specs:
+        layout[name] = (offset, shape, np.dtype(dtype))
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        offset += -(-nbytes // 8) * 8
+    return layout, offset
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer whose arrays are views of a single SharedMemory block, split into
+    n_segments ring buffers of capacity // n_segments rows, one per writer.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        obs_dim: int,
+        n_segments: int,
+        name: Optional[str] = None,
+        segment: Optional[int] = None,
+    ):
+        """
+        name : attach to an existing buffer (in another process), otherwise create one.
+        segment : the segment append() writes to.
+        """
+        assert capacity >= n_segments, "invalid capacity"
+        super().__init__(capacity=capacity)
+        self.obs_dim = obs_dim
+        self.n_segments = n_segments
+        self.segment = segment
+        self.segment_capacity = capacity // n_segments
+
+        layout, nbytes = _layout(capacity, obs_dim, n_segments)
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = SharedMemory(name=name)
+        for field_name, (offset, shape, dtype) in layout.items():
+            view = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            setattr(self, field_name, view)
+        if self.owner:
+            self.segments[:] = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def _allocate(self, obs_dim: int) -> None:
+        raise Exception("shared replay arrays are allocated up front")
+
+    def __len__(self) -> int:
+        return int(self.segments[:, 1].sum())
+
+    @property
+    def n_written(self) -> np.ndarray:
+        """transitions ever written, per segment"""
+        return self.segments[:, 2].copy()
+
+    def append(
+        self,
+        obs: tuple,
+        action_mask: int,
+        move: int,
+        reward: float,
+        done: int,
+        obs_next: Optional[tuple] = None,
+        action_mask_next: Optional[int] = None,
+    ) -> None:
+        assert self.segment is not None, "no segment to write to"
+        pos, size, written = self.segments[self.segment]
+        i = self.segment * self.segment_capacity + pos
+        self._write(i, obs, action_mask, move, reward, done, obs_next, action_mask_next)
+        # only counted once written, so readers never see a half written new row.
+        self.segments[self.segment] = (
+            (pos + 1) % self.segment_capacity,
+            min(size + 1, self.segment_capacity),
+            written + 1,
+        )
+
+    def sample(self, batch_size: int):
+        sizes = self.segments[:, 1].copy()
+        total = sizes.sum()
+        assert total, "replay buffer is empty"
+        inds = np.random.randint(total, size=batch_size)
+        # global sample index -> segment + row within it
+        ends = np.cumsum(sizes)
+        segment = np.searchsorted(ends, inds, side="right")
+        rows = inds - (ends - sizes)[segment]
+        return self._gather(segment * self.segment_capacity + rows)
+
+    def load(self, buffer: ReplayBuffer) -> None:
+        """
+        copies the transitions of a local buffer in, dealt round robin across the
+        segments (keeping the most recent ones if a segment overflows).
+        Loaded rows don't count towards n_written.
+        """
+        if not len(buffer):
+            return
+        assert buffer.obs.shape[1] == self.obs_dim, "invalid obs_dim"
+        # oldest to newest
+        if buffer.size < buffer.capacity:
+            rows = np.arange(buffer.size)
+        else:
+            rows = np.roll(np.arange(buffer.capacity), -buffer.pos)
+        for k in range(self.n_segments):
+            segment_rows = rows[k::self.n_segments][-self.segment_capacity:]
+            n = len(segment_rows)
+            start = k * self.segment_capacity
+            for field_name in _FIELDS:
+                getattr(self, field_name)[start:start + n] = getattr(
+                    buffer, field_name
+                )[segment_rows]
+            self.segments[k] = (n % self.segment_capacity, n, 0)
+
+    def to_local(self, validate: bool = False) -> ReplayBuffer:
+        """
+        copy of the filled rows, as a regular (process local) ReplayBuffer.
+        validate : see ReplayBuffer.
+        """
+        local = ReplayBuffer(capacity=self.capacity, validate=validate)
+        rows = np.concatenate(
+            [
+                k * self.segment_capacity + np.arange(size)
+                for k, size in enumerate(self.segments[:, 1])
+            ]
+        )
+        local._allocate(self.obs_dim)
+        for field_name in _FIELDS:
+            getattr(local, field_name)[: len(rows)] = getattr(self, field_name)[rows]
+        local.size = len(rows)
+        local.pos = len(rows) % local.capacity
+        return local
+
+    def close(self) -> None:
+        # views must go before the block is closed.
+        for field_name in list(_FIELDS) + ["segments"]:
+            setattr(self, field_name, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _run_actor(
+    k: int,
+    buffer_args: tuple,
+    weights_name: str,
+    n_params: int,
+    version: mp.Value,
+    lock: mp.Lock,
+    stop: mp.Event,
+    stats_name: str,
+    net_args: tuple,
+    game_hyperparams: object,
+    include_count: Union[bool, ObservationEncoder],
+    method: str,
+    force_cards: list,
+    force_every: int,
+    refresh_every: int,
+    seed: int,
+) -> None:
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    buffer = SharedReplayBuffer(*buffer_args, segment=k)
+    weights_shm = SharedMemory(name=weights_name)
+    weights = np.ndarray((n_params,), dtype=np.float32, buffer=weights_shm.buf)
+    stats_shm = SharedMemory(name=stats_name)
+    # per actor: rounds played, weight version in use
+    stats = np.ndarray((len(buffer.segments), 2), dtype=np.int64, buffer=stats_shm.buf)
+
+    model = Net(*net_args)
+    model.eval()
+    game = Game(**game_hyperparams)
+    local_version = -1
+    rounds = 0
+
+    try:
+        while not stop.is_set():
+            if (not rounds % refresh_every) and (version.value != local_version):
+                with lock:
+                    local_version = version.value
+                    weights_t = torch.from_numpy(weights.copy())
+                vector_to_parameters(weights_t, model.parameters())
+
+            forced = []
+            if force_cards and force_every and not rounds % force_every:
+                forced = force_cards[np.random.choice(len(force_cards))]
+            with torch.no_grad():
+                update_replay_buffer(
+                    blackjack=game,
+                    buffer=buffer,
+                    model=model,
+                    include_count=include_count,
+                    include_continuous_count=False,
+                    method=method,
+                    force_cards=forced,
+                )
+            rounds += 1
+            stats[k] = (rounds, local_version)
+    finally:
+        del weights, stats
+        buffer.close()
+        weights_shm.close()
+        stats_shm.close()
+
+
+class ActorLearner:
+    def __init__(
+        self,
+        trainer: Trainer,
+        n_actors: int,
+        game_hyperparams: object,
+        method: str = "softmax",
+        sync_every: int = 100,
+        refresh_every: int = 10,
+        force_cards: list = [],
+        force_every: int = 10,
+        seed: Optional[int] = None,
+    ):
+        """
+        Runs n_actors actor processes, writing to a shared replay buffer with the
+        capacity of trainer.replay_size, which replaces trainer.replay_buffer while
+        running (starting with its transitions, and copied back to a local
+        ReplayBuffer on close()).
+
+        - method : action selection of the actors (see select_action)
+        - sync_every : learner updates between published weights
+        - refresh_every : rounds between actors checking for new weights
+        - force_cards / force_every : every force_every rounds, actors deal a random
+            entry of force_cards to the player
+        - seed : seeds every actor (spawned seeds), fresh entropy if None
+        """
+        assert not trainer.prioritized, "prioritized replay isn't shared"
+        self.trainer = trainer
+        self.n_actors = n_actors
+        self.game_hyperparams = game_hyperparams
+        self.method = method
+        self.sync_every = sync_every
+        self.refresh_every = refresh_every
+        self.force_cards = force_cards
+        self.force_every = force_every
+        self.seed = seed
+
+        self.ctx = mp.get_context("spawn")
+        self.processes: List[mp.Process] = []
+        self.n_updates = 0
+        self.started_at: Optional[float] = None
+        self.train_time = 0.0
+
+    def _publish(self) -> None:
+        vector = parameters_to_vector(self.trainer.online_net.parameters()).detach()
+        with self.lock:
+            self.weights[:] = vector.numpy()
+            self.version.value += 1
+
+    def start(self) -> "ActorLearner":
+        net = self.trainer.online_net
+        self.buffer = SharedReplayBuffer(
+            capacity=self.trainer.replay_size,
+            obs_dim=net.input_dim,
+            n_segments=self.n_actors,
+        )
+        # transitions collected so far carry over, and come back on close()
+        self.validate = self.trainer.replay_buffer.validate
+        self.buffer.load(self.trainer.replay_buffer)
+        self.trainer.replay_buffer = self.buffer
+
+        n_params = sum(p.numel() for p in net.parameters())
+        self.weights_shm = SharedMemory(create=True, size=4 * n_params)
+        self.weights = np.ndarray(
+            (n_params,), dtype=np.float32, buffer=self.weights_shm.buf
+        )
+        self.stats_shm = SharedMemory(create=True, size=8 * 2 * self.n_actors)
+        self.stats = np.ndarray(
+            (self.n_actors, 2), dtype=np.int64, buffer=self.stats_shm.buf
+        )
+        self.stats[:] = 0
+
+        self.lock = self.ctx.Lock()
+        self.version = self.ctx.Value("q", -1, lock=False)
+        self.stop_event = self.ctx.Event()
+        self._publish()
+
+        seeds = spawn_seeds(self.n_actors, self.seed)
+        buffer_args = (
+            self.buffer.capacity, self.buffer.obs_dim, self.n_actors, self.buffer.name
+        )
+        for k in range(self.n_actors):
+            process = self.ctx.Process(
+                target=_run_actor,
+                args=(
+                    k,
+                    buffer_args,
+                    self.weights_shm.name,
+                    n_params,
+                    self.version,
+                    self.lock,
+                    self.stop_event,
+                    self.stats_shm.name,
+                    (net.input_dim, net.hidden_layers),
+                    self.game_hyperparams,
+                    self.trainer.include_count,
+                    self.method,
+                    self.force_cards,
+                    self.force_every,
+                    self.refresh_every,
+                    seeds[k],
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.started_at = time.perf_counter()
+        return self
+
+    def train(
+        self,
+        n_updates: int,
+        batch_size: int,
+        gamma: float,
+        loss_fct: nn.modules.loss._Loss,
+        optimizer: torch.optim.Optimizer,
+        scheduler: torch.optim.lr_scheduler.ExponentialLR,
+        target_update_freq: int = 5_000,
+        min_replay_size: int = 1_000,
+    ) -> List[float]:
+        """
+        runs n_updates learner steps (Trainer.train_epoch) while the actors play,
+        after waiting for min_replay_size transitions. Returns the losses.
+        """
+        assert self.processes, "must call start() first"
+        while len(self.buffer) < min_replay_size:
+            if not any(p.is_alive() for p in self.processes):
+                raise Exception("actor processes exited")
+            time.sleep(0.01)
+
+        losses = []
+        start = time.perf_counter()
+        for _ in range(n_updates):
+            losses.append(
+                self.trainer.train_epoch(
+                    batch_size=batch_size,
+                    gamma=gamma,
+                    loss_fct=loss_fct,
+                    optimizer=optimizer,
+                    scheduler=scheduler,
+                )
+            )
+            self.n_updates += 1
+            if not self.n_updates % self.sync_every:
+                self._publish()
+            if not self.n_updates % target_update_freq:
+                self.trainer.copy_online_to_target()
+        self.train_time += time.perf_counter() - start
+        return losses
+
+    def metrics(self) -> Dict[str, object]:
+        """
+        - transitions_per_sec / rounds_per_sec : summed over actors, since start()
+        - actor_transitions_per_sec : (n_actors,)
+        - updates_per_sec : learner updates per second spent in train()
+        - staleness : weight versions each actor is behind the learner (n_actors,),
+            staleness_updates is the same in learner updates (upper bound)
+        """
+        elapsed = time.perf_counter() - (self.started_at or time.perf_counter())
+        elapsed = max(elapsed, 1e-9)
+        written = self.buffer.n_written
+        stats = self.stats.copy()
+        staleness = self.version.value - stats[:, 1]
+        return {
+            "elapsed": elapsed,
+            "transitions": int(written.sum()),
+            "transitions_per_sec": float(written.sum() / elapsed),
+            "actor_transitions_per_sec": written / elapsed,
+            "rounds_per_sec": float(stats[:, 0].sum() / elapsed),
+            "n_updates": self.n_updates,
+            "updates_per_sec": self.n_updates / max(self.train_time, 1e-9),
+            "weight_version": int(self.version.value),
+            "staleness": staleness,
+            "staleness_updates": staleness * self.sync_every,
+            "replay_size": len(self.buffer),
+        }
+
+    def close(self) -> None:
+        """stops the actors, and hands a local copy of the replay buffer back"""
+        if not self.processes:
+            return
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+        self.trainer.replay_buffer = self.buffer.to_local(validate=self.validate)
+        self.buffer.close()
+        self.weights = None
+        self.stats = None
+        for shm in [self.weights_shm, self.stats_shm]:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self) -> "ActorLearner":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.close()
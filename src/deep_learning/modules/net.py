@@ -1,9 +1,13 @@
 from typing import Tuple
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from src.constants import moves
+from src.modules.actions import invalid_move_table, moves_to_mask
+
 
 class Net(nn.Module):
     def __init__(self, input_dim, hidden_layers=[]):
@@ -11,7 +15,7 @@ class Net(nn.Module):
 
         assert len(hidden_layers), "must have at least 1 hidden layer"
 
-        self.moves = ["stay", "hit", "double", "split", "surrender"]
+        self.moves = list(moves)
 
         self.input_dim = input_dim
         self.output_dim = len(self.moves)
@@ -26,11 +30,27 @@ class Net(nn.Module):
 
         self.fc_output = nn.Linear(self.hidden_layers[-1], self.output_dim)
 
-    def mask(self, valid_moves):
-        def to_mask(moves):
-            return [move not in moves for move in self.moves]
+        # (32, output_dim), True where a move is invalid, indexed by a valid move
+        # bitmask. Not persistent, so state_dicts are unchanged.
+        self.register_buffer(
+            "invalid_table",
+            torch.from_numpy(invalid_move_table(self.moves)),
+            persistent=False,
+        )
 
-        return torch.tensor(list(map(to_mask, valid_moves)))
+    def mask(self, valid_moves):
+        """
+        valid_moves is either a list of lists of moves, or integer bitmasks
+        (see Player.get_valid_moves_mask()). Returns True where a move is invalid,
+        as rows of invalid_table.
+        """
+        if isinstance(valid_moves, (torch.Tensor, np.ndarray)) or isinstance(
+            valid_moves[0], (int, np.integer)
+        ):
+            masks_t = torch.as_tensor(valid_moves, dtype=torch.int64)
+        else:
+            masks_t = torch.tensor([moves_to_mask(moves) for moves in valid_moves])
+        return self.invalid_table[masks_t.reshape(-1)]
 
     def forward(self, data):
         x_t = F.relu(self.fc_input(data))
@@ -39,14 +59,15 @@ class Net(nn.Module):
         return self.fc_output(x_t)
 
     def act(
-            self, obs, method="argmax", avail_actions=[]
+            self, obs, method="argmax", avail_actions=[], mask_t=None
             ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Used for explicit masking
 
         inputs:
         - obs: (batch_size, input_dim)
-        - avail_actions: empty or (batch_size, n_i)
+        - avail_actions: empty, (batch_size, n_i) moves, or (batch_size,) bitmasks
+        - mask_t: precomputed self.mask(avail_actions), used in place of avail_actions
 
         returns:
         - q_avail_t: (batch_size, len(self.moves))
@@ -55,20 +76,28 @@ class Net(nn.Module):
         """
 
         assert method in ["argmax", "softmax"], "must use a valid method"
-        with torch.no_grad():
+        # outputs are inference tensors: ops on them outside of inference mode (ie
+        # the TD targets of train_epoch) give normal tensors, but they can't be
+        # modified in place, or saved for backward as is (clone() them first).
+        with torch.inference_mode():
             q_values_t = self.forward(obs)
 
             q_avail_t: torch.Tensor = q_values_t
 
-            if avail_actions:
+            if mask_t is None and len(avail_actions):
                 mask_t = self.mask(avail_actions)
+            if mask_t is not None:
                 q_avail_t = q_avail_t.masked_fill(mask_t, -torch.inf)
 
-            if method == "argmax":
-                actions_t = torch.argmax(q_avail_t, dim=1, keepdim=True)
-            else:
-                action_p = F.softmax(q_avail_t, dim=1)
-                actions_t = torch.multinomial(action_p, num_samples=1)
+            scores_t = q_avail_t
+            if method == "softmax":
+                # Gumbel-max: the argmax of q + Gumbel noise is a sample of
+                # softmax(q), so both methods are a single masked argmax.
+                noise_t = torch.empty_like(q_avail_t).exponential_().log()
+                scores_t = q_avail_t - noise_t
+                if mask_t is not None:
+                    scores_t = scores_t.masked_fill(mask_t, -torch.inf)
+            actions_t = torch.argmax(scores_t, dim=1, keepdim=True)
 
             q_selection_t = q_avail_t.gather(1, index=actions_t)
 
@@ -0,0 +1,72 @@
+import queue
+import threading
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+import torch
+
+"""
+Background batch preparation for Trainer.train_epoch().
+
+A daemon thread keeps up to depth batches ready (double buffered by default):
+sampling the replay buffer, assembling the tensors, and building the invalid move
+mask of the next states for target_net.act(). The gradient step of the current
+batch (torch releases the GIL in forward / backward) then overlaps with the
+preparation of the next one.
+
+Batches are sampled a little ahead of their use, so they can miss the latest
+transitions. Sampling and the writes of the main thread share the replay buffer's
+lock, so a sampled row is never half overwritten. It's only used for uniform replay
+(priorities of prioritized replay are written back by index, after the batch).
+"""
+
+
+class PreparedBatch(NamedTuple):
+    obs_t: torch.Tensor
+    moves_t: torch.Tensor
+    rewards_t: torch.Tensor
+    dones_t: torch.Tensor
+    obs_next_t: torch.Tensor
+    # invalid moves of the next states, see Net.mask()
+    mask_next_t: torch.Tensor
+    # importance sampling weights + indices, prioritized replay only
+    weights_t: Optional[torch.Tensor] = None
+    inds: Optional[np.ndarray] = None
+
+
+class BatchPrefetcher:
+    def __init__(self, prepare: Callable[[], PreparedBatch], depth: int = 2):
+        """prepare() returns the next batch, called from the background thread"""
+        self.prepare = prepare
+        self.queue: queue.Queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        try:
+            while not self.stop_event.is_set():
+                batch = self.prepare()
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except BaseException as e:
+            self.error = e
+
+    def get(self) -> PreparedBatch:
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self.thread.is_alive() and self.error is None:
+                    raise Exception("prefetch thread stopped")
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
@@ -1,23 +1,300 @@
-from collections import deque
+from contextlib import nullcontext
 from dataclasses import dataclass, field
+from typing import ContextManager, Optional, Tuple, Union
 
 import numpy as np
+import torch
 
+from src.constants import moves
+from src.modules.actions import mask_to_moves, moves_to_mask
 from src.pydantic_types import ReplayBufferI
 
+"""
+Replay memory as a fixed capacity ring buffer of preallocated, typed arrays.
+
+Each field of a transition lives in its own contiguous array, written at the
+cursor, which wraps around once capacity is reached (oldest transitions are
+overwritten, like a deque with maxlen). Moves are stored as indices of
+constants.moves and action spaces as valid move bitmasks (see src.modules.actions).
+
+Collectors write transitions straight into the arrays with append(), without
+building a ReplayBufferI per transition. push() takes a ReplayBufferI, and
+validate=True rebuilds (ie validates) one for every append(), for debugging.
+
+Sampling gathers random rows with fancy indexing and wraps them with
+torch.from_numpy (no copy), so its cost only depends on the batch size.
+append() and sample() run under lock, a no-op unless another thread samples
+(Trainer.start_prefetch swaps in a threading.Lock), so a batch never mixes the
+fields of a row with those of the transition overwriting it.
+Arrays are allocated on the first write, once the observation size is known.
+
+PrioritizedReplayBuffer samples proportionally to priority**alpha instead
+(prioritized experience replay), with priorities held in a SumTree, and returns
+importance sampling weights to correct for it. Priorities are the absolute TD
+errors fed back with update_priorities(), new transitions get the max priority.
+"""
+
+SampleT = Tuple[
+    torch.Tensor,
+    np.ndarray,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    np.ndarray,
+]
+
+# action space stored for terminal transitions, which have no next state.
+_TERMINAL_MASK = moves_to_mask(["hit"])
+
 
 @dataclass
 class ReplayBuffer:
     capacity: int
-    memory: deque[ReplayBufferI] = field(init=False)
+    # validate every append() against ReplayBufferI (slow, for debugging)
+    validate: bool = False
+    size: int = field(init=False, default=0)
+    # index the next transition is written to
+    pos: int = field(init=False, default=0)
+    obs: Optional[np.ndarray] = field(init=False, default=None)
+    action_mask: np.ndarray = field(init=False)
+    move: np.ndarray = field(init=False)
+    reward: np.ndarray = field(init=False)
+    done: np.ndarray = field(init=False)
+    obs_next: Optional[np.ndarray] = field(init=False, default=None)
+    action_mask_next: np.ndarray = field(init=False)
+    # held while writing / sampling rows, see the module docstring
+    lock: ContextManager = field(init=False, default_factory=nullcontext, repr=False)
 
     def __post_init__(self):
-        self.memory = deque([], maxlen=self.capacity)
+        assert self.capacity > 0, "invalid capacity"
+        self.action_mask = np.zeros(self.capacity, dtype=np.int64)
+        self.move = np.zeros(self.capacity, dtype=np.int64)
+        self.reward = np.zeros(self.capacity, dtype=np.float32)
+        self.done = np.zeros(self.capacity, dtype=np.float32)
+        self.action_mask_next = np.zeros(self.capacity, dtype=np.int64)
+
+    def _allocate(self, obs_dim: int) -> None:
+        self.obs = np.zeros((self.capacity, obs_dim), dtype=np.float32)
+        self.obs_next = np.zeros((self.capacity, obs_dim), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(
+        self,
+        obs: Union[tuple, np.ndarray],
+        action_mask: int,
+        move: int,
+        reward: float,
+        done: int,
+        obs_next: Optional[Union[tuple, np.ndarray]] = None,
+        action_mask_next: Optional[int] = None,
+    ) -> None:
+        """
+        writes a transition in place.
+        action masks are valid move bitmasks, move is an index of constants.moves.
+        """
+        with self.lock:
+            self._write(
+                self.pos,
+                obs,
+                action_mask,
+                move,
+                reward,
+                done,
+                obs_next,
+                action_mask_next,
+            )
+            self.pos = (self.pos + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    def _write(
+        self,
+        i: int,
+        obs: tuple,
+        action_mask: int,
+        move: int,
+        reward: float,
+        done: int,
+        obs_next: Optional[tuple],
+        action_mask_next: Optional[int],
+    ) -> None:
+        if self.validate:
+            ReplayBufferI(
+                obs=tuple(obs),
+                action_space=mask_to_moves(action_mask),
+                move=moves[move],
+                reward=reward,
+                done=done,
+                obs_next=None if obs_next is None else tuple(obs_next),
+                action_space_next=(
+                    None
+                    if action_mask_next is None
+                    else mask_to_moves(action_mask_next)
+                ),
+            )
+        if self.obs is None:
+            self._allocate(len(obs))
+
+        self.obs[i] = obs
+        self.action_mask[i] = action_mask or _TERMINAL_MASK
+        self.move[i] = move
+        self.reward[i] = reward
+        self.done[i] = done
+        if obs_next is None:
+            self.obs_next[i] = 0
+            self.action_mask_next[i] = _TERMINAL_MASK
+        else:
+            self.obs_next[i] = obs_next
+            self.action_mask_next[i] = action_mask_next or _TERMINAL_MASK
 
     def push(self, item: ReplayBufferI):
-        self.memory.append(item)
+        self.append(
+            obs=item.obs,
+            action_mask=moves_to_mask(item.action_space),
+            move=moves.index(item.move),
+            reward=item.reward,
+            done=item.done,
+            obs_next=item.obs_next,
+            action_mask_next=(
+                None
+                if item.action_space_next is None
+                else moves_to_mask(item.action_space_next)
+            ),
+        )
+
+    def sample(self, batch_size: int) -> SampleT:
+        """
+        batch_size transitions, sampled uniformly with replacement.
+
+        returns:
+        - obs_t: (batch_size, obs_dim)
+        - action_mask: (batch_size,) valid move bitmasks
+        - moves_t: (batch_size, 1) indices of constants.moves
+        - rewards_t: (batch_size, 1)
+        - dones_t: (batch_size, 1)
+        - obs_next_t: (batch_size, obs_dim), 0 for terminal transitions
+        - action_mask_next: (batch_size,) valid move bitmasks of the next state
+        """
+        with self.lock:
+            assert self.size, "replay buffer is empty"
+            return self._gather(np.random.randint(self.size, size=batch_size))
+
+    def _gather(self, inds: np.ndarray) -> SampleT:
+        return (
+            torch.from_numpy(self.obs[inds]),
+            self.action_mask[inds],
+            torch.from_numpy(self.move[inds]).unsqueeze(-1),
+            torch.from_numpy(self.reward[inds]).unsqueeze(-1),
+            torch.from_numpy(self.done[inds]).unsqueeze(-1),
+            torch.from_numpy(self.obs_next[inds]),
+            self.action_mask_next[inds],
+        )
+
+
+class SumTree:
+    """
+    Binary tree over a flat array, each node the sum of its 2 children:
+    node 1 is the root, leaves are nodes [n_leaves, 2 * n_leaves).
+    Updates and proportional sampling walk a single path (O(log n)), vectorized
+    over a batch of leaves.
+    """
+
+    def __init__(self, capacity: int):
+        self.n_leaves = 1 << max(int(np.ceil(np.log2(capacity))), 0)
+        self.depth = int(np.log2(self.n_leaves))
+        self.tree = np.zeros(2 * self.n_leaves, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return self.tree[1]
+
+    def update(self, inds: np.ndarray, values: np.ndarray) -> None:
+        nodes = np.asarray(inds) + self.n_leaves
+        self.tree[nodes] = values
+        # parents are recomputed from their children, so leaves sharing a parent
+        # (or duplicated leaves) write the same sum.
+        for _ in range(self.depth):
+            nodes //= 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def update_one(self, ind: int, value: float) -> None:
+        node = ind + self.n_leaves
+        tree = self.tree
+        tree[node] = value
+        node //= 2
+        while node:
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+            node //= 2
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """leaf index of each value of the cumulative sum, values in [0, total)"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values = np.where(right, values - left, values)
+            nodes = 2 * nodes + right
+        return nodes - self.n_leaves
+
+
+@dataclass
+class PrioritizedReplayBuffer(ReplayBuffer):
+    # 0 is uniform sampling, 1 is fully proportional to priority
+    alpha: float = 0.6
+    # importance sampling exponent, annealed linearly to 1 over beta_steps samples
+    beta: float = 0.4
+    beta_steps: int = 100_000
+    # added to absolute TD errors, so no transition stops being sampled
+    eps: float = 1e-3
+    max_priority: float = field(init=False, default=1.0)
+    n_samples: int = field(init=False, default=0)
+    tree: SumTree = field(init=False, repr=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.tree = SumTree(self.capacity)
+
+    def append(self, *args, **kwargs) -> None:
+        i = self.pos
+        super().append(*args, **kwargs)
+        self.tree.update_one(i, self.max_priority**self.alpha)
+
+    @property
+    def beta_now(self) -> float:
+        frac = min(self.n_samples / max(self.beta_steps, 1), 1)
+        return self.beta + frac * (1 - self.beta)
+
+    def sample_prioritized(
+        self, batch_size: int
+    ) -> Tuple[SampleT, torch.Tensor, np.ndarray]:
+        """
+        stratified proportional sample.
+
+        returns:
+        - the same batch as sample()
+        - weights_t: (batch_size, 1) importance sampling weights (max of 1)
+        - inds: (batch_size,) indices of the transitions, for update_priorities()
+        """
+        assert self.size, "replay buffer is empty"
+        total = self.tree.total
+        segment = total / batch_size
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+        inds = self.tree.find(np.minimum(values, np.nextafter(total, 0)))
+        # rounding can land past the filled leaves, which have 0 priority
+        inds = np.minimum(inds, self.size - 1)
+
+        probs = self.tree.tree[inds + self.tree.n_leaves] / total
+        weights = (self.size * probs) ** -self.beta_now
+        weights /= weights.max()
+        self.n_samples += batch_size
 
-    def sample(self, batch_size: int):
-        inds = np.random.choice(self.memory.__len__(), batch_size, replace=True)
+        weights_t = torch.from_numpy(weights.astype(np.float32)).unsqueeze(-1)
+        return self._gather(inds), weights_t, inds
 
-        return [self.memory[i] for i in inds]
+    def update_priorities(self, inds: np.ndarray, td_errors: np.ndarray) -> None:
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(inds, priorities**self.alpha)
@@ -1,34 +1,70 @@
 from __future__ import annotations
 
-from copy import deepcopy
-from typing import TYPE_CHECKING
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+from copy import copy, deepcopy
+from typing import TYPE_CHECKING, Callable, List, Optional, Union
 
 import numpy as np
 import torch
 import torch.nn as nn
 
-from src.deep_learning.modules.replay import ReplayBuffer
-from src.deep_learning.utils.replay_buffer import (gather_buffer_obs,
-                                                   update_replay_buffer)
-from src.deep_learning.utils.runner import play_games
+from src.deep_learning.modules.prefetch import BatchPrefetcher, PreparedBatch
+from src.deep_learning.modules.replay import (PrioritizedReplayBuffer,
+                                              ReplayBuffer)
+from src.deep_learning.utils.replay_buffer import (
+    gather_buffer_obs, update_replay_buffer, update_replay_buffer_lockstep)
+from src.deep_learning.utils.runner import evaluate_streaming, play_games
+from src.utils.background_eval import BackgroundEvaluator, EvalResult
 
 if TYPE_CHECKING:
     # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
     from src.deep_learning.modules import Net
     from src.modules.game import Game
+    from src.modules.observation import ObservationEncoder
 
 
 class Trainer:
     def __init__(
             self, online_net, target_net, replay_size, include_count,
+            validate_transitions: bool = False,
+            prioritized: bool = False, alpha: float = 0.6, beta: float = 0.4,
+            beta_steps: int = 100_000,
     ):
+        """
+        include_count : whether observations include the true count, or an
+        ObservationEncoder for other features (see src.modules.observation).
+        validate_transitions : validate every transition written to the replay buffer
+        against ReplayBufferI (slow, for debugging).
+        prioritized : sample transitions proportionally to their TD error**alpha
+        (PrioritizedReplayBuffer), with importance sampling weights annealed from
+        beta to 1 over beta_steps sampled transitions.
+        """
         self.online_net: Net = online_net
         self.target_net: Net = target_net
 
         self.include_count = include_count
 
         self.replay_size = replay_size
-        self.replay_buffer = ReplayBuffer(capacity=replay_size)
+        self.prioritized = prioritized
+        if prioritized:
+            self.replay_buffer = PrioritizedReplayBuffer(
+                capacity=replay_size,
+                validate=validate_transitions,
+                alpha=alpha,
+                beta=beta,
+                beta_steps=beta_steps,
+            )
+        else:
+            self.replay_buffer = ReplayBuffer(
+                capacity=replay_size, validate=validate_transitions
+            )
+
+        self.prefetcher: Optional[BatchPrefetcher] = None
+        self.prefetch_batch_size = 0
+        # fractional gradient steps owed by train_round()
+        self.replay_credit = 0.0
 
     def copy_online_to_target(self):
         self.target_net.load_state_dict(deepcopy(self.online_net.state_dict()))
@@ -45,30 +81,101 @@ class Trainer:
                 force_cards=force_cards,
             )
 
+    def update_buffer_lockstep(
+        self, games: List[Game], method: str = "random", force_cards=[]
+    ):
+        """a round on every game, with batched forward passes across games"""
+        with torch.no_grad():
+            update_replay_buffer_lockstep(
+                games=games,
+                buffer=self.replay_buffer,
+                model=self.online_net,
+                include_count=self.include_count,
+                include_continuous_count=False,
+                method=method,
+                force_cards=force_cards,
+            )
+
+    def prepare_batch(self, batch_size: int) -> PreparedBatch:
+        """samples a batch, with the tensors train_epoch() needs"""
+        weights_t, inds = None, None
+        if self.prioritized:
+            batch, weights_t, inds = self.replay_buffer.sample_prioritized(batch_size)
+        else:
+            batch = gather_buffer_obs(
+                replay_buffer=self.replay_buffer,
+                batch_size=batch_size,
+                moves=self.online_net.moves,
+            )
+        (
+            obs_t,
+            _,
+            moves_t,
+            rewards_t,
+            dones_t,
+            obs_next_t,
+            action_space_next,
+        ) = batch
+        return PreparedBatch(
+            obs_t=obs_t,
+            moves_t=moves_t,
+            rewards_t=rewards_t,
+            dones_t=dones_t,
+            obs_next_t=obs_next_t,
+            mask_next_t=self.target_net.mask(action_space_next),
+            weights_t=weights_t,
+            inds=inds,
+        )
+
+    def start_prefetch(self, batch_size: int, depth: int = 2) -> None:
+        """
+        batches of batch_size are prepared by a background thread from now on,
+        overlapping with the gradient steps of train_epoch(). See prefetch.py.
+        Until stop_prefetch(), the replay buffer's writes and samples are locked.
+        Not available with prioritized replay: sampling would race with the
+        priority updates, and prefetched indices can be overwritten before their
+        TD errors are written back.
+        """
+        assert not self.prioritized, "prefetching isn't supported with prioritized"
+        assert len(self.replay_buffer), "replay buffer is empty"
+        self.stop_prefetch()
+        self.prefetch_batch_size = batch_size
+        self.replay_buffer.lock = threading.Lock()
+        self.prefetcher = BatchPrefetcher(
+            lambda: self.prepare_batch(batch_size), depth=depth
+        )
+
+    def stop_prefetch(self) -> None:
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+            self.replay_buffer.lock = nullcontext()
+
     def train_epoch(
             self, batch_size: int, gamma: float, loss_fct: nn.modules.loss._Loss,
             optimizer: torch.optim.Optimizer,
             scheduler: torch.optim.lr_scheduler.ExponentialLR):
         # Accumulate SARSA observations from replay buffer
+        if (self.prefetcher is not None) and (batch_size == self.prefetch_batch_size):
+            batch = self.prefetcher.get()
+        else:
+            batch = self.prepare_batch(batch_size)
         (
             obs_t,
-            _,
             moves_t,
             rewards_t,
             dones_t,
             obs_next_t,
-            action_space_next,
-        ) = gather_buffer_obs(
-            replay_buffer=self.replay_buffer,
-            batch_size=batch_size,
-            moves=self.online_net.moves,
-        )
+            mask_next_t,
+            weights_t,
+            inds,
+        ) = batch
 
         # Use these next states + next action_spaces to get target network
         # outputs (optimal next q value)
         target_q_argmax: torch.Tensor
         _, target_q_argmax, _ = self.target_net.act(
-            obs_next_t, method="argmax", avail_actions=action_space_next
+            obs_next_t, method="argmax", mask_t=mask_next_t
         )
 
         # reward clipping. We know our real rewards are bounded to [-2,2]
@@ -91,7 +198,16 @@ class Trainer:
         # )
 
         optimizer.zero_grad()
-        loss: torch.Tensor = loss_fct(action_q_values, targets_t)
+        loss: torch.Tensor
+        if weights_t is None:
+            loss = loss_fct(action_q_values, targets_t)
+        else:
+            # per transition losses, weighted to correct for prioritized sampling
+            elementwise_fct = copy(loss_fct)
+            elementwise_fct.reduction = "none"
+            loss = (weights_t * elementwise_fct(action_q_values, targets_t)).mean()
+            td_errors = (targets_t - action_q_values).detach().squeeze(-1).numpy()
+            self.replay_buffer.update_priorities(inds, td_errors)
         loss.backward()
         # nn.utils.clip_grad_value_(self.online_net.parameters(), 100)
         optimizer.step()
@@ -99,17 +215,136 @@ class Trainer:
 
         return loss.item()
 
-    async def eval(self, n_games: int, n_rounds: int, wagers, game_hyperparams):
-        self.online_net.eval()
+    def train_round(
+            self, blackjack: Game, batch_size: int, gamma: float,
+            loss_fct: nn.modules.loss._Loss, optimizer: torch.optim.Optimizer,
+            scheduler: torch.optim.lr_scheduler.ExponentialLR,
+            method: str = "random", force_cards=[], replay_ratio: float = 1):
+        """
+        collects a round (update_buffer), then runs replay_ratio gradient steps.
+        Fractional ratios carry over between calls (ie 0.25 is a step every 4 rounds).
+        Returns the losses of the steps.
+        """
+        self.update_buffer(blackjack=blackjack, method=method, force_cards=force_cards)
+
+        self.replay_credit += replay_ratio
+        n_steps = int(self.replay_credit)
+        self.replay_credit -= n_steps
+
+        return [
+            self.train_epoch(
+                batch_size=batch_size,
+                gamma=gamma,
+                loss_fct=loss_fct,
+                optimizer=optimizer,
+                scheduler=scheduler,
+            )
+            for _ in range(n_steps)
+        ]
 
-        r = await play_games(
+    async def eval(
+        self,
+        n_games: int,
+        n_rounds: int,
+        wagers,
+        game_hyperparams,
+        executor: str = "serial",
+        n_workers: Optional[int] = None,
+        seed: Optional[int] = None,
+        half_width: Optional[float] = None,
+        time_budget: Optional[float] = None,
+        lockstep: bool = False,
+    ):
+        """
+        executor, n_workers and seed are passed to src.utils.executor.
+        if half_width or time_budget is passed, games of n_rounds are only played
+        until the 95% CI of the mean reward is within +/- half_width, or time_budget
+        seconds have passed (at most n_games of them).
+        lockstep : play games together, batching forward passes (see play_games).
+        """
+        self.online_net.eval()
+        return await evaluate_model(
             model=self.online_net,
+            include_count=self.include_count,
             n_games=n_games,
             n_rounds=n_rounds,
             wagers=wagers,
+            game_hyperparams=game_hyperparams,
+            executor=executor,
+            n_workers=n_workers,
+            seed=seed,
+            half_width=half_width,
+            time_budget=time_budget,
+            lockstep=lockstep,
+        )
+
+    def eval_async(
+        self,
+        evaluator: BackgroundEvaluator,
+        step: int,
+        callback: Optional[Callable[[EvalResult], None]] = None,
+        **eval_kwargs,
+    ) -> "Future[EvalResult]":
+        """
+        eval() of a snapshot of the online network, in a background process, while
+        training continues. eval_kwargs are those of eval().
+        Returns a future of the EvalResult (mean reward), tagged with step.
+        """
+        model = deepcopy(self.online_net).cpu()
+        model.eval()
+        return evaluator.submit(
+            step,
+            evaluate_model,
+            callback=callback,
+            model=model,
             include_count=self.include_count,
+            **eval_kwargs,
+        )
+
+
+async def evaluate_model(
+    model: Net,
+    include_count: Union[bool, ObservationEncoder],
+    n_games: int,
+    n_rounds: int,
+    wagers,
+    game_hyperparams,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    half_width: Optional[float] = None,
+    time_budget: Optional[float] = None,
+    lockstep: bool = False,
+) -> float:
+    """mean reward of the first player, see Trainer.eval()"""
+    if (half_width is not None) or (time_budget is not None):
+        summary = await evaluate_streaming(
+            model=model,
+            wagers=wagers,
+            include_count=include_count,
             game_hyperparams=game_hyperparams,
+            half_width=half_width,
+            time_budget=time_budget,
+            max_rounds=n_rounds * n_games,
+            chunk_rounds=n_rounds,
+            executor=executor,
+            n_workers=n_workers,
+            seed=seed,
         )
-        mean_reward = np.mean(r[:, 0, :])
+        return summary.mean[0]
+
+    r = await play_games(
+        model=model,
+        n_games=n_games,
+        n_rounds=n_rounds,
+        wagers=wagers,
+        include_count=include_count,
+        game_hyperparams=game_hyperparams,
+        executor=executor,
+        n_workers=n_workers,
+        seed=seed,
+        lockstep=lockstep,
+    )
+    mean_reward = np.mean(r[:, 0, :])
 
-        return mean_reward
+    return mean_reward
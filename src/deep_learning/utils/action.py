@@ -1,10 +1,14 @@
 from __future__ import \
     annotations  # required for preventing the cyclical import of type annotations
 
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Tuple, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
+
+from src.modules.actions import mask_to_moves
+from src.modules.observation import ObservationEncoder, as_encoder
 
 if TYPE_CHECKING:
     # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
@@ -12,12 +16,18 @@ if TYPE_CHECKING:
 
 
 def select_action(
-    model: Net, method: str, policy: List[str], observation: tuple,
+    model: Net, method: str, policy: Union[List[str], int], observation: tuple,
 ) -> str:
+    """
+    policy is a list of valid moves, or a bitmask of valid moves.
+    observation is a tuple, or a float32 row (ie of ObservationEncoder.empty()).
+    """
     if method == "random":
+        if isinstance(policy, int):
+            policy = mask_to_moves(policy)
         return np.random.choice(policy)
     with torch.no_grad():
-        obs_t = torch.tensor(observation, dtype=torch.float32).unsqueeze(0)
+        obs_t = torch.as_tensor(observation, dtype=torch.float32).unsqueeze(0)
         _, _, action_ind = model.act(
             obs=obs_t,
             method=method,
@@ -27,4 +37,78 @@ def select_action(
         return move
 
 
-__all__ = ["select_action"]
+def action_probabilities(
+    model: Net,
+    method: str,
+    observations: np.ndarray,
+    avail_actions: Union[List[List[str]], np.ndarray],
+) -> np.ndarray:
+    """
+    Probability select_action() gives to each of model.moves, for a batch of
+    observations (n, input_dim) and their valid moves (n,) -> (n, len(model.moves)).
+    Used as the target policy (or logged behavior policy) of off-policy evaluation.
+    """
+    mask_t = model.mask(avail_actions)
+    if method == "random":
+        valid_t = (~mask_t).double()
+        return (valid_t / valid_t.sum(dim=1, keepdim=True)).numpy()
+
+    obs_t = torch.as_tensor(observations, dtype=torch.float32)
+    q_avail_t, _, actions_t = model.act(
+        obs=obs_t, method="argmax", avail_actions=avail_actions
+    )
+    if method == "softmax":
+        return F.softmax(q_avail_t.double(), dim=1).numpy()
+    probs_t = torch.zeros(q_avail_t.shape, dtype=torch.float64)
+    return probs_t.scatter_(1, actions_t, 1.0).numpy()
+
+
+def select_actions(
+    model: Net,
+    method: str,
+    policies: np.ndarray,
+    observations: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched select_action(), with a single forward pass for every observation.
+    policies are (batch_size,) bitmasks of valid moves.
+
+    returns:
+    - actions: (batch_size,) indices of model.moves
+    - probabilities: (batch_size,) probability of each selected action
+    """
+    probs = action_probabilities(model, method, observations, policies)
+    if method == "argmax":
+        actions = probs.argmax(axis=1)
+    else:
+        cum = probs.cumsum(axis=1)
+        # scaled by the total, so rounding can't leave every move below u
+        u = np.random.rand(len(probs), 1) * cum[:, -1:]
+        actions = (cum > u).argmax(axis=1)
+    return actions, probs[np.arange(len(actions)), actions]
+
+
+def action_values(model: Net, observations: np.ndarray) -> np.ndarray:
+    """q values of every move, (n, input_dim) -> (n, len(model.moves))"""
+    with torch.no_grad():
+        obs_t = torch.as_tensor(observations, dtype=torch.float32)
+        return model(obs_t).double().numpy()
+
+
+def decision_observations(
+    decisions: np.ndarray, include_count: Union[bool, ObservationEncoder]
+) -> np.ndarray:
+    """
+    observations of logged decisions (HandRecorder "decisions" rows), encoded like
+    the runners encode them.
+    """
+    return as_encoder(include_count).encode_decisions(decisions)
+
+
+__all__ = [
+    "select_action",
+    "select_actions",
+    "action_probabilities",
+    "action_values",
+    "decision_observations",
+]
@@ -0,0 +1,113 @@
+from __future__ import \
+    annotations  # required for preventing the cyclical import of type annotations
+
+from typing import TYPE_CHECKING, Optional, Sequence
+
+import numpy as np
+import torch
+
+from src.constants import moves
+from src.modules.actions import invalid_move_table
+from src.modules.observation import ObservationEncoder
+from src.q.utils.policy import CompiledPolicy
+
+from .viz.helpers import gen_all_states
+
+if TYPE_CHECKING:
+    # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
+    from src.deep_learning.modules import Net
+
+"""
+Distills a Net into the lookup tables of a CompiledPolicy (src.q.utils.policy).
+
+The Net is evaluated once over every observation of gen_all_states(), and the
+greedy move (Net.act argmax, so ties go to the first move) is tabulated for every
+valid move mask. Gameplay with the result (play_n_games, bankroll runners, ...)
+is then an array lookup per decision, and doesn't need torch at all
+(CompiledPolicy.save / load only use numpy).
+
+Nets with the true count as input are evaluated at each of count_buckets, and a
+decision uses the bucket closest to the game's true count.
+# noqa: E501
+"""
+
+
+def distill_policy(
+    model: Net,
+    count_buckets: Optional[Sequence[float]] = None,
+    encoder: Optional[ObservationEncoder] = None,
+) -> CompiledPolicy:
+    """
+    count_buckets : true counts to evaluate the model at, required if (and only if)
+        the model's input includes the true count, ie np.arange(-5, 6).
+    encoder : encoding of the model's observations, defaults to the runners' one
+        (with the true count if the model has 4 inputs). Models fed can_split /
+        can_double are evaluated for every valid move mask.
+    """
+    if encoder is None:
+        encoder = ObservationEncoder(include_count=model.input_dim == 4)
+    assert encoder.dim == model.input_dim, "invalid encoder"
+    assert not encoder.cards_remaining, "cards remaining can't be tabulated"
+    include_count = encoder.include_count
+    assert include_count == (count_buckets is not None), "invalid count_buckets"
+
+    states = np.array(gen_all_states(), dtype=np.float32)
+    n_moves = len(model.moves)
+    # (32, n_moves), True where a move is valid, in the model's move order
+    valid = ~invalid_move_table(model.moves)
+    # the policy's actions are indices in constants.moves
+    move_index = np.array([moves.index(move) for move in model.moves])
+
+    if include_count:
+        counts = np.sort(np.asarray(count_buckets, dtype=np.float32))
+    else:
+        counts = np.zeros(1, dtype=np.float32)
+    # observations only vary with the mask if the encoder says so.
+    n_masks = 32 if encoder.uses_mask else 1
+    c_ind, s_ind, m_ind = np.indices((len(counts), len(states), n_masks)).reshape(
+        3, -1
+    )
+    observations = encoder.encode_arrays(
+        states[s_ind, 0],
+        states[s_ind, 1],
+        states[s_ind, 2],
+        mask=m_ind,
+        true_count=counts[c_ind],
+    )
+
+    model.eval()
+    with torch.no_grad():
+        q_values = model(torch.from_numpy(observations)).numpy()
+
+    # (n_buckets, n_states, 32, n_moves)
+    q_masked = np.where(
+        valid, q_values.reshape(len(counts), len(states), n_masks, n_moves), -np.inf
+    )
+    best = q_masked.argmax(axis=-1)
+    best_values = np.take_along_axis(q_masked, best[..., None], axis=-1)[..., 0]
+    no_moves = ~valid.any(axis=-1)
+
+    actions = np.full((len(counts), 22, 12, 2, 32), -1, dtype=np.int8)
+    max_values = np.full((len(counts), 22, 12, 2, 32), np.nan, dtype=np.float32)
+    p = states[:, 0].astype(int)
+    h = states[:, 1].astype(int)
+    ace = (states[:, 2] > 0).astype(int)
+    actions[:, p, h, ace] = np.where(no_moves, -1, move_index[best])
+    max_values[:, p, h, ace] = np.where(no_moves, np.nan, best_values)
+
+    count_bins = None
+    if include_count:
+        # a true count maps to the closest bucket
+        count_bins = (counts[1:] + counts[:-1]) / 2
+    else:
+        actions = actions[0]
+        max_values = max_values[0]
+
+    actions.setflags(write=False)
+    max_values.setflags(write=False)
+    return CompiledPolicy(
+        actions=actions, max_values=max_values, count_bins=count_bins
+    )
+
+
+__all__ = ["distill_policy"]
@@ -1,14 +1,16 @@
 from __future__ import \
     annotations  # required for preventing the cyclical import of type annotations
 
-from typing import TYPE_CHECKING, List, Tuple
+from typing import TYPE_CHECKING, List, Tuple, Union
 
+import numpy as np
 import torch
 
+from src import constants
 from src.modules.game import Game
-from src.pydantic_types import ReplayBufferI
+from src.modules.observation import ObservationEncoder, as_encoder
 
-from .action import select_action
+from .action import action_probabilities, select_action, select_actions
 
 if TYPE_CHECKING:
     # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
@@ -19,7 +21,7 @@ def generate_state_action_pairs(
     blackjack: Game,
     player_ind: int,
     model: Net,
-    include_count: bool,
+    include_count: Union[bool, ObservationEncoder],
     include_continuous_count: bool,
     method: str = "random",
 ) -> List[List[Tuple]]:
@@ -27,31 +29,31 @@ def generate_state_action_pairs(
     house_value = house_card_show.value if house_card_show.value > 1 else 11
     player = blackjack.players[player_ind]
 
+    encoder = as_encoder(include_count)
     s_a = [[]]
 
     true_count = blackjack.true_count
+    # rows are kept by s_a, so a new block is allocated once one is filled.
+    observations = encoder.empty(8)
+    n_obs = 0
 
     while not player.is_done():
-        player_total, useable_ace = player.get_value()
-        policy = player.get_valid_moves()
-
-        if include_count:
-            observation = (
-                player_total,
-                house_value,
-                2 * int(useable_ace) - 1,
-                # 2 * int("split" in policy) - 1,
-                # 2 * int("double" in policy) - 1,
-                true_count
-            )
-        else:
-            observation = (
-                player_total,
-                house_value,
-                2 * int(useable_ace) - 1,
-                # 2 * int("split" in policy) - 1,
-                # 2 * int("double" in policy) - 1
-            )
+        policy = player.get_valid_moves_mask()
+
+        if n_obs == len(observations):
+            observations = encoder.empty(len(observations))
+            n_obs = 0
+        encoder.write_player(
+            observations,
+            n_obs,
+            blackjack,
+            player_ind,
+            house_value,
+            mask=policy,
+            true_count=true_count,
+        )
+        observation = observations[n_obs]
+        n_obs += 1
 
         move = select_action(
             model=model, method=method, policy=policy, observation=observation
@@ -65,7 +67,17 @@ def generate_state_action_pairs(
         if move == "split":
             s_a.append(s_a[nHand].copy())
 
-        blackjack.step_player(player_ind, move)
+        propensity = float("nan")
+        if blackjack.recorder is not None:
+            probs = action_probabilities(
+                model=model,
+                method=method,
+                observations=observation[None],
+                avail_actions=[policy],
+            )
+            propensity = float(probs[0, model.moves.index(move)])
+
+        blackjack.step_player(player_ind, move, propensity)
 
         if include_continuous_count:
             true_count = blackjack.true_count
@@ -77,7 +89,7 @@ def update_replay_buffer(
     blackjack: Game,
     buffer: ReplayBuffer,
     model: Net,
-    include_count: bool,
+    include_count: Union[bool, ObservationEncoder],
     include_continuous_count: bool,
     method: str = "random",
     force_cards: list = [],
@@ -100,8 +112,85 @@ def update_replay_buffer(
 
     _, results = blackjack.get_results()
 
-    rewards = results[0]
+    push_transitions(buffer=buffer, s_a_pairs=s_a_pairs, rewards=results[0])
+
+
+def update_replay_buffer_lockstep(
+    games: List[Game],
+    buffer: ReplayBuffer,
+    model: Net,
+    include_count: Union[bool, ObservationEncoder],
+    include_continuous_count: bool,
+    method: str = "random",
+    force_cards: list = [],
+):
+    """
+    update_replay_buffer() on a round of every game, with the games advanced
+    together: the pending decisions of all games are batched into a single
+    forward pass per step (see select_actions()).
+    """
+    encoder = as_encoder(include_count)
+    s_a_pairs = []
+    house_values = []
+    true_counts = []
+    for blackjack in games:
+        blackjack.init_round([1])
+        blackjack.deal_init(force_cards=force_cards)
+        house_card_show = blackjack.get_house_show()
+        house_values.append(
+            house_card_show.value if house_card_show.value > 1 else 11
+        )
+        true_counts.append(blackjack.true_count)
+        s_a_pairs.append([[]])
+
+    active = [k for k in range(len(games)) if not games[k].players[0].is_done()]
+    while active:
+        policies = np.array(
+            [games[k].players[0].get_valid_moves_mask() for k in active]
+        )
+        # a fresh array every step, its rows are kept by s_a_pairs.
+        observations = encoder.encode_games(
+            [games[k] for k in active],
+            [0] * len(active),
+            [house_values[k] for k in active],
+            masks=policies,
+            true_counts=[true_counts[k] for k in active],
+        )
+
+        actions, probabilities = select_actions(model, method, policies, observations)
 
+        for k, observation, policy, action, propensity in zip(
+            active, observations, policies, actions, probabilities
+        ):
+            blackjack = games[k]
+            player = blackjack.players[0]
+            move = model.moves[action]
+
+            nHand = player.i_hand  # need this for isolating "split" moves.
+            s_a_pairs[k][nHand].append((observation, int(policy), move))
+            if move == "split":
+                s_a_pairs[k].append(s_a_pairs[k][nHand].copy())
+
+            blackjack.step_player(0, move, float(propensity))
+
+            if include_continuous_count:
+                true_counts[k] = blackjack.true_count
+
+        active = [k for k in active if not games[k].players[0].is_done()]
+
+    for blackjack, s_a in zip(games, s_a_pairs):
+        blackjack.step_house(only_reveal_card=True)
+        while not blackjack.house_done():
+            blackjack.step_house()
+
+        _, results = blackjack.get_results()
+        push_transitions(buffer=buffer, s_a_pairs=s_a, rewards=results[0])
+
+
+def push_transitions(
+    buffer: ReplayBuffer, s_a_pairs: List[List[Tuple]], rewards: List[float]
+):
+    """writes the transitions of a played hand (and its splits) to the buffer"""
     for i, s_a_pair_hand in enumerate(s_a_pairs):
         for j, s_a_pair in enumerate(s_a_pair_hand):
             state_obs, action_space, move = s_a_pair
@@ -127,49 +216,36 @@ def update_replay_buffer(
                     reward = sum(rewards) / len(rewards)
                 state_obs_next, action_space_next, _ = s_a_pair_hand[j + 1]
 
-            buffer.push(
-                ReplayBufferI(
-                    obs=state_obs,
-                    action_space=action_space,
-                    move=move,
-                    reward=reward,
-                    done=done,
-                    obs_next=state_obs_next,
-                    action_space_next=action_space_next,
-                )
+            # written straight into the buffer's arrays, see ReplayBuffer.append()
+            buffer.append(
+                obs=state_obs,
+                action_mask=action_space,
+                move=constants.moves.index(move),
+                reward=reward,
+                done=done,
+                obs_next=state_obs_next,
+                action_mask_next=action_space_next,
             )
 
 
 def gather_buffer_obs(replay_buffer: ReplayBuffer, batch_size: int, moves: List[str]):
-    observations = replay_buffer.sample(batch_size=batch_size)
-
-    dim = len(observations[0].obs)
-    filler = tuple([0] * dim)
-
-    (obs, action_space, moves_, rewards, dones, obs_next, action_space_next) = (
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-    )
+    """
+    samples a batch from the replay buffer, see ReplayBuffer.sample().
+    moves_t index moves (the model's move order).
+    """
+    (
+        obs_t,
+        action_space,
+        moves_t,
+        rewards_t,
+        dones_t,
+        obs_next_t,
+        action_space_next,
+    ) = replay_buffer.sample(batch_size=batch_size)
 
-    for observation in observations:
-        obs.append(observation.obs)
-        action_space.append(observation.action_space or ["hit"])
-        moves_.append(moves.index(observation.move))
-        rewards.append(observation.reward)
-        dones.append(observation.done)
-        obs_next.append(observation.obs_next or filler)
-        action_space_next.append(observation.action_space_next or ["hit"])
-
-    obs_t = torch.tensor(obs, dtype=torch.float32)
-    moves_t = torch.tensor(moves_, dtype=torch.int64).unsqueeze(-1)
-    rewards_t = torch.tensor(rewards, dtype=torch.float32).unsqueeze(-1)
-    dones_t = torch.tensor(dones, dtype=torch.float32).unsqueeze(-1)
-    obs_next_t = torch.tensor(obs_next, dtype=torch.float32)
+    if list(moves) != constants.moves:
+        lookup_t = torch.tensor([moves.index(move) for move in constants.moves])
+        moves_t = lookup_t[moves_t]
 
     return (
         obs_t,
@@ -185,5 +261,7 @@ def gather_buffer_obs(replay_buffer: ReplayBuffer, batch_size: int, moves: List[
 __all__ = [
     "generate_state_action_pairs",
     "update_replay_buffer",
+    "update_replay_buffer_lockstep",
+    "push_transitions",
     "gather_buffer_obs",
 ]
@@ -1,14 +1,16 @@
 from __future__ import \
     annotations  # required for preventing the cyclical import of type annotations
 
-import asyncio
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Optional, Union
 
 import numpy as np
 
 from src.modules.game import Game
+from src.modules.observation import ObservationEncoder, as_encoder
+from src.utils.executor import run_tasks
+from src.utils.stats import EvalSummary, Welford, run_until_precise
 
-from .action import select_action
+from .action import select_action, select_actions
 
 if TYPE_CHECKING:
     # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
@@ -19,7 +21,7 @@ def play_round(
     blackjack: Game,
     model: Net,
     wagers: List[float],
-    include_count: bool,
+    include_count: Union[bool, ObservationEncoder],
 ):
     blackjack.init_round(wagers)
     blackjack.deal_init()
@@ -27,36 +29,22 @@ def play_round(
     house_card_show = blackjack.get_house_show()
     house_value = house_card_show.value if house_card_show.value > 1 else 11
 
+    encoder = as_encoder(include_count)
+    observation = encoder.empty(1)
+
     for i, player in enumerate(blackjack.players):
         while not player.is_done():
-            player_total, useable_ace = player.get_value()
-            policy = player.get_valid_moves()
-
-            if include_count:
-                observation = (
-                    player_total,
-                    house_value,
-                    2 * int(useable_ace) - 1,
-                    # 2 * int("split" in policy) - 1,
-                    # 2 * int("double" in policy) - 1,
-                    blackjack.true_count
-                )
-            else:
-                observation = (
-                    player_total,
-                    house_value,
-                    2 * int(useable_ace) - 1,
-                    # 2 * int("split" in policy) - 1,
-                    # 2 * int("double" in policy) - 1
-                )
+            policy = player.get_valid_moves_mask()
+            encoder.write_player(observation, 0, blackjack, i, house_value, mask=policy)
             move = select_action(
                 model=model,
                 method="argmax",
                 policy=policy,
-                observation=observation,
+                observation=observation[0],
             )
 
-            blackjack.step_player(i, move)
+            # argmax is deterministic
+            blackjack.step_player(i, move, 1.0)
 
     blackjack.step_house(only_reveal_card=True)
     while not blackjack.house_done():
@@ -67,12 +55,12 @@ def play_round(
     return players_winnings
 
 
-async def play_rounds(
+def run_rounds(
     blackjack: Game,
     model: Net,
     n_rounds: int,
     wagers: List[float],
-    include_count: bool,
+    include_count: Union[bool, ObservationEncoder],
 ):
     rewards = [[] for _ in wagers]
 
@@ -91,31 +79,233 @@ async def play_rounds(
     return rewards
 
 
+async def play_rounds(
+    blackjack: Game,
+    model: Net,
+    n_rounds: int,
+    wagers: List[float],
+    include_count: Union[bool, ObservationEncoder],
+):
+    return run_rounds(
+        blackjack=blackjack,
+        model=model,
+        n_rounds=n_rounds,
+        wagers=wagers,
+        include_count=include_count,
+    )
+
+
+def play_game(
+    model: Net,
+    n_rounds: int,
+    wagers: List[float],
+    include_count: Union[bool, ObservationEncoder],
+    game_hyperparams: object,
+) -> np.ndarray:
+    """a single game on a fresh Game. Module level so it can be sent to a process pool."""  # noqa: E501
+    model.eval()
+    rewards = run_rounds(
+        blackjack=Game(**game_hyperparams),
+        model=model,
+        n_rounds=n_rounds,
+        wagers=wagers,
+        include_count=include_count,
+    )
+    return np.array(rewards)
+
+
+def _start_round(blackjack: Game, wagers: List[float]) -> int:
+    """deals a new round, returns the house value"""
+    blackjack.init_round(wagers)
+    blackjack.deal_init()
+    house_card_show = blackjack.get_house_show()
+    return house_card_show.value if house_card_show.value > 1 else 11
+
+
+def _finish_round(blackjack: Game) -> List[float]:
+    """plays out the house, returns the reward of each player"""
+    blackjack.step_house(only_reveal_card=True)
+    while not blackjack.house_done():
+        blackjack.step_house()
+    _, players_winnings = blackjack.get_results()
+    return [sum(reward) for reward in players_winnings]
+
+
+def run_games_lockstep(
+    games: List[Game],
+    model: Net,
+    n_rounds: int,
+    wagers: List[float],
+    include_count: Union[bool, ObservationEncoder],
+) -> np.ndarray:
+    """
+    Plays n_rounds on every game, advancing all of them together. At each step, the
+    pending decision of every game is gathered into a single batch, so the model
+    does one forward pass per step rather than one per decision.
+    Games are independent, so they can be at different rounds.
+
+    returns rewards as an (n_games x n_players x n_rounds) array.
+    """
+    encoder = as_encoder(include_count)
+    buffer = encoder.empty(len(games))
+    rewards = np.zeros((len(games), len(wagers), n_rounds))
+    rounds = [0] * len(games)
+    seats = [0] * len(games)
+    house_values = [_start_round(blackjack, wagers) for blackjack in games]
+
+    active = list(range(len(games)))
+    while active:
+        pending = []
+        for k in active:
+            blackjack = games[k]
+            while rounds[k] < n_rounds:
+                players = blackjack.players
+                while seats[k] < len(players) and players[seats[k]].is_done():
+                    seats[k] += 1
+                if seats[k] < len(players):
+                    pending.append(k)
+                    break
+                rewards[k, :, rounds[k]] = _finish_round(blackjack)
+                rounds[k] += 1
+                seats[k] = 0
+                if rounds[k] < n_rounds:
+                    house_values[k] = _start_round(blackjack, wagers)
+        active = pending
+        if not active:
+            break
+
+        policies = np.array(
+            [games[k].players[seats[k]].get_valid_moves_mask() for k in active]
+        )
+        observations = encoder.encode_games(
+            [games[k] for k in active],
+            [seats[k] for k in active],
+            [house_values[k] for k in active],
+            masks=policies,
+            out=buffer,
+        )
+        actions, _ = select_actions(model, "argmax", policies, observations)
+        for k, action in zip(active, actions):
+            # argmax is deterministic
+            games[k].step_player(seats[k], model.moves[action], 1.0)
+
+    return rewards
+
+
+def play_games_lockstep(
+    model: Net,
+    n_games: int,
+    n_rounds: int,
+    wagers: List[float],
+    include_count: Union[bool, ObservationEncoder],
+    game_hyperparams: object,
+) -> np.ndarray:
+    """run_games_lockstep() on n_games fresh Games. Module level for process pools."""
+    model.eval()
+    games = [Game(**game_hyperparams) for _ in range(n_games)]
+    return run_games_lockstep(games, model, n_rounds, wagers, include_count)
+
+
 async def play_games(
     model: Net,
     n_games: int,
     n_rounds: int,
     wagers: List[float],
-    include_count: bool,
+    include_count: Union[bool, ObservationEncoder],
     game_hyperparams: object,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    lockstep: bool = False,
+    batch_size: int = 64,
 ):
+    """
+    returns rewards as an (n_games x n_players x n_rounds) array.
+    Games are dispatched with src.utils.executor.
+    include_count : or an ObservationEncoder, for other observation features.
+    lockstep : games are split into batches of at most batch_size, each played with
+        run_games_lockstep() (batching the forward passes) as a task. Batches only
+        depend on n_games and batch_size, so results are reproducible for a seed
+        whatever the executor or number of workers.
+    """
     # Will use the optimal move to carry out gameplay
     model.eval()
-    tasks = []
-    for _ in range(n_games):
-        blackjack = Game(**game_hyperparams)
-        tasks.append(
-            asyncio.create_task(
-                play_rounds(
-                    blackjack=blackjack,
-                    model=model,
-                    n_rounds=n_rounds,
-                    wagers=wagers,
-                    include_count=include_count,
-                )
-            )
+    if lockstep:
+        assert batch_size > 0, "invalid batch_size"
+        n_batches = -(-n_games // batch_size)
+        sizes = [len(b) for b in np.array_split(np.arange(n_games), n_batches)]
+        rewards = await run_tasks(
+            play_games_lockstep,
+            [
+                (model, size, n_rounds, wagers, include_count, game_hyperparams)
+                for size in sizes
+                if size
+            ],
+            executor=executor,
+            n_workers=n_workers,
+            seed=seed,
         )
+        return np.concatenate(rewards)
 
-    rewards = await asyncio.gather(*tasks)
+    rewards = await run_tasks(
+        play_game,
+        [(model, n_rounds, wagers, include_count, game_hyperparams)] * n_games,
+        executor=executor,
+        n_workers=n_workers,
+        seed=seed,
+    )
 
     return np.array(rewards)
+
+
+def play_game_stats(
+    model: Net,
+    wagers: List[float],
+    include_count: Union[bool, ObservationEncoder],
+    game_hyperparams: object,
+    bins: Optional[np.ndarray],
+    n_rounds: int,
+) -> Welford:
+    """same as play_game(), but only returns the Welford accumulator of the rewards"""
+    stats = Welford(n_players=len(wagers), bins=bins)
+    stats.update_batch(
+        play_game(model, n_rounds, wagers, include_count, game_hyperparams).T
+    )
+    return stats
+
+
+async def evaluate_streaming(
+    model: Net,
+    wagers: List[float],
+    include_count: Union[bool, ObservationEncoder],
+    game_hyperparams: object,
+    half_width: Optional[float] = None,
+    confidence: float = 0.95,
+    time_budget: Optional[float] = None,
+    max_rounds: int = 1_000_000,
+    chunk_rounds: int = 1_000,
+    bins: Optional[np.ndarray] = None,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> EvalSummary:
+    """
+    Plays games of chunk_rounds until the mean reward per round of every player is
+    known to +/- half_width (at confidence), time_budget seconds have passed, or
+    max_rounds are played. See src.utils.stats.run_until_precise.
+    """
+    model.eval()
+    return await run_until_precise(
+        play_game_stats,
+        (model, wagers, include_count, game_hyperparams, bins),
+        n_players=len(wagers),
+        chunk_rounds=chunk_rounds,
+        half_width=half_width,
+        confidence=confidence,
+        time_budget=time_budget,
+        max_rounds=max_rounds,
+        bins=bins,
+        executor=executor,
+        n_workers=n_workers,
+        seed=seed,
+    )
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, List, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import numpy as np
 import torch
 
+from src.modules.actions import moves_to_mask
+from src.modules.observation import ObservationEncoder
+
 if TYPE_CHECKING:
     # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
     from src.deep_learning.modules import Net
@@ -21,16 +24,41 @@ def gen_all_states():
 
 
 def get_masked_output_space(
-        model: Net, data: List[Tuple], action_space: List[List[str]]):
-
-    data_t = torch.tensor(data, dtype=torch.float32)
+        model: Net,
+        data: List[Tuple],
+        action_space: List[str],
+        encoder: Optional[ObservationEncoder] = None,
+        true_count: float = 0.0):
+    """
+    q values of every (player_total, house_value, useable_ace) state of data, with
+    the moves outside of action_space masked.
+    encoder : encoding of the model's observations, defaults to the runners' one
+    (with the true count, at true_count, if the model has 4 inputs).
+    """
+    if encoder is None:
+        encoder = ObservationEncoder(include_count=model.input_dim == 4)
+    states = np.array(data, dtype=np.float32).reshape(-1, 3)
+    data_t = torch.from_numpy(
+        encoder.encode_arrays(
+            states[:, 0],
+            states[:, 1],
+            states[:, 2],
+            mask=moves_to_mask(action_space),
+            true_count=true_count,
+        )
+    )
     actions = [action_space]*len(data)
     q_masked, _, _ = model.act(data_t, method="argmax", avail_actions=actions)
 
     return q_masked
 
 
-def fill_value_grid(model: Net, states: List[Tuple], hand_type: str):
+def fill_value_grid(
+        model: Net,
+        states: List[Tuple],
+        hand_type: str,
+        encoder: Optional[ObservationEncoder] = None,
+        true_count: float = 0.0):
 
     if hand_type == "hard":
         fill = np.full((16, 10), np.nan)
@@ -45,7 +73,9 @@ def fill_value_grid(model: Net, states: List[Tuple], hand_type: str):
     q_masked = get_masked_output_space(
         model=model,
         data=states,
-        action_space=policy
+        action_space=policy,
+        encoder=encoder,
+        true_count=true_count,
     )
 
     for i, q in enumerate(q_masked):
@@ -63,7 +93,12 @@ def fill_value_grid(model: Net, states: List[Tuple], hand_type: str):
     return fill
 
 
-def fill_string_grid(model: Net, states: List[Tuple], hand_type: str):
+def fill_string_grid(
+        model: Net,
+        states: List[Tuple],
+        hand_type: str,
+        encoder: Optional[ObservationEncoder] = None,
+        true_count: float = 0.0):
     if hand_type == "hard":
         fill = np.empty((16, 10), dtype="O")
         policy = ["hit", "stay", "double", "surrender"]
@@ -77,7 +112,17 @@ def fill_string_grid(model: Net, states: List[Tuple], hand_type: str):
     q_masked = get_masked_output_space(
         model=model,
         data=states,
-        action_space=policy
+        action_space=policy,
+        encoder=encoder,
+        true_count=true_count,
+    )
+    # best move once more than 2 cards are held, for double / surrender
+    q_fallback = get_masked_output_space(
+        model=model,
+        data=states,
+        action_space=["stay", "hit"],
+        encoder=encoder,
+        true_count=true_count,
     )
 
     for i, q in enumerate(q_masked):
@@ -95,11 +140,7 @@ def fill_string_grid(model: Net, states: List[Tuple], hand_type: str):
         max_ind2 = None
         max_val2 = ""
         if (model.moves[max_ind1] in ["double", "surrender"]) and (not can_split):
-            _, _, next_best = model.act(
-                obs=torch.tensor(states[i], dtype=torch.float32),
-                avail_actions=[["stay", "hit"]]
-            )
-            max_ind2 = next_best[0].item()
+            max_ind2 = torch.argmax(q_fallback[i]).item()
 
         if model.moves[max_ind1] in ["surrender", "split"]:
             str_fill = model.moves[max_ind1][:2].title()
@@ -117,12 +158,17 @@ def fill_string_grid(model: Net, states: List[Tuple], hand_type: str):
     return fill
 
 
-def generate_grid(model: Net, return_type: str = "string"):
+def generate_grid(
+        model: Net,
+        return_type: str = "string",
+        encoder: Optional[ObservationEncoder] = None,
+        true_count: float = 0.0):
     """
     generates the grids for:
     - hard totals (will include all actions except split)
     - soft totals (will include all actions except split)
     - ability to split (will include all actions)
+    encoder / true_count : see get_masked_output_space()
     """
     assert return_type in ["string", "value"], "invalid return_type given."
 
@@ -145,33 +191,45 @@ def generate_grid(model: Net, return_type: str = "string"):
         hard_totals = fill_value_grid(
             model=model,
             states=hard_states,
-            hand_type="hard"
+            hand_type="hard",
+            encoder=encoder,
+            true_count=true_count,
         )
         soft_totals = fill_value_grid(
             model=model,
             states=soft_states,
-            hand_type="soft"
+            hand_type="soft",
+            encoder=encoder,
+            true_count=true_count,
         )
         split_totals = fill_value_grid(
             model=model,
             states=split_states,
-            hand_type="split"
+            hand_type="split",
+            encoder=encoder,
+            true_count=true_count,
         )
     else:
         hard_totals = fill_string_grid(
             model=model,
             states=hard_states,
-            hand_type="hard"
+            hand_type="hard",
+            encoder=encoder,
+            true_count=true_count,
         )
         soft_totals = fill_string_grid(
             model=model,
             states=soft_states,
-            hand_type="soft"
+            hand_type="soft",
+            encoder=encoder,
+            true_count=true_count,
         )
         split_totals = fill_string_grid(
             model=model,
             states=split_states,
-            hand_type="split"
+            hand_type="split",
+            encoder=encoder,
+            true_count=true_count,
         )
 
     return hard_totals, soft_totals, split_totals
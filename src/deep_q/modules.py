@@ -6,7 +6,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from src.deep_q.helpers import play_games
+from src.deep_q.helpers import ENCODER, play_games
+from src.modules.actions import invalid_move_table, moves_to_mask
 
 
 class Net(nn.Module):
@@ -30,11 +31,18 @@ class Net(nn.Module):
 
         self.fc_output = nn.Linear(self.hidden_layers[-1], self.output_dim)
 
-    def mask(self, valid_moves):
-        def to_mask(moves):
-            return [1 if (move in moves) else torch.nan for move in self.moves]
+        # (32, output_dim), True where a move is invalid, indexed by a valid move
+        # bitmask. Not persistent, so state_dicts are unchanged.
+        self.register_buffer(
+            "invalid_table",
+            torch.from_numpy(invalid_move_table(self.moves)),
+            persistent=False,
+        )
 
-        return torch.tensor(list(map(to_mask, valid_moves)))
+    def mask(self, valid_moves):
+        """True where a move is invalid, as rows of invalid_table"""
+        masks_t = torch.tensor([moves_to_mask(moves) for moves in valid_moves])
+        return self.invalid_table[masks_t]
 
     def forward(self, data):
         x_t = F.relu(self.fc_input(data))
@@ -56,14 +64,13 @@ class Net(nn.Module):
 
         assert method in ["argmax", "softmax"], "must use a valid method"
 
-        with torch.no_grad():
+        with torch.inference_mode():
             q_values_t = self.forward(obs)
 
             q_avail_t = q_values_t
 
             if avail_actions:
-                mask_t = self.mask(avail_actions)
-                q_avail_t = torch.nan_to_num(q_avail_t * mask_t, nan=-torch.inf)
+                q_avail_t = q_avail_t.masked_fill(self.mask(avail_actions), -torch.inf)
 
             if method == "argmax":
                 actions_t = torch.argmax(q_avail_t, dim=1, keepdim=True).detach()
@@ -131,8 +138,8 @@ class Trainer(EarlyStop):
 
         transition_inds = np.random.choice(len(replay_buffer), batch_size, replace=True)
 
-        obs_t = torch.tensor(
-            [replay_buffer[i][0] for i in transition_inds], dtype=torch.float32
+        obs_t = torch.from_numpy(
+            np.stack([replay_buffer[i][0] for i in transition_inds])
         )
         # a_s = [replay_buffer[i][1] for i in transition_inds]
         moves_t = torch.tensor(
@@ -145,9 +152,15 @@ class Trainer(EarlyStop):
         dones_t = torch.tensor(
             [replay_buffer[i][4] for i in transition_inds], dtype=torch.float32
         ).unsqueeze(-1)
-        obs_next_t = torch.tensor(
-            [replay_buffer[i][5] or (0, 0, 0, 0, 0) for i in transition_inds],
-            dtype=torch.float32,
+        # terminal transitions have no next observation, see helpers.ENCODER
+        obs_none = ENCODER.empty(1)[0]
+        obs_next_t = torch.from_numpy(
+            np.stack(
+                [
+                    obs_none if replay_buffer[i][5] is None else replay_buffer[i][5]
+                    for i in transition_inds
+                ]
+            )
         )
         a_s_next = [replay_buffer[i][6] or ["stay"] for i in transition_inds]
 
@@ -9,7 +9,9 @@ from typing import TYPE_CHECKING, List
 import numpy as np
 import torch
 
+from src.modules.actions import moves_to_mask
 from src.modules.game import Game
+from src.modules.observation import ObservationEncoder
 from src.pydantic_types import StateActionPairDeepCount
 
 if TYPE_CHECKING:
@@ -17,6 +19,9 @@ if TYPE_CHECKING:
     from src.deep_q_count.modules import Net
     from src.modules.player import Player
 
+# (player_total, house_show, useable_ace, can_split, can_double, true_count)
+ENCODER = ObservationEncoder(can_split=True, can_double=True, include_count=True)
+
 
 def update_replay_buffer(
     blackjack: Game,
@@ -41,14 +46,14 @@ def update_replay_buffer(
     if blackjack.house_blackjack:
         return
 
-    count = blackjack.get_count()
-    true_count = count * 52 / blackjack.cards.sum()
+    true_count = blackjack.true_count
 
     player = blackjack.players[0]
     player: type[Player]
 
     s_a = [[]]
     action_space = [[]]
+    observation = ENCODER.empty(1)
 
     house_show = blackjack.get_house_show(show_value=True)
 
@@ -68,29 +73,30 @@ def update_replay_buffer(
         can_double = "double" in policy
 
         # I figure that using [-1,1] could help the ReLu fct more than [0,1]
-        obs = (
+        ENCODER.write(
+            observation,
+            0,
             player_total,
             house_show,
-            2 * int(useable_ace) - 1,
-            2 * int(can_split) - 1,
-            2 * int(can_double) - 1,
-            true_count,
+            useable_ace,
+            mask=moves_to_mask(policy),
+            true_count=true_count,
         )
 
         if mode == "random":
             move = np.random.choice(model.moves)
         elif mode == "argmax":
-            obs_t = torch.tensor(obs, dtype=torch.float32).unsqueeze(0)
+            obs_t = torch.from_numpy(observation)
             _, _, action_ind = model.act(obs=obs_t, method="argmax")
             move = model.moves[action_ind[0][0].item()]
         else:
-            obs_t = torch.tensor(obs, dtype=torch.float32).unsqueeze(0)
+            obs_t = torch.from_numpy(observation)
             _, _, action_ind = model.act(obs=obs_t, method="softmax")
             move = model.moves[action_ind[0][0].item()]
 
         if move not in policy:
             # Can change the penalty as a hyperparameter of learning process.
-            buffer.append((obs, policy, move, -1.5, 1, None, None))
+            buffer.append((observation[0].copy(), policy, move, -1.5, 1, None, None))
             return
 
         s_a_pair = StateActionPairDeepCount(
@@ -111,25 +117,23 @@ def update_replay_buffer(
         blackjack.step_player(player, move)
 
         if continuous_count:
-            count = blackjack.get_count()
-            true_count = count * 52 / blackjack.cards.sum()
+            true_count = blackjack.true_count
 
     blackjack.step_house()
 
     _, reward_hands = player.get_result(blackjack.house.cards[0])
 
     s_a_pair: StateActionPairDeepCount
-    look_forward: StateActionPairDeepCount
     for i, s_a_pair_hand in enumerate(s_a):
+        hand_obs = ENCODER.encode_arrays(
+            [p.player_show for p in s_a_pair_hand],
+            [p.house_show for p in s_a_pair_hand],
+            [p.useable_ace for p in s_a_pair_hand],
+            mask=[moves_to_mask(a_s) for a_s in action_space[i]],
+            true_count=[p.count for p in s_a_pair_hand],
+        )
         for j, s_a_pair in enumerate(s_a_pair_hand):
-            state_obs = (
-                s_a_pair.player_show,
-                s_a_pair.house_show,
-                2 * int(s_a_pair.useable_ace) - 1,
-                2 * int(s_a_pair.can_split) - 1,
-                2 * int(s_a_pair.can_double) - 1,
-                s_a_pair.count,
-            )
+            state_obs = hand_obs[j]
             move = s_a_pair.move
             # reward = 0.25*int(s_a_pair.move in ["hit", "split"])
             reward = 0
@@ -143,15 +147,7 @@ def update_replay_buffer(
                 done = 1
                 a_s_new = None
             else:
-                look_forward = s_a_pair_hand[j + 1]
-                state_obs_new = (
-                    look_forward.player_show,
-                    look_forward.house_show,
-                    2 * int(look_forward.useable_ace) - 1,
-                    2 * int(look_forward.can_split) - 1,
-                    2 * int(look_forward.can_double) - 1,
-                    look_forward.count,
-                )
+                state_obs_new = hand_obs[j + 1]
                 a_s_new = action_space[i][j + 1]
 
             buffer.append((state_obs, a_s, move, reward, done, state_obs_new, a_s_new))
@@ -168,11 +164,12 @@ def play_round(
     blackjack.init_round(wagers)
     blackjack.deal_init()
 
-    count = blackjack.get_count()
-    true_count = count * 52 / blackjack.cards.sum()
+    true_count = blackjack.true_count
 
     house_show = blackjack.get_house_show(show_value=True)
 
+    observation = ENCODER.empty(1)
+
     for player in blackjack.players:
         player: type[Player]
         while not player.is_done():
@@ -181,19 +178,17 @@ def play_round(
             policy = player.get_valid_moves()
             policy = [p for p in policy if p != "surrender"]
 
-            can_split = "split" in policy
-            can_double = "double" in policy
-
-            obs = (
+            ENCODER.write(
+                observation,
+                0,
                 player_total,
                 house_show,
-                2 * int(useable_ace) - 1,
-                2 * int(can_split) - 1,
-                2 * int(can_double) - 1,
-                true_count,
+                useable_ace,
+                mask=moves_to_mask(policy),
+                true_count=true_count,
             )
 
-            obs_t = torch.tensor(obs, dtype=torch.float32).unsqueeze(0)
+            obs_t = torch.from_numpy(observation)
             _, _, action_ind = model.act(obs=obs_t, method="argmax")
             move = model.moves[action_ind[0][0].item()]
             if move not in policy:
@@ -202,8 +197,7 @@ def play_round(
             blackjack.step_player(player, move)
 
             if continuous_count:
-                count = blackjack.get_count()
-                true_count = count * 52 / blackjack.cards.sum()
+                true_count = blackjack.true_count
 
     blackjack.step_house()
     _, players_winnings = blackjack.get_results()
@@ -271,11 +265,12 @@ def play_round_gather_count(
     blackjack.init_round(wagers)
     blackjack.deal_init()
 
-    count = blackjack.get_count()
-    true_count = count * 52 / blackjack.cards.sum()
+    true_count = blackjack.true_count
 
     house_show = blackjack.get_house_show(show_value=True)
 
+    observation = ENCODER.empty(1)
+
     for player in blackjack.players:
         player: type[Player]
         while not player.is_done():
@@ -284,31 +279,28 @@ def play_round_gather_count(
             policy = player.get_valid_moves()
             policy = [p for p in policy if p != "surrender"]
 
-            can_split = "split" in policy
-            can_double = "double" in policy
-
-            obs = (
+            ENCODER.write(
+                observation,
+                0,
                 player_total,
                 house_show,
-                2 * int(useable_ace) - 1,
-                2 * int(can_split) - 1,
-                2 * int(can_double) - 1,
-                true_count,
+                useable_ace,
+                mask=moves_to_mask(policy),
+                true_count=true_count,
             )
 
-            obs_t = torch.tensor(obs, dtype=torch.float32).unsqueeze(0)
+            obs_t = torch.from_numpy(observation)
             _, _, action_ind = model.act(obs=obs_t, method="argmax")
             move = model.moves[action_ind[0][0].item()]
 
             if move not in policy:
-                print(obs, move, policy)
+                print(observation[0], move, policy)
                 return None, None
 
             blackjack.step_player(player, move)
 
             if continuous_count:
-                count = blackjack.get_count()
-                true_count = count * 52 / blackjack.cards.sum()
+                true_count = blackjack.true_count
 
     blackjack.step_house()
     _, players_winnings = blackjack.get_results()
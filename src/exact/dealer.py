@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    # if type_checking, import the modules for type hinting. Otherwise we get cyclical import errors. # noqa: E501
+    from src.modules.game import Game
+
+"""
+Exact distribution of the house's final total.
+
+Shoe compositions are tuples of 10 counts, indexed by card value - 1
+(Ace first, all ten valued cards last). A composition of None means an
+infinite deck, where each draw is independent of the cards already seen.
+
+The house plays out recursively over the cards it can draw. Results are
+memoized with a bounded LRU cache keyed on (house hand, composition), so repeated
+lookups (same upcard, same shoe) are essentially free.
+
+Every new composition would need a fresh recursion though, which gets slow when
+sweeping over many of them (ie solving player hands). So for finite shoes, the
+recursion is only done once per upcard to list every multiset of cards the house
+can draw, along with how many orderings of it are valid and the outcome it leads to.
+The probability of any ordering of a multiset only depends on the composition:
+    prod_v n_v (n_v - 1) ... (n_v - d_v + 1) / N (N - 1) ... (N - k + 1)
+so distributions for a whole batch of compositions are a couple of matmuls
+over that table (see dealer_distributions()).
+
+Outcomes:
+    "17" ... "21" : house stands on that total (21 excludes blackjack)
+    "bust" : house busts (any total > 21)
+    "22" : house busts on exactly 22, already included in "bust". Needed for push_dealer22.
+    "blackjack" : house has a natural
+# noqa: E501
+"""
+
+OUTCOMES = ["17", "18", "19", "20", "21", "22", "bust", "blackjack"]
+
+INFINITE_PROBS = tuple([1 / 13] * 9 + [4 / 13])
+
+CACHE_SIZE = 2**16
+
+
+def shoe_counts(n_decks: int) -> Tuple[int, ...]:
+    """composition of a full shoe of n_decks"""
+    return tuple([4 * n_decks] * 9 + [16 * n_decks])
+
+
+def remove_cards(counts: Sequence[int], values: Iterable[int]) -> Tuple[int, ...]:
+    """removes cards (by value, Ace == 1 or 11) from a composition"""
+    counts = list(counts)
+    for value in values:
+        ind = (1 if value == 11 else value) - 1
+        assert counts[ind] > 0, "card isn't in the shoe"
+        counts[ind] -= 1
+    return tuple(counts)
+
+
+def unseen_counts(game: Game) -> Tuple[int, ...]:
+    """
+    composition of the cards a player hasn't seen: what's left in the shoe, plus
+    the house hole card while it's still face down.
+    """
+    values = [card.value for card in game.shoe.cards]
+    if game.hole_card is not None:
+        values.append(game.hole_card.value)
+    counts = np.bincount(np.array(values, dtype=np.int64), minlength=11)[1:]
+    return tuple(int(c) for c in counts)
+
+
+def _draw_probs(counts: Optional[Tuple[int, ...]]):
+    """yields (value, probability, composition after the draw)"""
+    if counts is None:
+        for i, p in enumerate(INFINITE_PROBS):
+            yield i + 1, p, None
+        return
+    n = sum(counts)
+    if not n:
+        raise Exception("no cards in the deck")
+    for i, c in enumerate(counts):
+        if c:
+            yield i + 1, c / n, counts[:i] + (c - 1,) + counts[i + 1:]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _play_house(
+    hard: int,
+    has_ace: bool,
+    counts: Optional[Tuple[int, ...]],
+    hit_soft17: bool,
+) -> Tuple[float, ...]:
+    """
+    probabilities of (17, 18, 19, 20, 21, 22, 23+) from a house hand that
+    can't be a blackjack anymore.
+    """
+    soft = has_ace and (hard <= 11)
+    total = hard + 10 if soft else hard
+
+    probs = [0.0] * 7
+    if total > 21:
+        probs[5 if total == 22 else 6] = 1.0
+        return tuple(probs)
+    if (total > 17) or ((total == 17) and not (soft and hit_soft17)):
+        probs[total - 17] = 1.0
+        return tuple(probs)
+
+    for value, p, counts_next in _draw_probs(counts):
+        res = _play_house(
+            hard + value, has_ace or (value == 1), counts_next, hit_soft17
+        )
+        for i in range(7):
+            probs[i] += p * res[i]
+    return tuple(probs)
+
+
+@lru_cache(maxsize=None)
+def _house_draws(upcard: int, hit_soft17: bool) -> Tuple[np.ndarray, ...]:
+    """
+    every multiset of cards the house can draw (hole card included) for an upcard.
+
+    returns:
+        - (10 * width, n) indicator of the multisets, row v * width + d is set
+            when d cards of value v + 1 are drawn
+        - (n,) number of cards drawn
+        - (n, len(OUTCOMES)) valid orderings of each multiset, in its outcome column
+    """
+    table: Dict[Tuple[Tuple[int, ...], int], int] = {}
+
+    def _draw(hard: int, has_ace: bool, drawn: Tuple[int, ...]) -> None:
+        for value in range(1, 11):
+            drawn_next = drawn[:value - 1] + (drawn[value - 1] + 1,) + drawn[value:]
+            if not any(drawn) and ({upcard, value} == {1, 10}):
+                key = (drawn_next, len(OUTCOMES) - 1)
+                table[key] = table.get(key, 0) + 1
+                continue
+
+            hard_next = hard + value
+            has_ace_next = has_ace or (value == 1)
+            soft = has_ace_next and (hard_next <= 11)
+            total = hard_next + 10 if soft else hard_next
+            if total > 21:
+                outcome = 5 if total == 22 else 6
+            elif (total > 17) or ((total == 17) and not (soft and hit_soft17)):
+                outcome = total - 17
+            else:
+                _draw(hard_next, has_ace_next, drawn_next)
+                continue
+            key = (drawn_next, outcome)
+            table[key] = table.get(key, 0) + 1
+
+    _draw(upcard, upcard == 1, (0,) * 10)
+
+    drawn = np.array([k[0] for k in table], dtype=np.int64)
+    width = drawn.max() + 1
+    indicator = np.zeros((len(drawn), 10 * width))
+    np.put_along_axis(indicator, drawn + width * np.arange(10), 1.0, axis=1)
+
+    orderings = np.zeros((len(drawn), len(OUTCOMES)))
+    orderings[np.arange(len(drawn)), [k[1] for k in table]] = list(table.values())
+    return indicator.T.copy(), drawn.sum(axis=1), orderings
+
+
+def _log_falling(counts: np.ndarray, width: int) -> np.ndarray:
+    """
+    log of n (n - 1) ... (n - d + 1) for d in [0, width), along a new last axis.
+    Very negative (rather than -inf, to keep matmuls finite) once n runs out.
+    """
+    steps = counts[..., None] - np.arange(width - 1)
+    with np.errstate(divide="ignore"):
+        log_steps = np.log(np.maximum(steps, 0))
+    log_steps[np.isinf(log_steps)] = -1e6
+    zeros = np.zeros(counts.shape + (1,))
+    return np.concatenate([zeros, np.cumsum(log_steps, axis=-1)], axis=-1)
+
+
+def dealer_distributions(
+    upcard: int,
+    counts: np.ndarray,
+    hit_soft17: bool = False,
+    chunk_size: int = 512,
+) -> np.ndarray:
+    """
+    dealer_distribution() for many finite shoe compositions at once.
+
+    - counts : (m, 10) compositions, each already excluding the upcard.
+    returns (m, len(OUTCOMES)) probabilities, columns ordered like OUTCOMES.
+    """
+    upcard = 1 if upcard == 11 else upcard
+    indicator, n_drawn, orderings = _house_draws(upcard, hit_soft17)
+    width = indicator.shape[0] // 10
+
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    n = counts.sum(axis=1)
+    if not n.all():
+        raise Exception("no cards in the deck")
+
+    probs = np.zeros((len(counts), len(OUTCOMES)))
+    for i in range(0, len(counts), chunk_size):
+        chunk = slice(i, i + chunk_size)
+        # numerator, per value drawn, and the N (N - 1) ... shared denominator.
+        log_numerator = _log_falling(counts[chunk], width).reshape(-1, 10 * width)
+        log_denominator = _log_falling(n[chunk], n_drawn.max() + 1)[:, n_drawn]
+        log_p = log_numerator @ indicator - log_denominator
+        probs[chunk] = np.exp(log_p) @ orderings
+
+    # 22 is a subset of bust.
+    probs[:, 6] += probs[:, 5]
+    return probs
+
+
+def dealer_distribution(
+    upcard: int,
+    counts: Optional[Sequence[int]] = None,
+    hit_soft17: bool = False,
+) -> Dict[str, float]:
+    """
+    Exact distribution of the house's final total.
+
+    - upcard : value of the card the house shows (Ace as 1 or 11)
+    - counts : composition of the shoe the hole card + hits are drawn from,
+        so it should already exclude the upcard (and any other seen cards).
+        None for an infinite deck.
+    - hit_soft17 : RulesI.dealer_hit_soft17
+    """
+    upcard = 1 if upcard == 11 else upcard
+    counts = None if counts is None else tuple(counts)
+
+    probs = np.zeros(len(OUTCOMES))
+    if counts is not None:
+        probs = dealer_distributions(upcard, np.array([counts]), hit_soft17)[0]
+        return dict(zip(OUTCOMES, probs.tolist()))
+
+    for value, p, counts_next in _draw_probs(counts):
+        if {upcard, value} == {1, 10}:
+            probs[-1] += p
+            continue
+        res = _play_house(
+            upcard + value, (upcard == 1) or (value == 1), counts_next, hit_soft17
+        )
+        probs[:6] += p * np.array(res[:6])
+        probs[6] += p * (res[5] + res[6])
+
+    return dict(zip(OUTCOMES, probs.tolist()))
+
+
+def dealer_table(
+    counts: Optional[Sequence[int]] = None, hit_soft17: bool = False
+) -> np.ndarray:
+    """
+    (10, len(OUTCOMES)) table of dealer_distribution() for house shows 2 -> 11,
+    the upcard is removed from counts for each row.
+    """
+    table = np.zeros((10, len(OUTCOMES)))
+    for i, upcard in enumerate(range(2, 12)):
+        counts_up = None if counts is None else remove_cards(counts, [upcard])
+        res = dealer_distribution(upcard, counts_up, hit_soft17)
+        table[i] = [res[k] for k in OUTCOMES]
+    return table
+
+
+def cache_clear() -> None:
+    _play_house.cache_clear()
+    _house_draws.cache_clear()
@@ -0,0 +1,258 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from src.exact.dealer import (INFINITE_PROBS, dealer_distribution, remove_cards,
+                              shoe_counts)
+from src.modules.actions import MOVE_BITS, valid_move_table
+from src.pydantic_types import RulesI
+
+"""
+Exact expected return (and variance) per round of a greedy Q table policy.
+
+Follows the same gameplay as Game + play_round(): the policy picks the best valid
+move for the (player_total, house_value, useable_ace) state, sampling uniformly
+between ties, with valid moves taken from actions.valid_move_table().
+
+Player draws are independent (infinite deck, or shrink_deck=False). Once the house's
+final total is fixed, every hand of the player is then independent of each other,
+so moments are computed conditioned on each house outcome and mixed afterwards.
+This also makes resplits tractable. A hand started from a split card (X) either
+splits again (with probability S) into 2 independent copies of X, or doesn't (A):
+    E[X] = A1 / (1 - 2S)
+    E[X^2] = (A2 + 2S E[X]^2) / (1 - 2S)
+where A1, A2 are the contributions of the moves other than split.
+# noqa: E501
+"""
+
+Moments = Tuple[float, float]
+
+# house outcomes, conditioned on no blackjack: 17, 18, 19, 20, 21, 22, 23+
+HOUSE_TOTALS = [17, 18, 19, 20, 21, 22, 23]
+
+
+def _total(hard: int, ace: bool) -> Tuple[int, bool]:
+    soft = ace and (hard <= 11)
+    return (hard + 10 if soft else hard), soft
+
+
+class _HandEvaluator:
+    """moments of a player's winnings against a fixed house total"""
+
+    def __init__(
+        self, q: dict, rules: RulesI, table: np.ndarray, house_value: int, house: int
+    ):
+        self.q = q
+        self.rules = rules
+        self.table = table
+        self.house_value = house_value
+        self.house = house
+        self.memo: Dict[tuple, tuple] = {}
+
+    def _pay(self, total: int) -> float:
+        if total > 21:
+            return -1.0
+        if self.house > 21:
+            if self.rules.push_dealer22 and (self.house == 22):
+                return 0.0
+            return 1.0
+        return float(np.sign(total - self.house))
+
+    def _policy(self, total: int, soft: bool, mask: int) -> Dict[str, float]:
+        """probability of each move, greedy with uniform ties (select_action)"""
+        q_dict = {
+            k: v
+            for k, v in self.q[(total, self.house_value, soft)].items()
+            if mask & MOVE_BITS[k]
+        }
+        if not q_dict:
+            raise Exception("no valid moves for the policy")
+        best = max(q_dict.values())
+        best_moves = [k for k, v in q_dict.items() if v == best]
+        return {k: 1 / len(best_moves) for k in best_moves}
+
+    def _stand(self, total: int) -> Moments:
+        pay = self._pay(total)
+        return pay, pay**2
+
+    def _double(self, hard: int, ace: bool) -> Moments:
+        m1 = 0.0
+        m2 = 0.0
+        for i, p in enumerate(INFINITE_PROBS):
+            pay = 2 * self._pay(_total(hard + i + 1, ace or (i == 0))[0])
+            m1 += p * pay
+            m2 += p * pay**2
+        return m1, m2
+
+    def _hit(self, hard: int, ace: bool, multi_hand: bool) -> Moments:
+        """draw a card, then keep playing the (now 3+ card) hand"""
+        m1 = 0.0
+        m2 = 0.0
+        for i, p in enumerate(INFINITE_PROBS):
+            hard_next = hard + i + 1
+            ace_next = ace or (i == 0)
+            total, _ = _total(hard_next, ace_next)
+            if total >= 21:
+                res = self._stand(total)
+            else:
+                res, _ = self.decide(hard_next, ace_next, False, 0, multi_hand, False)
+            m1 += p * res[0]
+            m2 += p * res[1]
+        return m1, m2
+
+    def decide(
+        self,
+        hard: int,
+        ace: bool,
+        two_cards: bool,
+        pair: int,
+        multi_hand: bool,
+        aces_split: bool,
+    ) -> Tuple[Moments, float]:
+        """
+        moments of the moves other than split (weighted by the policy), and the
+        probability that the policy splits.
+        """
+        key = (hard, ace, two_cards, pair, multi_hand, aces_split)
+        if key in self.memo:
+            return self.memo[key]
+
+        total, soft = _total(hard, ace)
+        mask = int(
+            self.table[
+                int(two_cards),
+                pair,
+                int(multi_hand),
+                int(aces_split),
+                0 if total < 21 else (1 if total == 21 else 2),
+            ]
+        )
+
+        m1 = 0.0
+        m2 = 0.0
+        p_split = 0.0
+        for move, p in self._policy(total, soft, mask).items():
+            if move == "split":
+                p_split += p
+                continue
+            if move == "stay":
+                res = self._stand(total)
+            elif move == "hit":
+                res = self._hit(hard, ace, multi_hand)
+            elif move == "double":
+                res = self._double(hard, ace)
+            else:
+                res = (-0.5, 0.25)
+            m1 += p * res[0]
+            m2 += p * res[1]
+
+        self.memo[key] = ((m1, m2), p_split)
+        return self.memo[key]
+
+    def split(self, i_card: int) -> Moments:
+        """moments of the sum of both hands, splitting a pair of value i_card + 1"""
+        key = ("split", i_card)
+        if key in self.memo:
+            return self.memo[key]
+
+        aces_split = i_card == 0
+        a1 = 0.0
+        a2 = 0.0
+        s = 0.0
+        for i, p in enumerate(INFINITE_PROBS):
+            hard = i_card + i + 2
+            ace = aces_split or (i == 0)
+            total, _ = _total(hard, ace)
+            if i != i_card:
+                pairs = [(0, 1.0)]
+            elif i == 9:
+                # any 2 ten valued cards, only 1 / 4 of which are the same card.
+                pairs = [(1, 0.25), (2, 0.75)]
+            else:
+                pairs = [(1, 1.0)]
+
+            for pair, p_pair in pairs:
+                if (total == 21) or (
+                    aces_split and (not pair) and (not self.rules.hit_after_split_aces)
+                ):
+                    res, p_split = self._stand(total), 0.0
+                else:
+                    res, p_split = self.decide(
+                        hard, ace, True, pair, True, aces_split
+                    )
+                a1 += p * p_pair * res[0]
+                a2 += p * p_pair * res[1]
+                s += p * p_pair * p_split
+
+        m1 = a1 / (1 - 2 * s)
+        m2 = (a2 + 2 * s * m1**2) / (1 - 2 * s)
+        self.memo[key] = (2 * m1, 2 * m2 + 2 * m1**2)
+        return self.memo[key]
+
+
+def evaluate_policy_exact(
+    q: dict, rules: RulesI = {}, n_decks: Optional[int] = None
+) -> Tuple[float, float]:
+    """
+    Exact expected return and variance per round (wager of 1) of playing q greedily.
+
+    - q : Q table in the init_q() format
+    - rules : RulesI (or dict of rules)
+    - n_decks : if passed, the house's outcome accounts for its upcard being
+        removed from a fresh shoe of n_decks. Player draws are always independent.
+    """
+    if not isinstance(rules, RulesI):
+        rules = RulesI(**rules)
+    table = valid_move_table(rules)
+    blackjack_payout = 1.2 if rules.reduced_blackjack_payout else 1.5
+
+    p_natural = 2 * INFINITE_PROBS[0] * INFINITE_PROBS[9]
+
+    m1 = 0.0
+    m2 = 0.0
+    for i_house, p_house in enumerate(INFINITE_PROBS):
+        house_value = 11 if i_house == 0 else i_house + 1
+        counts = None
+        if n_decks is not None:
+            counts = remove_cards(shoe_counts(n_decks), [house_value])
+        dist = dealer_distribution(house_value, counts, rules.dealer_hit_soft17)
+        p_blackjack = dist["blackjack"]
+        p_totals = np.array(
+            [dist[str(t)] for t in range(17, 23)] + [dist["bust"] - dist["22"]]
+        ) / (1 - p_blackjack)
+
+        # house blackjack ends the round before the player moves.
+        m1 += p_house * p_blackjack * -(1 - p_natural)
+        m2 += p_house * p_blackjack * (1 - p_natural)
+
+        m1_round = p_natural * blackjack_payout
+        m2_round = p_natural * blackjack_payout**2
+        for house, p_total in zip(HOUSE_TOTALS, p_totals):
+            evaluator = _HandEvaluator(q, rules, table, house_value, house)
+            for i, p_i in enumerate(INFINITE_PROBS):
+                for j, p_j in enumerate(INFINITE_PROBS):
+                    if {i, j} == {0, 9}:
+                        continue
+                    if i != j:
+                        pairs = [(0, 1.0)]
+                    elif i == 9:
+                        pairs = [(1, 0.25), (2, 0.75)]
+                    else:
+                        pairs = [(1, 1.0)]
+
+                    for pair, p_pair in pairs:
+                        p = p_total * p_i * p_j * p_pair
+                        (h1, h2), p_split = evaluator.decide(
+                            i + j + 2, (i == 0) or (j == 0), True, pair, False, False
+                        )
+                        if p_split:
+                            s1, s2 = evaluator.split(i)
+                            h1 += p_split * s1
+                            h2 += p_split * s2
+                        m1_round += p * h1
+                        m2_round += p * h2
+
+        m1 += p_house * (1 - p_blackjack) * m1_round
+        m2 += p_house * (1 - p_blackjack) * m2_round
+
+    return m1, m2 - m1**2
@@ -0,0 +1,310 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.exact.dealer import (INFINITE_PROBS, OUTCOMES, dealer_distribution,
+                              dealer_distributions, remove_cards, shoe_counts)
+from src.pydantic_types import RulesI
+from src.q.utils.plotting import generate_grid
+
+"""
+Exact EV of every move, for every (player_total, house_value, useable_ace) state.
+
+For each house show, the EV of stay / hit / double / surrender is computed by
+recursing over the player's hand composition (counts of each card value), with
+the cards in the hand removed from the shoe for both the player's draws and the
+house's outcome. Everything is conditioned on the house not having blackjack,
+as Game ends the round before any decision in that case.
+
+The Q table is keyed like init_q(), which doesn't know the composition of a hand,
+so each state holds the EV averaged over the 2 card hands that make up that state
+(weighted by how likely they are dealt). Split uses the pair that makes up the state.
+
+Approximations:
+    - a split hand is not resplit. Hands are played out with stay / hit / double
+      (if double_after_split), and the second hand is valued like the first.
+      Split aces that draw an ace stay on soft 12 when hit_after_split_aces is False.
+    - the player's draws are not conditioned on the hole card (standard practice).
+# noqa: E501
+"""
+
+Hand = Tuple[int, ...]
+
+
+class _Solver:
+    def __init__(self, rules: RulesI, counts: Optional[Tuple[int, ...]], upcard: int):
+        self.rules = rules
+        self.upcard = upcard
+        self.shoe = None if counts is None else remove_cards(counts, [upcard])
+        self.memo_stand: Dict[tuple, float] = {}
+        self.memo_hit: Dict[tuple, float] = {}
+        self.memo_split_hand: Dict[tuple, float] = {}
+
+        # the house's outcome only depends on which cards the player took out of
+        # the shoe, so it's computed up front for every hand that can be reached.
+        if self.shoe is None:
+            self.dealer = {None: self._dist_row(dealer_distribution(
+                upcard, None, rules.dealer_hit_soft17
+            ))}
+        else:
+            removals = self._reachable()
+            dists = dealer_distributions(
+                upcard,
+                np.array(self.shoe) - np.array(removals),
+                rules.dealer_hit_soft17,
+            )
+            self.dealer = dict(zip(removals, dists))
+
+    @staticmethod
+    def _dist_row(dist: Dict[str, float]) -> np.ndarray:
+        return np.array([dist[k] for k in OUTCOMES])
+
+    def _reachable(self) -> List[Hand]:
+        """
+        compositions of every hand with a hard total <= 21, plus the same hands
+        with an extra card removed when they could come from splitting it.
+        """
+        hands: List[Hand] = []
+
+        def _build(hand: Hand, hard: int, i_min: int) -> None:
+            for i in range(i_min, 10):
+                if hard + i + 1 > 21:
+                    break
+                if hand[i] >= self.shoe[i]:
+                    continue
+                hand_next = self._add(hand, i)
+                hands.append(hand_next)
+                _build(hand_next, hard + i + 1, i)
+
+        _build((0,) * 10, 0, 0)
+        splits = [
+            self._add(hand, i)
+            for hand in hands
+            for i in range(10)
+            if hand[i] and (hand[i] < self.shoe[i])
+        ]
+        return list(set(hands + splits))
+
+    def _removed(self, hand: Hand, removed: int) -> Hand:
+        """every card taken out of the shoe by the player"""
+        return hand if removed < 0 else self._add(hand, removed)
+
+    def _shoe(self, hand: Hand, removed: int) -> Optional[Tuple[int, ...]]:
+        if self.shoe is None:
+            return None
+        return tuple(c - h for c, h in zip(self.shoe, self._removed(hand, removed)))
+
+    def _draws(self, hand: Hand, removed: int):
+        """yields (value index, probability)"""
+        counts = self._shoe(hand, removed)
+        if counts is None:
+            yield from enumerate(INFINITE_PROBS)
+            return
+        n = sum(counts)
+        for i, c in enumerate(counts):
+            if c:
+                yield i, c / n
+
+    def _key(self, hand: Hand, removed: int) -> tuple:
+        # with an infinite deck, only the total matters, not the composition.
+        if self.shoe is None:
+            return (self._total(hand), self._soft(hand), removed == 0)
+        return (hand, removed)
+
+    @staticmethod
+    def _soft(hand: Hand) -> bool:
+        return bool(hand[0]) and (sum((i + 1) * c for i, c in enumerate(hand)) <= 11)
+
+    @staticmethod
+    def _total(hand: Hand) -> int:
+        hard = sum((i + 1) * c for i, c in enumerate(hand))
+        if hand[0] and (hard <= 11):
+            return hard + 10
+        return hard
+
+    @staticmethod
+    def _add(hand: Hand, i: int) -> Hand:
+        return hand[:i] + (hand[i] + 1,) + hand[i + 1:]
+
+    def stand(self, hand: Hand, removed: int = -1) -> float:
+        key = self._key(hand, removed)
+        if key in self.memo_stand:
+            return self.memo_stand[key]
+
+        total = self._total(hand)
+        if total > 21:
+            return -1.0
+        removed_cards = None if self.shoe is None else self._removed(hand, removed)
+        dist = dict(zip(OUTCOMES, self.dealer[removed_cards]))
+        no_blackjack = 1 - dist["blackjack"]
+
+        push = dist["22"] if self.rules.push_dealer22 else 0
+        win = dist["bust"] - push
+        lose = 0
+        for house in range(17, 22):
+            p = dist[str(house)]
+            if house < total:
+                win += p
+            elif house > total:
+                lose += p
+
+        ev = (win - lose) / no_blackjack
+        self.memo_stand[key] = ev
+        return ev
+
+    def hit(self, hand: Hand, removed: int = -1) -> float:
+        """EV of hitting, then playing on optimally with stay / hit"""
+        key = self._key(hand, removed)
+        if key in self.memo_hit:
+            return self.memo_hit[key]
+
+        ev = 0.0
+        for i, p in self._draws(hand, removed):
+            hand_next = self._add(hand, i)
+            total = self._total(hand_next)
+            if total > 21:
+                ev -= p
+            elif total == 21:
+                ev += p * self.stand(hand_next, removed)
+            else:
+                ev += p * max(
+                    self.stand(hand_next, removed), self.hit(hand_next, removed)
+                )
+
+        self.memo_hit[key] = ev
+        return ev
+
+    def double(self, hand: Hand, removed: int = -1) -> float:
+        ev = 0.0
+        for i, p in self._draws(hand, removed):
+            ev += p * self.stand(self._add(hand, i), removed)
+        return 2 * ev
+
+    def _split_hand(self, hand: Hand, removed: int) -> float:
+        """value of a 2 card hand after a split (no surrender, no resplit)"""
+        key = self._key(hand, removed)
+        if key in self.memo_split_hand:
+            return self.memo_split_hand[key]
+
+        aces_split = hand[0] and (removed == 0)
+        stand = self.stand(hand, removed)
+        if (self._total(hand) == 21) or (
+            aces_split and not self.rules.hit_after_split_aces
+        ):
+            ev = stand
+        else:
+            ev = max(stand, self.hit(hand, removed))
+            if self.rules.double_after_split:
+                ev = max(ev, self.double(hand, removed))
+
+        self.memo_split_hand[key] = ev
+        return ev
+
+    def split(self, i_pair: int) -> float:
+        hand = self._add((0,) * 10, i_pair)
+        ev = 0.0
+        for i, p in self._draws(hand, i_pair):
+            ev += p * self._split_hand(self._add(hand, i), i_pair)
+        return 2 * ev
+
+    def two_card_hands(self) -> List[Tuple[Hand, float]]:
+        """every 2 card hand (besides blackjack) + probability it's dealt"""
+        hands = []
+        empty = (0,) * 10
+        for i, p_i in self._draws(empty, -1):
+            for j, p_j in self._draws(self._add(empty, i), -1):
+                if j < i:
+                    continue
+                if {i, j} == {0, 9}:
+                    continue
+                p = p_i * p_j * (1 if i == j else 2)
+                hands.append((self._add(self._add(empty, i), j), p))
+        return hands
+
+
+def _state(hand: Hand) -> Tuple[int, bool]:
+    hard = sum((i + 1) * c for i, c in enumerate(hand))
+    useable_ace = bool(hand[0]) and (hard <= 11)
+    return hard + 10 * useable_ace, useable_ace
+
+
+def solve_q(
+    rules: RulesI = {},
+    n_decks: Optional[int] = None,
+    counts: Optional[Sequence[int]] = None,
+    moves_blacklist: List[str] = [],
+) -> dict:
+    """
+    Exact EV of each move, in the same format as init_q().
+
+    - rules : RulesI (or dict of rules)
+    - n_decks : number of decks in a fresh shoe. None for an infinite deck.
+    - counts : explicit shoe composition (see src.exact.dealer), overrides n_decks.
+
+    Moves that are never valid in a state (split without a pair) are -inf.
+    """
+    if not isinstance(rules, RulesI):
+        rules = RulesI(**rules)
+    if counts is None and n_decks is not None:
+        counts = shoe_counts(n_decks)
+    counts = None if counts is None else tuple(counts)
+
+    moves = ["stay", "hit", "split", "double", "surrender"]
+    moves = [m for m in moves if m not in moves_blacklist]
+
+    Q = {}
+    for house in range(2, 12):
+        solver = _Solver(rules, counts, house)
+
+        totals: Dict[Tuple[int, bool], np.ndarray] = {}
+        weights: Dict[Tuple[int, bool], float] = {}
+        for hand, p in solver.two_card_hands():
+            state = _state(hand)
+            evs = np.array(
+                [solver.stand(hand), solver.hit(hand), solver.double(hand), -0.5]
+            )
+            totals[state] = totals.get(state, 0) + p * evs
+            weights[state] = weights.get(state, 0) + p
+
+        for p in range(4, 22):
+            ace_arr = [False]
+            if 11 < p < 21:
+                ace_arr.append(True)
+
+            for ace in ace_arr:
+                if (p, ace) in totals:
+                    stay, hit, double, surrender = totals[(p, ace)] / weights[(p, ace)]
+                else:
+                    # only hard 21, which is never dealt in 2 cards.
+                    hand = solver._add(solver._add(solver._add((0,) * 10, 9), 9), 0)
+                    stay, hit, double, surrender = (
+                        solver.stand(hand), -1.0, -2.0, -0.5
+                    )
+
+                split = -np.inf
+                if ace and (p == 12):
+                    split = solver.split(0)
+                elif (not ace) and (not p % 2) and (p <= 20):
+                    split = solver.split(p // 2 - 1)
+
+                evs = {
+                    "stay": stay,
+                    "hit": hit,
+                    "split": split,
+                    "double": double,
+                    "surrender": surrender,
+                }
+                Q[(p, house, ace)] = {m: float(evs[m]) for m in moves}
+
+    return Q
+
+
+def basic_strategy(
+    rules: RulesI = {},
+    n_decks: Optional[int] = None,
+    counts: Optional[Sequence[int]] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """hard, soft, split strategy grids (see generate_grid) from solve_q()"""
+    return generate_grid(
+        solve_q(rules=rules, n_decks=n_decks, counts=counts), return_type="string"
+    )
@@ -0,0 +1,99 @@
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+
+from src.constants import moves
+from src.pydantic_types import RulesI
+
+"""
+Integer bitmask representation of the action space.
+
+Bit i of a mask is set if moves[i] is valid, so any set of valid moves is an
+int in [0, 32). Validity of a move only depends on a handful of hand features,
+so every mask is precomputed per set of rules, and a lookup replaces building
+lists of strings on every decision.
+
+Table axes:
+    - two_cards : hand has exactly 2 cards
+    - pair : 0 = not a pair, 1 = same card (ie K,K), 2 = same value only (ie K,Q)
+    - multi_hand : player has more than 1 hand (split)
+    - aces_split : player split aces
+    - total : 0 = under 21, 1 = 21, 2 = bust
+"""
+
+MOVE_BITS = {move: 1 << i for i, move in enumerate(moves)}
+
+MASK_MOVES: List[List[str]] = [
+    [move for move in moves if mask & MOVE_BITS[move]] for mask in range(32)
+]
+
+
+def moves_to_mask(valid_moves: List[str]) -> int:
+    mask = 0
+    for move in valid_moves:
+        mask |= MOVE_BITS[move]
+    return mask
+
+
+def mask_to_moves(mask: int) -> List[str]:
+    return MASK_MOVES[mask]
+
+
+@lru_cache(maxsize=None)
+def _build_table(rules_items: tuple) -> np.ndarray:
+    rules = RulesI(**dict(rules_items))
+    table = np.zeros((2, 3, 2, 2, 3), dtype=np.uint8)
+
+    for two_cards in [0, 1]:
+        for pair in [0, 1, 2]:
+            for multi_hand in [0, 1]:
+                for aces_split in [0, 1]:
+                    # mirrors Player.get_valid_moves()
+                    can_hit = (not aces_split) or rules.hit_after_split_aces
+                    can_stay = can_hit
+                    can_surrender = (
+                        two_cards and (not multi_hand) and rules.allow_surrender
+                    )
+                    can_split = two_cards and (
+                        (pair == 1) or ((pair == 2) and rules.split_any_ten)
+                    )
+                    can_double = (
+                        two_cards
+                        and (multi_hand and rules.double_after_split or not multi_hand)
+                        and can_hit
+                    )
+
+                    valid = []
+                    if can_stay:
+                        valid.append("stay")
+                    if can_hit:
+                        valid.append("hit")
+                    if can_split:
+                        valid.append("split")
+                    if can_surrender:
+                        valid.append("surrender")
+                    if can_double:
+                        valid.append("double")
+
+                    ind = (two_cards, pair, multi_hand, aces_split)
+                    table[ind + (0,)] = moves_to_mask(valid)
+                    table[ind + (1,)] = MOVE_BITS["stay"]
+                    table[ind + (2,)] = 0
+
+    table.setflags(write=False)
+    return table
+
+
+def valid_move_table(rules: RulesI) -> np.ndarray:
+    """(2, 3, 2, 2, 3) table of valid move masks for the given rules"""
+    return _build_table(tuple(rules))
+
+
+def invalid_move_table(move_order: List[str]) -> np.ndarray:
+    """
+    (32, len(move_order)) table, True where move_order[j] isn't valid for the mask
+    of row i. Lets networks mask their outputs with a single index per decision.
+    """
+    bits = np.array([MOVE_BITS[move] for move in move_order])
+    return (np.arange(32)[:, None] & bits) == 0
@@ -25,12 +25,23 @@ class Card:
             self.value = 1 if self.card == "A" else 10
 
 
-@dataclass
+@dataclass(slots=True)
 class Cards:
+    """
+    Hand totals are kept as running state, a hard total (Ace == 1) and the
+    number of aces, so adding / removing a card is O(1) and total /
+    useable_ace never need to loop over the hand.
+    """
+
     cards: List[Card] = field(default_factory=list)
     requires_total: bool = True
-    total: int = field(init=False)
-    useable_ace: bool = field(init=False)
+    hard_total: int = field(init=False, default=0)
+    n_aces: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        if self.requires_total:
+            for card in self.cards:
+                self._add_value(card)
 
     @classmethod
     def init_from_deck(cls, n):
@@ -47,50 +58,56 @@ class Cards:
                 cards.extend([Card(suit, c)] * n)
         return cards
 
-    def _update_value(self) -> None:
-        summed = 0
-        aces = 0
-        self.useable_ace = False
-        for card in self.cards:
-            summed += card.value
-            aces += int(card.card == "A")
-        if aces:
-            if summed <= 11:
-                self.useable_ace = True
-                summed += 10
-        self.total = summed
-
-    def _decorator(f):
-        def inner(self, *args, **kwargs):
-            res = f(self, *args, **kwargs)
-            if self.requires_total:
-                self._update_value()
-            return res
-
-        return inner
-
-    @_decorator
+    @property
+    def n_remaining(self) -> int:
+        return len(self.cards)
+
+    @property
+    def useable_ace(self) -> bool:
+        return (self.n_aces > 0) and (self.hard_total <= 11)
+
+    @property
+    def total(self) -> int:
+        if self.n_aces and (self.hard_total <= 11):
+            return self.hard_total + 10
+        return self.hard_total
+
+    def _add_value(self, card: Card) -> None:
+        self.hard_total += card.value
+        self.n_aces += card.value == 1
+
+    def _remove_value(self, card: Card) -> None:
+        self.hard_total -= card.value
+        self.n_aces -= card.value == 1
+
     def add_cards(self, cards: Union[Card, List[Card]]) -> None:
         if isinstance(cards, Card):
-            self.cards.append(cards)
-        else:
-            self.cards.extend(cards)
+            cards = [cards]
+        self.cards.extend(cards)
+        if self.requires_total:
+            for card in cards:
+                self._add_value(card)
 
-    @_decorator
-    def remove_card(self, ind: int) -> None:
+    def remove_card(self, ind: int) -> Card:
         if ind >= len(self.cards):
             raise Exception("invalid index used")
-        return self.cards.pop(ind)
+        card = self.cards.pop(ind)
+        if self.requires_total:
+            self._remove_value(card)
+        return card
 
-    @_decorator
     def clear_cards(self):
         self.cards = []
+        self.hard_total = 0
+        self.n_aces = 0
 
-    @_decorator
     def select_card(self, deplete: bool = True) -> Card:
         if not len(self.cards):
             raise Exception("no cards in the deck")
         ind = choice(len(self.cards))
-        if deplete:
-            return self.cards.pop(ind)
-        return self.cards[ind]
+        if not deplete:
+            return self.cards[ind]
+        card = self.cards.pop(ind)
+        if self.requires_total:
+            self._remove_value(card)
+        return card
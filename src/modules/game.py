@@ -1,8 +1,12 @@
 from dataclasses import dataclass, field
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
+
+from src.constants import count_systems
 
 from src.modules.cards import Card, Cards
 from src.modules.player import Player
+from src.modules.recorder import HandRecorder
+from src.modules.shoe import Shoe, ShoeBank
 from src.pydantic_types import RulesI
 
 """
@@ -15,6 +19,10 @@ Input :
     - shrink_deck : boolean , whether or not to remove selected cards from deck. If False, each card is drawn iid.
     - n_decks : number of decks to play with (default is 6, which is typical)
     - ratio_penetrate : ratio of cards that are playable (default is 2/3 of 6 decks). Only applicable when shrinkDeck == True.
+    - shoe_type : "array" (pre-shuffled integer shoe, dealt with a cursor) or "cards" (list of Card, random pop per draw).
+    - count_system : key of constants.count_systems used for the running count (default is "hi_lo").
+    - recorder : optional HandRecorder, which logs every player decision (step_player) and every player's result (get_results) to memory-mapped files.
+    - shoe_bank : optional ShoeBank. Shoes are then taken in order from the bank instead of shuffled at random, so every Game with the same bank sees the same cards. Requires shoe_type == "array".
 
 MUST call init_round() to start the round
 
@@ -30,39 +38,77 @@ class Game:
     shrink_deck: bool = True
     n_decks: int = 6
     ratio_penetrate: float = 4 / 6
+    shoe_type: str = "array"
+    count_system: str = "hi_lo"
+    shoe_bank: Optional[ShoeBank] = None
+    recorder: Optional[HandRecorder] = None
+    i_shoe: int = field(init=False, default=0)
     n_rounds_played: int = field(init=False, default=0)
     reset_deck_after_round: bool = field(init=False, default=False)
     cut_card: int = field(init=False)
-    shoe: Cards = field(init=False)
+    shoe: Union[Shoe, Cards] = field(init=False)
     players: List[Player] = field(init=False)
     house: Player = field(init=False)
     count: int = field(init=False, default=0)
     true_count: float = field(init=False, default=0)
+    count_weights: List[int] = field(init=False)
+    hole_card: Optional[Card] = field(init=False, default=None)
 
     def __post_init__(self):
         if not isinstance(self.rules, RulesI):
             self.rules = RulesI(**self.rules)
+        assert self.shoe_type in ["array", "cards"], "invalid shoe_type"
+        assert self.count_system in count_systems, "invalid count_system"
+        assert (self.shoe_bank is None) or (
+            self.shoe_type == "array"
+        ), "shoe_bank requires shoe_type='array'"
+        weights = count_systems[self.count_system]
+        # indexed by card value, so a card's weight is a single list lookup.
+        self.count_weights = [0] + [weights[v] for v in range(1, 11)]
         self.cut_card = int(self.n_decks * 52 * (1 - self.ratio_penetrate))
         self._init_deck()
 
     def _init_deck(self) -> None:
-        self.shoe = Cards.init_from_deck(self.n_decks)
+        if self.shoe_bank is not None:
+            self.shoe = self.shoe_bank.shoe(self.i_shoe, self.n_decks, self.cut_card)
+            self.i_shoe += 1
+        elif self.shoe_type == "array":
+            self.shoe = Shoe(n_decks=self.n_decks, cut_card=self.cut_card)
+        else:
+            self.shoe = Cards.init_from_deck(self.n_decks)
         self.count = 0
         self.true_count = 0
+        self.hole_card = None
 
     def _init_players(self) -> None:
         self.players = [Player(wager=wager, rules=self.rules) for wager in self.wagers]
         self.house = Player(wager=0)
 
-    def _select_card(self) -> Card:
+    def _select_card(self, hidden: bool = False) -> Card:
         card = self.shoe.select_card(deplete=self.shrink_deck)
-        stop_card_met = len(self.shoe.cards) <= self.cut_card
+        stop_card_met = self.shoe.n_remaining <= self.cut_card
 
         if stop_card_met and self.shrink_deck:
             self.reset_deck_after_round = True
 
+        if hidden:
+            # the house hole card isn't counted until it's revealed.
+            self.hole_card = card
+        else:
+            self._count_card(card)
+
         return card
 
+    def _count_card(self, card: Card) -> None:
+        # count is meaningless when cards are drawn iid.
+        if self.shrink_deck:
+            self.count += self.count_weights[card.value]
+
+    def _reveal_hole_card(self) -> None:
+        if self.hole_card is not None:
+            self._count_card(self.hole_card)
+            self.hole_card = None
+
     def _decorator(f):
         def inner(self, *args, **kwargs):
             res = f(self, *args, **kwargs)
@@ -72,22 +118,11 @@ class Game:
         return inner
 
     def _update_count(self) -> None:
-        def count_impact(card: Card):
-            if 2 <= card.value <= 6:
-                return -1
-            if (card.value == 1) or (card.value == 10):
-                return 1
-            return 0
-
-        # count based off cards still in the shoe.
-        count = sum(map(count_impact, self.shoe.cards))
-        if not self.house_played:
-            # need to fix for the hidden house card, which we don't know about until it's flipped. # noqa: E501
-            hidden_card = self.house.cards[0].cards[1]
-            count += count_impact(hidden_card)
-
-        self.true_count = count * 52 / len(self.shoe.cards)
-        self.count = count
+        # running count is kept incrementally as cards are seen, so only the
+        # true count needs refreshing. The hidden house card is still
+        # considered part of the unseen cards until it's flipped.
+        n_unseen = self.shoe.n_remaining + int(self.hole_card is not None)
+        self.true_count = self.count * 52 / n_unseen
 
     def init_round(self, wagers: List[float]) -> None:
         """
@@ -102,6 +137,12 @@ class Game:
         self.house_blackjack = False
         self.house_played = False
 
+        # if the previous hole card was never flipped, it's seen now.
+        self._reveal_hole_card()
+
+        if self.recorder is not None:
+            self.recorder.start_round()
+
         if self.reset_deck_after_round:
             self._init_deck()
             self.reset_deck_after_round = False
@@ -126,12 +167,12 @@ class Game:
         if len(force_cards):
             assert len(force_cards) == 2, "must include exactly 2 cards to force"
 
-        for _ in range(2):
+        for i in range(2):
             for player in self.players:
                 if not force_cards:
                     card = self._select_card()
                     player._deal_card(card)
-            card = self._select_card()
+            card = self._select_card(hidden=i == 1)
             self.house._deal_card(card)
         if force_cards:
             for c in force_cards:
@@ -164,6 +205,7 @@ class Game:
         # throughout each card draw, versus only at the end of the house sequence.
 
         self.house_played = True
+        self._reveal_hole_card()
         if only_reveal_card:
             return
 
@@ -185,17 +227,49 @@ class Game:
         return False
 
     @_decorator
-    def step_player(self, ind: int, move: str) -> None:
+    def step_player(
+        self, ind: int, move: str, propensity: float = float("nan")
+    ) -> None:
+        """
+        propensity : probability the policy gave to move. Only used by the recorder,
+        for off-policy evaluation of other policies.
+        """
+        if self.recorder is not None:
+            player = self.players[ind]
+            player_total, useable_ace = player.get_value()
+            house_value = self.get_house_show().value
+            state = (player_total, house_value if house_value > 1 else 11, useable_ace)
+            mask = player.get_valid_moves_mask()
+            i_hand = player.i_hand
+            true_count = self.true_count
+
         n = Player.get_num_cards_draw(move)
         cards = [self._select_card() for _ in range(n)]
         self.players[ind].step(move, cards)
 
+        if self.recorder is not None:
+            self.recorder.record_decision(
+                ind, i_hand, state, mask, move, cards, true_count, propensity
+            )
+
     def get_results(self) -> Tuple[List[List[str]], List[float]]:
         players = []
         winnings = []
-        for player in self.players:
+        for i, player in enumerate(self.players):
             text, win = player.get_result(self.house.cards[0])
             players.append(text)
             winnings.append(win)
 
+            if self.recorder is not None:
+                self.recorder.record_round(
+                    seat=i,
+                    base_wager=player.base_wager,
+                    wagers=player.wager,
+                    results=text,
+                    winnings=win,
+                    house_cards=self.house.cards[0].cards,
+                    house_total=self.house.cards[0].total,
+                    true_count=self.true_count,
+                )
+
         return players, winnings
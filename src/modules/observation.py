@@ -0,0 +1,210 @@
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Optional, Sequence, Union
+
+import numpy as np
+
+from src.modules.actions import MOVE_BITS
+
+if TYPE_CHECKING:
+    from src.modules.game import Game
+
+"""
+Encoding of a player's decision into the observation fed to a network.
+
+Columns, in order (optional ones only if enabled):
+    - player_total
+    - house_value : value of the house show, with aces as 11
+    - useable_ace : +1 / -1
+    - can_split : +1 / -1, from the valid move mask (optional)
+    - can_double : +1 / -1, from the valid move mask (optional)
+    - true_count : (optional)
+    - cards_remaining : unseen cards (remaining shoe + the hole card), in decks (optional)
+Booleans are encoded as [-1, 1] rather than [0, 1], which plays better with ReLU.
+
+Observations are written as float32 rows straight into preallocated (n, dim) arrays
+(empty()), one decision (write(), write_player()) or a batch of games (encode_games())
+at a time, and torch.from_numpy() wraps them without a copy. encode_arrays()
+encodes whole columns at once (every state of a grid, logged decisions, ...).
+
+Runners and collectors that take include_count also accept an ObservationEncoder in
+its place, for the optional features (see as_encoder()).
+# noqa: E501
+"""
+
+FEATURES = [
+    "player_total",
+    "house_value",
+    "useable_ace",
+    "can_split",
+    "can_double",
+    "true_count",
+    "cards_remaining",
+]
+
+
+@dataclass
+class ObservationEncoder:
+    include_count: bool = False
+    can_split: bool = False
+    can_double: bool = False
+    cards_remaining: bool = False
+    # enabled columns, in order
+    features: List[str] = field(init=False)
+    dim: int = field(init=False)
+
+    def __post_init__(self):
+        enabled = {
+            "can_split": self.can_split,
+            "can_double": self.can_double,
+            "true_count": self.include_count,
+            "cards_remaining": self.cards_remaining,
+        }
+        self.features = [f for f in FEATURES if enabled.get(f, True)]
+        self.dim = len(self.features)
+
+    @property
+    def uses_mask(self) -> bool:
+        """whether observations depend on the valid move mask"""
+        return self.can_split or self.can_double
+
+    def empty(self, n: int) -> np.ndarray:
+        return np.zeros((n, self.dim), dtype=np.float32)
+
+    def write(
+        self,
+        out: np.ndarray,
+        i: int,
+        player_total: int,
+        house_value: int,
+        useable_ace: bool,
+        mask: int = 0,
+        true_count: float = 0.0,
+        cards_remaining: float = 0.0,
+    ) -> None:
+        """writes the observation of a decision into row i of out"""
+        row = [player_total, house_value, 1 if useable_ace else -1]
+        if self.can_split:
+            row.append(1 if mask & MOVE_BITS["split"] else -1)
+        if self.can_double:
+            row.append(1 if mask & MOVE_BITS["double"] else -1)
+        if self.include_count:
+            row.append(true_count)
+        if self.cards_remaining:
+            row.append(cards_remaining)
+        out[i] = row
+
+    def write_player(
+        self,
+        out: np.ndarray,
+        i: int,
+        game: "Game",
+        player_ind: int,
+        house_value: int,
+        mask: Optional[int] = None,
+        true_count: Optional[float] = None,
+    ) -> None:
+        """
+        write() of the current hand of a player.
+        mask / true_count : if already known (defaults to the player's valid moves,
+            and the game's current true count).
+        """
+        player = game.players[player_ind]
+        player_total, useable_ace = player.get_value()
+        if self.uses_mask and mask is None:
+            mask = player.get_valid_moves_mask()
+        self.write(
+            out,
+            i,
+            player_total,
+            house_value,
+            useable_ace,
+            mask=mask or 0,
+            true_count=game.true_count if true_count is None else true_count,
+            cards_remaining=self._cards_remaining(game) if self.cards_remaining else 0,
+        )
+
+    @staticmethod
+    def _cards_remaining(game: "Game") -> float:
+        n_unseen = game.shoe.n_remaining + int(game.hole_card is not None)
+        return n_unseen / 52
+
+    def encode_games(
+        self,
+        games: Sequence["Game"],
+        seats: Sequence[int],
+        house_values: Sequence[int],
+        masks: Optional[Sequence[int]] = None,
+        true_counts: Optional[Sequence[float]] = None,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        observations of the pending decision of every game (player seats[k]), as
+        the first len(games) rows of out (allocated if not passed, or too small).
+        """
+        n = len(games)
+        if out is None or len(out) < n:
+            out = self.empty(n)
+        for k in range(n):
+            self.write_player(
+                out,
+                k,
+                games[k],
+                seats[k],
+                house_values[k],
+                mask=None if masks is None else masks[k],
+                true_count=None if true_counts is None else true_counts[k],
+            )
+        return out[:n]
+
+    def encode_arrays(
+        self,
+        player_total: np.ndarray,
+        house_value: np.ndarray,
+        useable_ace: np.ndarray,
+        mask: Optional[Union[np.ndarray, int]] = None,
+        true_count: Union[np.ndarray, float] = 0.0,
+        cards_remaining: Optional[Union[np.ndarray, float]] = None,
+    ) -> np.ndarray:
+        """
+        vectorized write(), over columns of decisions -> (n, dim).
+        useable_ace is a boolean (or +1 / -1) array. Scalars are broadcast.
+        """
+        assert not (self.uses_mask and mask is None), "mask is required"
+        assert not (
+            self.cards_remaining and cards_remaining is None
+        ), "cards_remaining is required"
+
+        player_total = np.asarray(player_total)
+        out = self.empty(len(player_total))
+        columns = {
+            "player_total": player_total,
+            "house_value": house_value,
+            "useable_ace": np.where(np.asarray(useable_ace) > 0, 1, -1),
+            "true_count": true_count,
+            "cards_remaining": cards_remaining,
+        }
+        if self.uses_mask:
+            mask = np.asarray(mask, dtype=np.int64)
+            columns["can_split"] = np.where(mask & MOVE_BITS["split"], 1, -1)
+            columns["can_double"] = np.where(mask & MOVE_BITS["double"], 1, -1)
+        for j, feature in enumerate(self.features):
+            out[:, j] = columns[feature]
+        return out
+
+    def encode_decisions(self, decisions: np.ndarray) -> np.ndarray:
+        """observations of logged decisions (HandRecorder "decisions" rows)"""
+        assert not self.cards_remaining, "cards remaining aren't recorded"
+        return self.encode_arrays(
+            decisions["player_total"],
+            decisions["house_value"],
+            decisions["useable_ace"],
+            mask=decisions["mask"],
+            true_count=decisions["true_count"],
+        )
+
+
+def as_encoder(include_count: Union[bool, ObservationEncoder]) -> ObservationEncoder:
+    """the encoder of an include_count argument (or the encoder passed in its place)"""
+    if isinstance(include_count, ObservationEncoder):
+        return include_count
+    return ObservationEncoder(include_count=bool(include_count))
@@ -1,6 +1,9 @@
 from dataclasses import dataclass, field
 from typing import List, Tuple
 
+import numpy as np
+
+from src.modules.actions import valid_move_table
 from src.modules.cards import Card, Cards
 from src.pydantic_types import RulesI
 
@@ -26,10 +29,12 @@ class Player:
     complete: List[bool] = field(init=False, default_factory=lambda: [False])
     surrendered: bool = field(init=False, default=False)
     aces_split: bool = field(init=False, default=False)
+    move_table: np.ndarray = field(init=False, repr=False)
 
     def __post_init__(self):
         if not isinstance(self.rules, RulesI):
             self.rules = RulesI(**self.rules)
+        self.move_table = valid_move_table(self.rules)
         self.base_wager = self.wager
         self.wager = [self.wager]
 
@@ -76,10 +81,8 @@ class Player:
         self.wager.insert(i_hand + 1, self.base_wager)
         self.complete.insert(i_hand + 1, False)
 
-        # Calling this add_cards() fct will inherently create an updated
-        # "total" variable.
-        # if we create the new Cards in the .insert() method, we won't have
-        # the "total" variable yet.
+        # Cards keeps its running total through remove_card() / add_cards(),
+        # so both hands are up to date once the new cards are dealt.
         self.cards[i_hand].add_cards(cards[0])
         self.cards[i_hand + 1].add_cards(cards[1])
 
@@ -150,6 +153,38 @@ class Player:
 
         return possible_moves
 
+    @_decorator
+    def get_valid_moves_mask(self) -> int:
+        """
+        Same as get_valid_moves(), but as an integer bitmask over constants.moves,
+        looked up from a table precomputed for the rules.
+        """
+        if self.i_hand < 0:
+            return 0
+
+        hand = self.cards[self.i_hand]
+        two_cards = len(hand.cards) == 2
+        pair = 0
+        if two_cards:
+            card_0, card_1 = hand.cards
+            if card_0.card == card_1.card:
+                pair = 1
+            elif card_0.value == card_1.value:
+                pair = 2
+        total = hand.total
+        total_ind = 0 if total < 21 else (1 if total == 21 else 2)
+
+        # bools have to be cast, numpy treats them as boolean masks otherwise.
+        return int(
+            self.move_table[
+                int(two_cards),
+                pair,
+                int(len(self.cards) > 1),
+                int(self.aces_split),
+                total_ind,
+            ]
+        )
+
     @staticmethod
     def get_num_cards_draw(move: str) -> int:
         if move in ["hit", "double"]:
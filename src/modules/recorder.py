@@ -0,0 +1,240 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from src.constants import card_map, moves
+from src.modules.cards import Card
+
+"""
+Hand history of simulated rounds.
+
+Game appends a fixed size record per player decision and per player per round to
+NumPy structured arrays (one row per record, fields side by side), which live in
+chunked, memory-mapped .npy files:
+    <path>/decisions_000000.npy, decisions_000001.npy, ...
+    <path>/rounds_000000.npy, ...
+    <path>/meta.json : number of rows written to each chunk
+
+Nothing is pickled, and only the chunk being written is mapped, so the history
+can grow well past RAM. HandHistory reads chunks back as memory-mapped views
+(zero-copy). A single field (column()) is a strided view of one chunk, so gathering
+it over several chunks copies it.
+
+Cards are stored as rank codes (constants.card_map, 2 -> 0 ... A -> 12), -1 if empty.
+Actions are indices of constants.moves. Results are indices of RESULTS.
+Decisions keep the probability the behavior policy gave to the logged action
+(propensity, NaN if the caller didn't pass it), for off-policy evaluation.
+# noqa: E501
+"""
+
+# cards dealt by a single action (split deals 2).
+MAX_ACTION_CARDS = 2
+MAX_HOUSE_CARDS = 12
+MAX_HANDS = 8
+
+RESULTS = ["bust", "win", "loss", "push", "blackjack", "surrender"]
+
+RANK_CODES = {v: k for k, v in card_map.items()}
+
+DECISION_DTYPE = np.dtype(
+    [
+        ("round", np.int64),
+        ("seat", np.int8),
+        ("hand", np.int8),
+        ("player_total", np.int8),
+        ("house_value", np.int8),
+        ("useable_ace", np.bool_),
+        ("mask", np.uint8),
+        ("action", np.int8),
+        ("cards", np.int8, (MAX_ACTION_CARDS,)),
+        ("true_count", np.float32),
+        ("propensity", np.float32),
+    ]
+)
+
+ROUND_DTYPE = np.dtype(
+    [
+        ("round", np.int64),
+        ("seat", np.int8),
+        ("wager", np.float32),
+        ("n_hands", np.int8),
+        ("wagers", np.float32, (MAX_HANDS,)),
+        ("results", np.int8, (MAX_HANDS,)),
+        ("winnings", np.float32, (MAX_HANDS,)),
+        ("house_cards", np.int8, (MAX_HOUSE_CARDS,)),
+        ("house_total", np.int8),
+        ("true_count", np.float32),
+    ]
+)
+
+TABLES = {"decisions": DECISION_DTYPE, "rounds": ROUND_DTYPE}
+
+
+def card_codes(cards: List[Card], size: int) -> List[int]:
+    codes = [RANK_CODES[card.card] for card in cards[:size]]
+    return codes + [-1] * (size - len(codes))
+
+
+class _ChunkWriter:
+    def __init__(self, path: str, name: str, dtype: np.dtype, chunk_size: int):
+        self.path = path
+        self.name = name
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.counts: List[int] = []
+        self.chunk: Optional[np.memmap] = None
+        # plain ndarray view of the same mapped buffer, row assignment on a memmap
+        # subclass is several times slower.
+        self.rows: Optional[np.ndarray] = None
+
+    def _open_chunk(self) -> None:
+        if self.chunk is not None:
+            self.chunk.flush()
+        file = os.path.join(self.path, f"{self.name}_{len(self.counts):06d}.npy")
+        self.chunk = np.lib.format.open_memmap(
+            file, mode="w+", dtype=self.dtype, shape=(self.chunk_size,)
+        )
+        self.rows = self.chunk.view(np.ndarray)
+        self.counts.append(0)
+
+    def append(self, row: tuple) -> None:
+        if self.chunk is None or self.counts[-1] == self.chunk_size:
+            self._open_chunk()
+        self.rows[self.counts[-1]] = row
+        self.counts[-1] += 1
+
+    def flush(self) -> None:
+        if self.chunk is not None:
+            self.chunk.flush()
+
+
+@dataclass
+class HandRecorder:
+    path: str
+    # rows per chunk file
+    chunk_size: int = 1_000_000
+    round_id: int = field(init=False, default=-1)
+    writers: Dict[str, _ChunkWriter] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.writers = {
+            name: _ChunkWriter(self.path, name, dtype, self.chunk_size)
+            for name, dtype in TABLES.items()
+        }
+
+    def start_round(self) -> None:
+        self.round_id += 1
+
+    def record_decision(
+        self,
+        seat: int,
+        hand: int,
+        state: tuple,
+        mask: int,
+        move: str,
+        cards: List[Card],
+        true_count: float,
+        propensity: float = np.nan,
+    ) -> None:
+        player_total, house_value, useable_ace = state
+        self.writers["decisions"].append(
+            (
+                self.round_id,
+                seat,
+                hand,
+                player_total,
+                house_value,
+                useable_ace,
+                mask,
+                moves.index(move),
+                card_codes(cards, MAX_ACTION_CARDS),
+                true_count,
+                propensity,
+            )
+        )
+
+    def record_round(
+        self,
+        seat: int,
+        base_wager: float,
+        wagers: List[float],
+        results: List[str],
+        winnings: List[float],
+        house_cards: List[Card],
+        house_total: int,
+        true_count: float,
+    ) -> None:
+        n_hands = len(winnings)
+        pad = MAX_HANDS - n_hands
+        self.writers["rounds"].append(
+            (
+                self.round_id,
+                seat,
+                base_wager,
+                n_hands,
+                (list(wagers) + [np.nan] * MAX_HANDS)[:MAX_HANDS],
+                [RESULTS.index(r) for r in results][:MAX_HANDS] + [-1] * pad,
+                list(winnings)[:MAX_HANDS] + [np.nan] * pad,
+                card_codes(house_cards, MAX_HOUSE_CARDS),
+                house_total,
+                true_count,
+            )
+        )
+
+    def flush(self) -> None:
+        for writer in self.writers.values():
+            writer.flush()
+        meta = {
+            "chunk_size": self.chunk_size,
+            "round_id": self.round_id,
+            "counts": {name: w.counts for name, w in self.writers.items()},
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def close(self) -> None:
+        self.flush()
+        for writer in self.writers.values():
+            writer.chunk = None
+            writer.rows = None
+
+
+@dataclass
+class HandHistory:
+    """zero-copy reader of a HandRecorder directory"""
+
+    path: str
+    counts: Dict[str, List[int]] = field(init=False)
+
+    def __post_init__(self):
+        with open(os.path.join(self.path, "meta.json")) as f:
+            self.counts = json.load(f)["counts"]
+
+    def chunks(self, table: str = "decisions") -> Iterator[np.ndarray]:
+        """memory-mapped (read only) views of each chunk, trimmed to rows written"""
+        assert table in TABLES, "invalid table"
+        for i, count in enumerate(self.counts[table]):
+            file = os.path.join(self.path, f"{table}_{i:06d}.npy")
+            yield np.load(file, mmap_mode="r")[:count]
+
+    def __len__(self) -> int:
+        return sum(self.counts["decisions"])
+
+    def n_rows(self, table: str = "decisions") -> int:
+        return sum(self.counts[table])
+
+    def column(self, table: str, name: str) -> np.ndarray:
+        """
+        a single field over every chunk: a strided view of the records if there's a
+        single chunk, otherwise a copy.
+        """
+        cols = [chunk[name] for chunk in self.chunks(table)]
+        if not cols:
+            return np.empty(0, dtype=TABLES[table][name])
+        if len(cols) == 1:
+            return cols[0]
+        return np.concatenate(cols)
@@ -0,0 +1,88 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import numpy as np
+
+from src.modules.cards import Card, SuitEnum
+
+"""
+Array backed shoe.
+
+Instead of holding a list of Card objects and popping a random index on every
+draw, the shoe is stored as a small integer array which is shuffled once, and
+cards are dealt by advancing a cursor. Each code maps back onto one of the 52
+unique Card objects, so Player / Cards still receive Card instances.
+
+code = suit_index * 13 + rank_index, where rank_index follows constants.card_map
+
+ShoeBank is a seeded, reproducible sequence of shoes: shoe i is always shuffled
+by the same RNG stream, so different policies can be played against exactly the
+same cards (common random numbers).
+"""
+
+RANKS = [2, 3, 4, 5, 6, 7, 8, 9, 10, "J", "Q", "K", "A"]
+
+DECK: List[Card] = [Card(suit, c) for suit in SuitEnum for c in RANKS]
+
+
+@dataclass
+class Shoe:
+    n_decks: int = 6
+    # number of cards remaining at which the cut card is reached.
+    cut_card: int = 0
+    rng: Optional[np.random.Generator] = None
+    codes: np.ndarray = field(init=False)
+    cursor: int = field(init=False, default=0)
+    cut_index: int = field(init=False)
+
+    def __post_init__(self):
+        self.codes = np.tile(np.arange(len(DECK), dtype=np.int8), self.n_decks)
+        # the cut card is just a position in the shuffled array.
+        self.cut_index = len(self.codes) - self.cut_card
+        self.shuffle()
+
+    def shuffle(self) -> None:
+        if self.rng is None:
+            np.random.shuffle(self.codes)
+        else:
+            self.rng.shuffle(self.codes)
+        self.cursor = 0
+
+    @property
+    def n_remaining(self) -> int:
+        return len(self.codes) - self.cursor
+
+    @property
+    def cut_card_met(self) -> bool:
+        return self.cursor >= self.cut_index
+
+    @property
+    def cards(self) -> List[Card]:
+        """remaining cards in the shoe, only here for compatibility with Cards"""
+        return [DECK[c] for c in self.codes[self.cursor:].tolist()]
+
+    def select_card(self, deplete: bool = True) -> Card:
+        if not deplete:
+            # iid draw from the full shoe, cursor never moves.
+            if self.rng is None:
+                ind = np.random.randint(len(self.codes))
+            else:
+                ind = self.rng.integers(len(self.codes))
+            return DECK[self.codes[ind]]
+        if self.cursor >= len(self.codes):
+            raise Exception("no cards in the deck")
+        code = self.codes[self.cursor]
+        self.cursor += 1
+        return DECK[code]
+
+
+@dataclass
+class ShoeBank:
+    seed: int
+
+    def rng(self, i: int) -> np.random.Generator:
+        return np.random.default_rng([self.seed, i])
+
+    def shoe(self, i: int, n_decks: int = 6, cut_card: int = 0) -> Shoe:
+        """i-th shoe of the bank, identical every time it's requested"""
+        return Shoe(n_decks=n_decks, cut_card=cut_card, rng=self.rng(i))
@@ -0,0 +1,366 @@
+from dataclasses import dataclass, field
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from src.constants import card_map, card_values, count_systems, moves
+from src.modules.actions import MOVE_BITS, valid_move_table
+from src.pydantic_types import RulesI
+
+"""
+Vectorized version of the Game module.
+
+Holds N independent tables (1 player seat + the house each) as NumPy arrays
+and steps all of them in lockstep. It follows the same gameplay as
+Game / Player / Cards, but without any per-card python objects:
+
+    - reset() : starts a round on every table (reshuffling where the cut card was met)
+    - valid_action_mask() : (N, 5) boolean mask of valid moves for the current hand
+    - step(actions) : applies one action per table, ignoring tables that are done
+    - settle() : plays out the house on every table, returns the winnings per table
+
+Cards are stored as rank codes (index of constants.card_map), actions as the
+index of constants.moves.
+
+Player allows unlimited splits, here the number of hands is capped at max_hands,
+after which splitting is no longer a valid move.
+# noqa: E501
+"""
+
+RANK_VALUES = np.array([card_values[card_map[i]] for i in range(13)], dtype=np.int8)
+ACE = 12
+
+STAY, HIT, DOUBLE, SPLIT, SURRENDER = [moves.index(m) for m in moves]
+SPLIT_BIT = MOVE_BITS["split"]
+
+
+@dataclass
+class VecGame:
+    n_tables: int
+    rules: RulesI = field(default_factory=lambda: {})
+    shrink_deck: bool = True
+    n_decks: int = 6
+    ratio_penetrate: float = 4 / 6
+    max_hands: int = 8
+    count_system: str = "hi_lo"
+    seed: Optional[int] = None
+
+    def __post_init__(self):
+        if not isinstance(self.rules, RulesI):
+            self.rules = RulesI(**self.rules)
+        assert self.count_system in count_systems, "invalid count_system"
+        self.rng = np.random.default_rng(self.seed)
+        self.move_table = valid_move_table(self.rules)
+
+        n, h = self.n_tables, self.max_hands
+        self.rows = np.arange(n)
+
+        weights = count_systems[self.count_system]
+        self.count_weights = np.array(
+            [weights[v] for v in RANK_VALUES], dtype=np.int16
+        )
+
+        shoe_size = 52 * self.n_decks
+        self.cut_index = shoe_size - int(shoe_size * (1 - self.ratio_penetrate))
+        self.shoes = np.tile(np.arange(13, dtype=np.int8), (n, 4 * self.n_decks))
+        self.cursor = np.zeros(n, dtype=np.int64)
+        self.reshuffle = np.ones(n, dtype=bool)
+        self.count = np.zeros(n, dtype=np.int64)
+
+        # player hands
+        self.hard = np.zeros((n, h), dtype=np.int16)
+        self.aces = np.zeros((n, h), dtype=np.int16)
+        self.n_cards = np.zeros((n, h), dtype=np.int16)
+        # first 2 ranks of each hand, required to know whether it's a pair.
+        self.rank0 = np.full((n, h), -1, dtype=np.int8)
+        self.rank1 = np.full((n, h), -1, dtype=np.int8)
+        self.wager = np.zeros((n, h), dtype=np.float32)
+        self.complete = np.ones((n, h), dtype=bool)
+        self.n_hands = np.ones(n, dtype=np.int64)
+        self.base_wager = np.ones(n, dtype=np.float32)
+        self.aces_split = np.zeros(n, dtype=bool)
+        self.surrendered = np.zeros(n, dtype=bool)
+
+        # house hand
+        self.house_hard = np.zeros(n, dtype=np.int16)
+        self.house_aces = np.zeros(n, dtype=np.int16)
+        self.house_n_cards = np.zeros(n, dtype=np.int16)
+        self.house_show = np.zeros(n, dtype=np.int8)
+        self.house_hole = np.zeros(n, dtype=np.int8)
+        self.house_blackjack = np.zeros(n, dtype=bool)
+        self.hole_revealed = np.ones(n, dtype=bool)
+
+        self.winnings = np.zeros((n, h), dtype=np.float32)
+
+    @staticmethod
+    def _total(hard: np.ndarray, aces: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        useable_ace = (aces > 0) & (hard <= 11)
+        return hard + 10 * useable_ace, useable_ace
+
+    @property
+    def true_count(self) -> np.ndarray:
+        n_unseen = self.shoes.shape[1] - self.cursor
+        # hole card is unseen until settle() flips it.
+        n_unseen = n_unseen + ~self.hole_revealed
+        return self.count * 52 / n_unseen
+
+    @property
+    def i_hand(self) -> np.ndarray:
+        """index of the current hand for each table (0 if the table is done)"""
+        return np.argmin(self.complete, axis=1)
+
+    @property
+    def done(self) -> np.ndarray:
+        return self.complete.all(axis=1)
+
+    def _draw(self, rows: np.ndarray, counted: bool = True) -> np.ndarray:
+        if not self.shrink_deck:
+            return self.rng.integers(13, size=len(rows)).astype(np.int8)
+        cursor = self.cursor[rows]
+        if (cursor >= self.shoes.shape[1]).any():
+            raise Exception("no cards in the deck")
+        ranks = self.shoes[rows, cursor]
+        self.cursor[rows] = cursor + 1
+        if counted:
+            self.count[rows] += self.count_weights[ranks]
+        return ranks
+
+    def _deal_player(self, rows: np.ndarray, hands: np.ndarray) -> np.ndarray:
+        ranks = self._draw(rows)
+        n = self.n_cards[rows, hands]
+        self.rank0[rows, hands] = np.where(n == 0, ranks, self.rank0[rows, hands])
+        self.rank1[rows, hands] = np.where(n == 1, ranks, self.rank1[rows, hands])
+        self.hard[rows, hands] += RANK_VALUES[ranks]
+        self.aces[rows, hands] += ranks == ACE
+        self.n_cards[rows, hands] = n + 1
+        return ranks
+
+    def _deal_house(self, rows: np.ndarray, hidden: bool = False) -> np.ndarray:
+        ranks = self._draw(rows, counted=not hidden)
+        self.house_hard[rows] += RANK_VALUES[ranks]
+        self.house_aces[rows] += ranks == ACE
+        self.house_n_cards[rows] += 1
+        return ranks
+
+    def get_totals(self) -> Tuple[np.ndarray, np.ndarray]:
+        """player total + useable_ace for the current hand of each table"""
+        i_hand = self.i_hand
+        return self._total(
+            self.hard[self.rows, i_hand], self.aces[self.rows, i_hand]
+        )
+
+    def get_house_value(self) -> np.ndarray:
+        """value of the card the house shows, Ace == 11"""
+        value = RANK_VALUES[self.house_show].astype(np.int64)
+        return np.where(value == 1, 11, value)
+
+    def reset(self, wagers: Union[float, np.ndarray] = 1) -> None:
+        """
+        Initializes a round on every table, and deals the initial cards.
+        Tables which hit the cut card in the previous round are reshuffled.
+        """
+        if self.reshuffle.any():
+            rows = self.reshuffle.nonzero()[0]
+            self.shoes[rows] = self.rng.permuted(self.shoes[rows], axis=1)
+            self.cursor[rows] = 0
+            self.count[rows] = 0
+            self.reshuffle[:] = False
+
+        self.base_wager[:] = wagers
+        self.hard[:] = 0
+        self.aces[:] = 0
+        self.n_cards[:] = 0
+        self.rank0[:] = -1
+        self.rank1[:] = -1
+        self.wager[:] = 0
+        self.wager[:, 0] = self.base_wager
+        self.complete[:] = True
+        self.complete[:, 0] = False
+        self.n_hands[:] = 1
+        self.aces_split[:] = False
+        self.surrendered[:] = False
+        self.winnings[:] = 0
+
+        self.house_hard[:] = 0
+        self.house_aces[:] = 0
+        self.house_n_cards[:] = 0
+
+        first_hand = np.zeros(self.n_tables, dtype=np.int64)
+        self._deal_player(self.rows, first_hand)
+        self.house_show[:] = self._deal_house(self.rows)
+        self._deal_player(self.rows, first_hand)
+        self.house_hole[:] = self._deal_house(self.rows, hidden=True)
+        self.hole_revealed[:] = False
+
+        total, _ = self._total(self.hard[:, 0], self.aces[:, 0])
+        self.complete[:, 0] = total >= 21
+
+        house_total, _ = self._total(self.house_hard, self.house_aces)
+        self.house_blackjack = house_total == 21
+        # round is over immediately on a house blackjack.
+        self.complete[self.house_blackjack] = True
+
+    def valid_action_bitmask(self) -> np.ndarray:
+        """
+        (N,) integer bitmask of the valid moves of the current hand, looked up
+        from the same table as Player.get_valid_moves_mask().
+        Tables that are done are 0.
+        """
+        i_hand = self.i_hand
+        rows = self.rows
+
+        total, _ = self._total(self.hard[rows, i_hand], self.aces[rows, i_hand])
+        rank0 = self.rank0[rows, i_hand]
+        rank1 = self.rank1[rows, i_hand]
+        two_cards = self.n_cards[rows, i_hand] == 2
+        same_value = RANK_VALUES[rank0] == RANK_VALUES[np.maximum(rank1, 0)]
+        pair = np.where(rank0 == rank1, 1, np.where(same_value, 2, 0)) * two_cards
+        total_ind = (total >= 21).astype(np.int64) + (total > 21)
+
+        masks = self.move_table[
+            two_cards.astype(np.int64),
+            pair,
+            (self.n_hands > 1).astype(np.int64),
+            self.aces_split.astype(np.int64),
+            total_ind,
+        ]
+        masks = np.where(self.n_hands >= self.max_hands, masks & ~SPLIT_BIT, masks)
+        masks[self.done] = 0
+        return masks
+
+    def valid_action_mask(self) -> np.ndarray:
+        """(N, len(moves)) boolean version of valid_action_bitmask()"""
+        masks = self.valid_action_bitmask()
+        return ((masks[:, None] >> np.arange(len(moves))) & 1).astype(bool)
+
+    def step(self, actions: np.ndarray) -> None:
+        """
+        Applies actions (index of constants.moves) to the current hand of each
+        table. Actions for tables that are already done are ignored.
+        """
+        actions = np.asarray(actions)
+        active = ~self.done
+        i_hand = self.i_hand
+        mask = self.valid_action_mask()
+        assert mask[self.rows[active], actions[active]].all(), "invalid action given"
+
+        rows = (active & (actions == STAY)).nonzero()[0]
+        self.complete[rows, i_hand[rows]] = True
+
+        rows = (active & (actions == SURRENDER)).nonzero()[0]
+        self.surrendered[rows] = True
+        self.complete[rows, i_hand[rows]] = True
+
+        rows = (active & (actions == HIT)).nonzero()[0]
+        if len(rows):
+            hands = i_hand[rows]
+            self._deal_player(rows, hands)
+            total, _ = self._total(self.hard[rows, hands], self.aces[rows, hands])
+            self.complete[rows, hands] = total >= 21
+
+        rows = (active & (actions == DOUBLE)).nonzero()[0]
+        if len(rows):
+            hands = i_hand[rows]
+            self.wager[rows, hands] *= 2
+            self._deal_player(rows, hands)
+            self.complete[rows, hands] = True
+
+        rows = (active & (actions == SPLIT)).nonzero()[0]
+        if len(rows):
+            self._split(rows, i_hand[rows])
+
+    def _split(self, rows: np.ndarray, hands: np.ndarray) -> None:
+        rank0 = self.rank0[rows, hands]
+        rank1 = self.rank1[rows, hands]
+        self.aces_split[rows] = (rank0 == ACE) & (rank1 == ACE)
+
+        # shift every hand after the split hand to the right by 1, the new hand
+        # is inserted directly after the split hand (same as Player._split).
+        cols = np.arange(self.max_hands)
+        src = cols[None, :] - (cols[None, :] > (hands + 1)[:, None])
+        for arr in [
+            self.hard, self.aces, self.n_cards, self.rank0,
+            self.rank1, self.wager, self.complete,
+        ]:
+            arr[rows] = np.take_along_axis(arr[rows], src, axis=1)
+
+        new_hands = hands + 1
+        for hand, rank in [(hands, rank0), (new_hands, rank1)]:
+            self.hard[rows, hand] = RANK_VALUES[rank]
+            self.aces[rows, hand] = rank == ACE
+            self.n_cards[rows, hand] = 1
+            self.rank0[rows, hand] = rank
+            self.rank1[rows, hand] = -1
+            self.complete[rows, hand] = False
+        self.wager[rows, new_hands] = self.base_wager[rows]
+        self.n_hands[rows] += 1
+
+        for hand in [hands, new_hands]:
+            ranks = self._deal_player(rows, hand)
+            total, _ = self._total(self.hard[rows, hand], self.aces[rows, hand])
+            complete = total == 21
+            if not self.rules.hit_after_split_aces:
+                complete |= self.aces_split[rows] & (ranks != ACE)
+            self.complete[rows, hand] = complete
+
+    def _house_done(self) -> np.ndarray:
+        total, useable_ace = self._total(self.house_hard, self.house_aces)
+        hits = (total < 17) | (
+            (total == 17) & useable_ace & self.rules.dealer_hit_soft17
+        )
+        return ~hits
+
+    def settle(self) -> np.ndarray:
+        """
+        Flips the hole card, plays out the house on every table, and returns
+        the winnings per table (summed over split hands). Winnings per hand are
+        stored in self.winnings.
+        """
+        assert self.done.all(), "all players must be done before settling"
+
+        if self.shrink_deck:
+            self.count += self.count_weights[self.house_hole]
+        self.hole_revealed[:] = True
+
+        needs_card = ~self._house_done()
+        while needs_card.any():
+            self._deal_house(needs_card.nonzero()[0])
+            needs_card = ~self._house_done()
+
+        self.reshuffle = self.shrink_deck & (self.cursor >= self.cut_index)
+
+        blackjack_payout = 1.2 if self.rules.reduced_blackjack_payout else 1.5
+
+        house_total, _ = self._total(self.house_hard, self.house_aces)
+        house_total = house_total[:, None]
+        house_blackjack = self.house_blackjack[:, None]
+        push_22 = self.rules.push_dealer22 & (house_total == 22)
+
+        val, _ = self._total(self.hard, self.aces)
+        wager = self.wager
+        exists = np.arange(self.max_hands)[None, :] < self.n_hands[:, None]
+        is_blackjack = (val == 21) & (self.n_cards == 2) & (self.n_hands == 1)[:, None]
+
+        # loss by default, each condition below overrides it.
+        winnings = -wager
+        # house bust
+        winnings = np.where(
+            (val <= 21) & (house_total > 21), np.where(push_22, 0, wager), winnings
+        )
+        # neither bust
+        under = (val <= 21) & (house_total <= 21)
+        winnings = np.where(under & (val > house_total), wager, winnings)
+        winnings = np.where(under & (val == house_total), 0, winnings)
+        # blackjacks
+        winnings = np.where((val <= 21) & house_blackjack, -wager, winnings)
+        winnings = np.where(
+            is_blackjack,
+            np.where(house_blackjack, 0, wager * blackjack_payout),
+            winnings,
+        )
+        winnings = np.where(exists, winnings, 0)
+        winnings[self.surrendered] = 0
+        winnings[self.surrendered, 0] = -self.base_wager[self.surrendered] / 2
+
+        self.winnings = winnings.astype(np.float32)
+        return self.winnings.sum(axis=1)
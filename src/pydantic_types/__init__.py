@@ -10,6 +10,19 @@ class StateActionPairI(BaseModel):
     move: str
 
 
+class StateActionPairDeep(BaseModel):
+    player_show: int
+    house_show: int
+    useable_ace: bool
+    can_split: bool
+    can_double: bool
+    move: str
+
+
+class StateActionPairDeepCount(StateActionPairDeep):
+    count: float
+
+
 class ReplayBufferI(BaseModel):
     obs: tuple
     action_space: List[str]
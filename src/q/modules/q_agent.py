@@ -1,12 +1,19 @@
+from concurrent.futures import Future
 from copy import deepcopy
 from dataclasses import dataclass, field
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 
+from src.exact.evaluation import evaluate_policy_exact
 from src.modules.game import Game
+from src.pydantic_types import RulesI
+from src.constants import moves
+from src.q.modules.q_table import MOVE_INDEX, QTable
 from src.q.utils.create_q_dict import init_q
 from src.q.utils.evaluation import (compare_to_accepted, mean_cum_rewards,
                                     q_value_assessment)
-from src.q.utils.runner import play_n_games, select_action
+from src.q.utils.runner import (action_probabilities, evaluate_streaming,
+                                play_n_games)
+from src.utils.background_eval import BackgroundEvaluator, EvalResult
 
 '''
 I'll use this to learn the Q function
@@ -23,10 +30,23 @@ class QAgent:
     learning_rate: float = 0.01
     counter: int = 0
     moves_blacklist: List[str] = field(default_factory=list)
+    # if rules are passed, the baseline is the exact strategy for them,
+    # rather than the accepted chart.
+    rules: Optional[RulesI] = None
+    n_decks: Optional[int] = None
 
     def __post_init__(self):
-        self.q = init_q(moves_blacklist=self.moves_blacklist)
-        self.accepted_q = init_q(mode="accepted")
+        # dense array backed, but still usable as an init_q() dict.
+        self.q = QTable.from_dict(init_q(moves_blacklist=self.moves_blacklist))
+        if self.rules is None:
+            self.accepted_q = init_q(mode="accepted")
+        else:
+            self.accepted_q = init_q(
+                mode="exact",
+                rules=self.rules,
+                n_decks=self.n_decks,
+                moves_blacklist=self.moves_blacklist,
+            )
 
     def update_lr(self, lr):
         self.learning_rate = lr
@@ -41,9 +61,12 @@ class QAgent:
             reward: float,
             max_q_next: float) -> None:
 
-        old_q = self.q[state]
-        old_q[action] = old_q[action] + self.learning_rate *\
-            (reward + self.gamma * max_q_next - old_q[action])
+        self.q.update(
+            state=state,
+            action=MOVE_INDEX[action],
+            target=reward + self.gamma * max_q_next,
+            learning_rate=self.learning_rate,
+        )
 
     def learn(self, game: Game):
         '''
@@ -71,36 +94,39 @@ class QAgent:
 
         while not player.is_done():
             player_total, useable_ace = player.get_value()
-            policy = player.get_valid_moves()
+            policy = player.get_valid_moves_mask()
             i_hand = player.i_hand
 
             state = (player_total, house_value, useable_ace)
-            q_dict = self.q[state]
-            move = select_action(
-                state=q_dict,
-                policy=policy,
-                epsilon=self.epsilon,
-                method=self.selection_criteria,
-            )
+            move = moves[
+                self.q.select(
+                    state=state,
+                    mask=policy,
+                    epsilon=self.epsilon,
+                    method=self.selection_criteria,
+                )
+            ]
+
+            propensity = float("nan")
+            if game.recorder is not None:
+                propensity = action_probabilities(
+                    state=self.q[state],
+                    policy=policy,
+                    epsilon=self.epsilon,
+                    method=self.selection_criteria,
+                )[move]
 
-            game.step_player(player_ind, move)
+            game.step_player(player_ind, move, propensity)
 
             if not player.complete[i_hand]:
                 # If there is a next state, get the info from it.
                 player_total_next, useable_ace_next = player.get_value()
-                policy_next = player.get_valid_moves()
+                policy_next = player.get_valid_moves_mask()
 
                 state_next = (player_total_next, house_value, useable_ace_next)
 
-                # get best next move, which will allow us to get q_max
-                q_dict = self.q[state_next]
-                move_next = select_action(
-                    state=q_dict,
-                    policy=policy_next,
-                    epsilon=-1,
-                    method="epsilon",
-                )
-                max_q_next = self.q[state_next][move_next]
+                # q value of the best next move
+                max_q_next = self.q.max(state=state_next, mask=policy_next)
 
                 self.update_q(
                     state=state,
@@ -140,26 +166,123 @@ class QAgent:
 
         self.counter += 1
 
-    async def evaluate(self, n_rounds: int, n_games: int, game_hyperparams: object):
-        rewards = await play_n_games(
+    async def evaluate(
+        self,
+        n_rounds: int,
+        n_games: int,
+        game_hyperparams: object,
+        exact: bool = False,
+        executor: str = "serial",
+        n_workers: Optional[int] = None,
+        seed: Optional[int] = None,
+        half_width: Optional[float] = None,
+        time_budget: Optional[float] = None,
+    ):
+        """
+        if exact, mean_reward is the exact expected return per round, rather than
+        the average over n_games x n_rounds simulated rounds.
+        if half_width or time_budget is passed, games of n_rounds are only played
+        until the 95% CI of the mean reward is within +/- half_width, or time_budget
+        seconds have passed (at most n_games of them).
+        executor, n_workers and seed are passed to src.utils.executor.
+        """
+        return await evaluate_q(
             q=self.q,
-            wagers=[1],
+            accepted_q=self.accepted_q,
             n_rounds=n_rounds,
             n_games=n_games,
             game_hyperparams=game_hyperparams,
+            exact=exact,
+            executor=executor,
+            n_workers=n_workers,
+            seed=seed,
+            half_width=half_width,
+            time_budget=time_budget,
         )
-        mean_reward = mean_cum_rewards(rewards)[0]
 
-        percent_correct_baseline = compare_to_accepted(
-            q=self.q,
+    def evaluate_async(
+        self,
+        evaluator: BackgroundEvaluator,
+        step: int,
+        callback: Optional[Callable[[EvalResult], None]] = None,
+        **evaluate_kwargs,
+    ) -> "Future[EvalResult]":
+        """
+        evaluate() of a snapshot of the Q table, in a background process, while
+        learning continues. evaluate_kwargs are those of evaluate().
+        Returns a future of the EvalResult
+        (mean_reward, percent_correct_baseline, avg_max_q), tagged with step.
+        """
+        return evaluator.submit(
+            step,
+            evaluate_q,
+            callback=callback,
+            q=deepcopy(self.q),
             accepted_q=self.accepted_q,
+            **evaluate_kwargs,
         )
 
-        avg_max_q = q_value_assessment(
-            q=self.q, game_hyperparams=game_hyperparams, n_rounds=n_rounds
+    def get_q(self):
+        """plain init_q() dict copy of the Q table"""
+        return self.q.to_dict()
+
+
+async def evaluate_q(
+    q: QTable,
+    accepted_q: dict,
+    n_rounds: int,
+    n_games: int,
+    game_hyperparams: object,
+    exact: bool = False,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    half_width: Optional[float] = None,
+    time_budget: Optional[float] = None,
+):
+    """see QAgent.evaluate()"""
+    if exact:
+        # without shrinking the deck, cards are drawn iid, ie an infinite deck.
+        shrink_deck = game_hyperparams.get("shrink_deck", True)
+        mean_reward, _ = evaluate_policy_exact(
+            q=q,
+            rules=game_hyperparams.get("rules", {}),
+            n_decks=game_hyperparams.get("n_decks", 6) if shrink_deck else None,
         )
+    elif (half_width is not None) or (time_budget is not None):
+        summary = await evaluate_streaming(
+            q=q,
+            wagers=[1],
+            game_hyperparams=game_hyperparams,
+            half_width=half_width,
+            time_budget=time_budget,
+            max_rounds=n_rounds * n_games,
+            chunk_rounds=n_rounds,
+            executor=executor,
+            n_workers=n_workers,
+            seed=seed,
+        )
+        mean_reward = summary.mean[0]
+    else:
+        rewards = await play_n_games(
+            q=q,
+            wagers=[1],
+            n_rounds=n_rounds,
+            n_games=n_games,
+            game_hyperparams=game_hyperparams,
+            executor=executor,
+            n_workers=n_workers,
+            seed=seed,
+        )
+        mean_reward = mean_cum_rewards(rewards)[0]
 
-        return mean_reward, percent_correct_baseline, avg_max_q
+    percent_correct_baseline = compare_to_accepted(
+        q=q,
+        accepted_q=accepted_q,
+    )
 
-    def get_q(self):
-        return deepcopy(self.q)
+    avg_max_q = q_value_assessment(
+        q=q, game_hyperparams=game_hyperparams, n_rounds=n_rounds
+    )
+
+    return mean_reward, percent_correct_baseline, avg_max_q
@@ -0,0 +1,173 @@
+from collections.abc import Mapping, MutableMapping
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from src.constants import moves
+from src.modules.actions import invalid_move_table
+
+"""
+Dense Q table.
+
+values[player_total, house_value, useable_ace, action] is a float32 array, with
+actions indexed like constants.moves, so bit i of a valid move mask (see
+src.modules.actions) is column i. Updates and greedy lookups are plain array
+indexing, rather than hashing tuples and building filtered dicts: a decision is a
+masked max / argmax over its row, with the valid moves of every mask precomputed,
+and the RNG is only drawn from to break ties (or explore).
+
+QTable is still a Mapping of (player_total, house_value, useable_ace) -> row, where
+each row (QRow) is a mutable view of move -> value over the array, so code written
+against init_q() dicts (generate_grid, compare_to_accepted, ...) works as is.
+Rows iterate moves in the init_q() order.
+"""
+
+# move order of init_q() dicts
+Q_MOVES = ["stay", "hit", "split", "double", "surrender"]
+
+MOVE_INDEX = {move: i for i, move in enumerate(moves)}
+
+
+def q_states() -> List[Tuple[int, int, bool]]:
+    """every (player_total, house_value, useable_ace) key of init_q()"""
+    states = []
+    for p in range(4, 22):
+        ace_arr = [False]
+        if 11 < p < 21:
+            ace_arr.append(True)
+        for h in range(2, 12):
+            for ace in ace_arr:
+                states.append((p, h, ace))
+    return states
+
+
+class QRow(MutableMapping):
+    """move -> value view of a single state of a QTable"""
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: "QTable", row: np.ndarray):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, move: str) -> float:
+        if move not in self.table.moves:
+            raise KeyError(move)
+        return float(self.row[MOVE_INDEX[move]])
+
+    def __setitem__(self, move: str, value: float) -> None:
+        if move not in self.table.moves:
+            raise KeyError(move)
+        self.row[MOVE_INDEX[move]] = value
+
+    def __delitem__(self, move: str) -> None:
+        raise Exception("can't remove moves from a QTable")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.table.moves)
+
+    def __len__(self) -> int:
+        return len(self.table.moves)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+    def select(self, mask: int, epsilon: float, method: str) -> str:
+        return moves[self.table._select(self.row, mask, epsilon, method)]
+
+    def max(self, mask: int) -> float:
+        return self.table._max(self.row, mask)
+
+
+class QTable(Mapping):
+    def __init__(self, moves_blacklist: List[str] = [], fill: float = -1):
+        self.moves = [m for m in Q_MOVES if m not in moves_blacklist]
+        # action indices, in the init_q() order, for tie breaking like select_action()
+        self.order = np.array([MOVE_INDEX[m] for m in self.moves])
+        # [mask, action] -> whether the action is a valid move of the table
+        valid_moves = ~invalid_move_table(moves)
+        valid_moves[:, ~np.isin(moves, self.moves)] = False
+        # [mask, k] -> whether self.order[k] is valid
+        self.valid_ordered = valid_moves[:, self.order]
+        # [mask, action] -> 0 if valid, else -inf, added to a row to mask it
+        self.mask_offsets = np.where(valid_moves, 0, -np.inf).astype(np.float32)
+
+        self.states = q_states()
+        self.valid = np.zeros((22, 12, 2), dtype=bool)
+        for p, h, ace in self.states:
+            self.valid[p, h, int(ace)] = True
+
+        self.values = np.full((22, 12, 2, len(moves)), np.nan, dtype=np.float32)
+        self.values[self.valid] = fill
+
+    @classmethod
+    def from_dict(cls, q: Dict[Tuple[int, int, bool], Dict[str, float]]) -> "QTable":
+        moves_blacklist = [m for m in Q_MOVES if m not in next(iter(q.values()))]
+        table = cls(moves_blacklist=moves_blacklist)
+        for (p, h, ace), vals in q.items():
+            for move, value in vals.items():
+                table.values[p, h, int(ace), MOVE_INDEX[move]] = value
+        return table
+
+    def to_dict(self) -> Dict[Tuple[int, int, bool], Dict[str, float]]:
+        return {state: dict(self[state]) for state in self.states}
+
+    def __getitem__(self, state: Tuple[int, int, bool]) -> QRow:
+        p, h, ace = state
+        if not ((0 <= p < 22) and (0 <= h < 12) and self.valid[p, h, int(ace)]):
+            raise KeyError(state)
+        return QRow(self, self.values[p, h, int(ace)])
+
+    def __iter__(self) -> Iterator[Tuple[int, int, bool]]:
+        return iter(self.states)
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def _select(self, row: np.ndarray, mask: int, epsilon: float, method: str) -> int:
+        """mirrors select_action(), over a row of values"""
+        assert method in ["epsilon", "thompson"], "invalid method selected"
+
+        if method == "thompson":
+            candidates = self.order[self.valid_ordered[mask]]
+            exp = np.exp(row[candidates].astype(np.float64))
+            p = exp / exp.sum()
+            return int(candidates[np.random.choice(len(candidates), p=p)])
+
+        if np.random.rand() < epsilon:
+            candidates = self.order[self.valid_ordered[mask]]
+            return int(candidates[np.random.randint(len(candidates))])
+        masked = row + self.mask_offsets[mask]
+        best = masked.argmax()
+        # first and last best moves differ: multiple "best" moves, sample from them
+        # (in the init_q() order).
+        if best != len(masked) - 1 - masked[::-1].argmax():
+            ties = self.order[masked[self.order] == masked[best]]
+            best = ties[np.random.randint(len(ties))]
+        return int(best)
+
+    def _max(self, row: np.ndarray, mask: int) -> float:
+        masked = row + self.mask_offsets[mask]
+        return float(masked[masked.argmax()])
+
+    def select(
+        self, state: Tuple[int, int, bool], mask: int, epsilon: float, method: str
+    ) -> int:
+        """action index (into constants.moves) for a state + valid move mask"""
+        p, h, ace = state
+        return self._select(self.values[p, h, int(ace)], mask, epsilon, method)
+
+    def max(self, state: Tuple[int, int, bool], mask: int) -> float:
+        """maximum value over the valid moves of a state"""
+        p, h, ace = state
+        return self._max(self.values[p, h, int(ace)], mask)
+
+    def update(
+        self,
+        state: Tuple[int, int, bool],
+        action: int,
+        target: float,
+        learning_rate: float,
+    ) -> None:
+        ind = (state[0], state[1], int(state[2]), action)
+        self.values[ind] += learning_rate * (target - self.values[ind])
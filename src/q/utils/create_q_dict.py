@@ -1,8 +1,16 @@
 from copy import deepcopy
 from typing import List, Optional
 
+from src.exact.solver import solve_q
+from src.pydantic_types import RulesI
 
-def init_q(moves_blacklist: List[str] = [], mode: Optional[str] = None) -> object:
+
+def init_q(
+    moves_blacklist: List[str] = [],
+    mode: Optional[str] = None,
+    rules: RulesI = {},
+    n_decks: Optional[int] = None,
+) -> object:
     """
     Initialize the Q value object.
     I've gone back and forth about how to structure this.
@@ -21,7 +29,12 @@ def init_q(moves_blacklist: List[str] = [], mode: Optional[str] = None) -> objec
     will severely limit the number of occurrences in states where can_split=True,
     and we will not take advantage of the knowledge gained from states where
     player_total and house_value are the same, but with can_split = False.
+
+    mode="exact" returns the exact EV of each move (see src.exact.solver) for the
+    given rules and n_decks (None is an infinite deck).
     """
+    if mode == "exact":
+        return solve_q(rules=rules, n_decks=n_decks, moves_blacklist=moves_blacklist)
 
     moves = ["stay", "hit", "split", "double", "surrender"]
     moves = [m for m in moves if m not in moves_blacklist]
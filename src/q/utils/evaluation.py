@@ -1,19 +1,21 @@
-import asyncio
-from typing import List
+from statistics import NormalDist
+from typing import List, Optional, Tuple
 
 import numpy as np
 
 from src.modules.game import Game
 from src.modules.player import Player
+from src.q.utils.policy import CompiledPolicy, compile_policy
 from src.q.utils.plotting import generate_grid
-from src.q.utils.runner import play_round, select_action
+from src.q.utils.runner import play_n_games, play_round
+from src.utils.executor import run_tasks
 
 
 def cummulative_rewards_per_round(
     rewards_games: List[List[List[float]]],
 ) -> np.ndarray:
-    n_rounds = np.array(rewards_games).shape[-1]
-    return np.cumsum(rewards_games, axis=2)[:, :, -1] / n_rounds
+    rewards_games = np.asarray(rewards_games)
+    return rewards_games.sum(axis=2) / rewards_games.shape[-1]
 
 
 def mean_cum_rewards(rewards_games: List[List[List[float]]]) -> np.ndarray:
@@ -26,10 +28,65 @@ def median_cum_rewards(rewards_games: List[List[List[float]]]) -> np.ndarray:
     return np.median(cummed, axis=0)
 
 
+async def evaluate_paired_difference(
+    q_a: object,
+    q_b: object,
+    n_rounds: int,
+    n_games: int,
+    game_hyperparams: object,
+    shoe_seed: int = 0,
+    confidence: float = 0.95,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+) -> dict:
+    """
+    Plays both policies against the exact same shoes (common random numbers), and
+    reports the difference in mean reward per round (q_a - q_b).
+
+    Rewards of both policies are strongly correlated round by round, so the
+    standard error of the paired difference is much smaller than if both were
+    evaluated on independent shoes ("std_error_unpaired", for reference).
+    """
+    rewards = []
+    for q in [q_a, q_b]:
+        r = await play_n_games(
+            q=q,
+            wagers=[1],
+            n_rounds=n_rounds,
+            n_games=n_games,
+            game_hyperparams=game_hyperparams,
+            executor=executor,
+            n_workers=n_workers,
+            shoe_seed=shoe_seed,
+        )
+        rewards.append(r[:, 0, :].ravel())
+    rewards_a, rewards_b = rewards
+
+    n = len(rewards_a)
+    diff = rewards_a - rewards_b
+    std_error = diff.std(ddof=1) / np.sqrt(n)
+    std_error_unpaired = np.sqrt(
+        (rewards_a.var(ddof=1) + rewards_b.var(ddof=1)) / n
+    )
+    half_width = NormalDist().inv_cdf((1 + confidence) / 2) * std_error
+
+    return {
+        "diff": diff.mean(),
+        "std_error": std_error,
+        "ci": (diff.mean() - half_width, diff.mean() + half_width),
+        "mean_a": rewards_a.mean(),
+        "mean_b": rewards_b.mean(),
+        "std_error_unpaired": std_error_unpaired,
+        "n_rounds": n,
+    }
+
+
 def q_value_assessment(q: dict, game_hyperparams: object, n_rounds: int):
     """assessment of average maximum q value, for convergence"""
 
     game = Game(**game_hyperparams)
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
 
     max_q_values = []
 
@@ -43,17 +100,14 @@ def q_value_assessment(q: dict, game_hyperparams: object, n_rounds: int):
             player = game.players[i]
             while not player.is_done():
                 player_show, useable_ace = player.get_value()
-                policy = player.get_valid_moves()
+                policy = player.get_valid_moves_mask()
 
-                state = q[(player_show, house_value, useable_ace)]
+                state = (player_show, house_value, useable_ace)
 
                 # Add the maximum possible q value given the policy.
-                q_dict = {k: v for k, v in state.items() if k in policy}
-                max_q_values.append(max(q_dict.values()))
+                max_q_values.append(q.max(state, policy, game.true_count))
 
-                move = select_action(
-                    state=state, policy=policy, epsilon=-1, method="epsilon"
-                )
+                move = q.select(state, policy, game.true_count)
 
                 game.step_player(i, move)
 
@@ -101,16 +155,19 @@ def compare_to_accepted(q: dict, accepted_q: dict):
     return correct_moves
 
 
-async def play_until_bankroll(
+def run_until_bankroll(
     q: object,
     wager: float,
     bankroll: float,
     max_rounds: int,
     game_hyperparams: object,
-):
+) -> Tuple[int, int, float]:
+    """synchronous play_until_bankroll(), module level so it can go to a process pool"""  # noqa: E501
     assert max_rounds <= 1_000, "use a valid max_rounds <= 1,000"
 
     game = Game(**game_hyperparams)
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
 
     n_rounds = 0
     n_rounds_profitable = 0
@@ -127,29 +184,44 @@ async def play_until_bankroll(
     return n_rounds, n_rounds_profitable, profits
 
 
-async def play_games_bankroll(
+async def play_until_bankroll(
     q: object,
     wager: float,
     bankroll: float,
     max_rounds: int,
-    n_games: int,
     game_hyperparams: object,
 ):
-    tasks = []
-    for _ in range(n_games):
-        tasks.append(
-            asyncio.create_task(
-                play_until_bankroll(q, wager, bankroll, max_rounds, game_hyperparams)
-            )
-        )
+    return run_until_bankroll(q, wager, bankroll, max_rounds, game_hyperparams)
 
-    res = await asyncio.gather(*tasks)
 
-    rounds = [r[0] for r in res]
-    profitable = [r[1] for r in res]
-    profits = [r[2] for r in res]
+async def play_games_bankroll(
+    q: object,
+    wager: float,
+    bankroll: float,
+    max_rounds: int,
+    n_games: int,
+    game_hyperparams: object,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+):
+    """
+    returns arrays of (n_games,) rounds lasted, rounds profitable, profits.
+    Games are dispatched with src.utils.executor.
+    """
+    rounds, profitable, profits = await play_games_bankrolls(
+        q=q,
+        wager=wager,
+        max_rounds=max_rounds,
+        n_games=n_games,
+        bankrolls=[bankroll],
+        game_hyperparams=game_hyperparams,
+        executor=executor,
+        n_workers=n_workers,
+        seed=seed,
+    )
 
-    return rounds, profitable, profits
+    return rounds[0], profitable[0], profits[0]
 
 
 async def play_games_bankrolls(
@@ -159,27 +231,38 @@ async def play_games_bankrolls(
     n_games: int,
     bankrolls: List[float],
     game_hyperparams: object,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
 ):
-    tasks = []
-    for bankroll in bankrolls:
-        tasks.append(
-            asyncio.create_task(
-                play_games_bankroll(
-                    q, wager, bankroll, max_rounds, n_games, game_hyperparams
-                )
-            )
-        )
-
-    res = await asyncio.gather(*tasks)
-
-    rounds = [r[0] for r in res]
-    profitable = [r[1] for r in res]
-    profits = [r[2] for r in res]
+    """
+    returns arrays of (n_bankrolls, n_games) rounds lasted, rounds profitable, profits.
+    Games of every bankroll are dispatched together with src.utils.executor.
+    """
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
+
+    tasks = [
+        (q, wager, bankroll, max_rounds, game_hyperparams)
+        for bankroll in bankrolls
+        for _ in range(n_games)
+    ]
+    res = await run_tasks(
+        run_until_bankroll, tasks, executor=executor, n_workers=n_workers, seed=seed
+    )
+    res = np.array(res, dtype=np.float64).reshape(len(bankrolls), n_games, 3)
+
+    rounds = res[..., 0].astype(np.int64)
+    profitable = res[..., 1].astype(np.int64)
+    profits = res[..., 2]
 
     return rounds, profitable, profits
 
 
 def assess_static_outcomes(game: Game, q: object, n_rounds: int):
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
+
     results = {}
     busts = {}
     player_results = {"soft": {}, "hard": {}}
@@ -214,14 +297,10 @@ def assess_static_outcomes(game: Game, q: object, n_rounds: int):
         while not player.is_done():
             player_show, useable_ace = player.get_value()
 
-            policy = player.get_valid_moves()
-            policy = [p for p in policy if p != "insurance"]
+            policy = player.get_valid_moves_mask()
 
-            move = select_action(
-                q[(player_show, house_value, useable_ace)],
-                policy,
-                -1,
-                "epsilon",
+            move = q.select(
+                (player_show, house_value, useable_ace), policy, game.true_count
             )
 
             game.step_player(0, move)
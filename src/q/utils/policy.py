@@ -0,0 +1,185 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+
+from src.constants import moves
+from src.modules.actions import MOVE_BITS
+from src.q.modules.q_table import QTable
+
+"""
+Greedy policy of a Q table, compiled into lookup tables.
+
+For every (player_total, house_value, useable_ace) state and every valid move mask
+(see src.modules.actions), the greedy move is computed once, so gameplay only does
+an array lookup per decision rather than filtering a Q dict and sampling ties.
+
+Tied best moves are kept, and sampled at every decision (like select_action), so
+the compiled policy plays the same as the Q dict. With a seed, ties are sampled
+once per (state, mask) instead, which gives a deterministic policy.
+
+policy_probabilities() tabulates the full (stochastic) action distribution instead,
+for off-policy evaluation (see src.utils.off_policy).
+"""
+
+
+@dataclass
+class CompiledPolicy:
+    # [player_total, house_value, useable_ace, mask] -> index into constants.moves,
+    # -1 if no move of the Q table is valid.
+    actions: np.ndarray
+    # [player_total, house_value, useable_ace, mask] -> q value of that move.
+    max_values: np.ndarray
+    # edges between true count buckets, None if the policy ignores the count.
+    # Otherwise actions / max_values have a leading bucket axis (len(count_bins) + 1).
+    count_bins: Optional[np.ndarray] = None
+    # [..., mask, action] -> True for each of the tied best moves, None if the
+    # policy is deterministic. actions holds the first of them.
+    ties: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        self._bins = None if self.count_bins is None else list(self.count_bins)
+        # number of best moves, > 1 where a decision samples from ties
+        self._n_best = None if self.ties is None else self.ties.sum(axis=-1)
+
+    def _index(self, state: Tuple[int, int, bool], mask: int, true_count: float):
+        ind = (state[0], state[1], int(state[2]), mask)
+        if self._bins is None:
+            return ind
+        return (bisect_left(self._bins, true_count),) + ind
+
+    def action(
+        self, state: Tuple[int, int, bool], mask: int, true_count: float = 0
+    ) -> int:
+        ind = self._index(state, mask, true_count)
+        if self._n_best is not None and self._n_best[ind] > 1:
+            return int(np.random.choice(np.flatnonzero(self.ties[ind])))
+        return int(self.actions[ind])
+
+    def n_best(
+        self, state: Tuple[int, int, bool], mask: int, true_count: float = 0
+    ) -> int:
+        """number of moves action() picks from (uniformly), 0 if none is valid"""
+        ind = self._index(state, mask, true_count)
+        if self._n_best is not None and self._n_best[ind] > 1:
+            return int(self._n_best[ind])
+        return int(self.actions[ind] >= 0)
+
+    def select(
+        self, state: Tuple[int, int, bool], mask: int, true_count: float = 0
+    ) -> str:
+        action = self.action(state, mask, true_count)
+        if action < 0:
+            raise Exception("no valid moves for the policy")
+        return moves[action]
+
+    def max(
+        self, state: Tuple[int, int, bool], mask: int, true_count: float = 0
+    ) -> float:
+        return float(self.max_values[self._index(state, mask, true_count)])
+
+    def save(self, path: str) -> None:
+        """.npz of the tables, loading it back only needs numpy"""
+        np.savez(
+            path,
+            actions=self.actions,
+            max_values=self.max_values,
+            count_bins=np.array([]) if self.count_bins is None else self.count_bins,
+            ties=np.array([]) if self.ties is None else self.ties,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledPolicy":
+        with np.load(path) as data:
+            count_bins = data["count_bins"]
+            ties = data["ties"] if "ties" in data else np.array([])
+            return cls(
+                actions=data["actions"],
+                max_values=data["max_values"],
+                count_bins=count_bins if len(count_bins) else None,
+                ties=ties if len(ties) else None,
+            )
+
+
+def compile_policy(q: object, seed: Optional[int] = None) -> CompiledPolicy:
+    """
+    q is an init_q() dict or a QTable.
+    seed : None keeps tied moves, sampled at every decision, otherwise each tie is
+        sampled once with the seed.
+    """
+    rng = None if seed is None else np.random.default_rng(seed)
+
+    actions = np.full((22, 12, 2, 32), -1, dtype=np.int8)
+    max_values = np.full((22, 12, 2, 32), np.nan, dtype=np.float32)
+    ties = np.zeros((22, 12, 2, 32, len(moves)), dtype=bool)
+
+    for (p, h, ace), vals in q.items():
+        items = list(vals.items())
+        for mask in range(32):
+            valid = [(k, v) for k, v in items if mask & MOVE_BITS[k]]
+            if not valid:
+                continue
+            best = max(v for _, v in valid)
+            best_moves = [k for k, v in valid if v == best]
+            if rng is None or len(best_moves) == 1:
+                move = best_moves[0]
+            else:
+                move = best_moves[rng.integers(len(best_moves))]
+            actions[p, h, int(ace), mask] = moves.index(move)
+            max_values[p, h, int(ace), mask] = best
+            if rng is None and len(best_moves) > 1:
+                ties[p, h, int(ace), mask, [moves.index(k) for k in best_moves]] = True
+
+    actions.setflags(write=False)
+    max_values.setflags(write=False)
+    ties.setflags(write=False)
+    return CompiledPolicy(
+        actions=actions, max_values=max_values, ties=ties if ties.any() else None
+    )
+
+
+def policy_probabilities(
+    q: object, epsilon: float = -1, method: str = "epsilon"
+) -> np.ndarray:
+    """
+    [player_total, house_value, useable_ace, mask, action] -> probability of the
+    action (index into constants.moves), all 0 where no move is valid.
+
+    q is an init_q() dict or QTable, played like select_action(q[state], mask,
+    epsilon, method), or a CompiledPolicy (uniform over its tied moves).
+    """
+    bits = (np.arange(32)[:, None] >> np.arange(len(moves))) & 1 == 1
+
+    if isinstance(q, CompiledPolicy):
+        assert q.count_bins is None, "count policies need a callable, over true_count"
+        actions = q.actions.astype(np.int64)
+        probs = (actions[..., None] == np.arange(len(moves))).astype(np.float64)
+        if q.ties is not None:
+            n_best = q.ties.sum(axis=-1, keepdims=True)
+            probs = np.where(n_best > 1, q.ties / np.maximum(n_best, 1), probs)
+        return probs
+
+    assert method in ["epsilon", "thompson"], "invalid method selected"
+    if not isinstance(q, QTable):
+        q = QTable.from_dict(q)
+
+    # (22, 12, 2, 32, n_moves)
+    values = np.broadcast_to(
+        q.values[:, :, :, None, :].astype(np.float64), (22, 12, 2, 32, len(moves))
+    )
+    valid = bits & ~np.isnan(values)
+    n_valid = valid.sum(axis=-1, keepdims=True)
+    values = np.where(valid, values, -np.inf)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if method == "thompson":
+            exp = np.exp(values - values.max(axis=-1, keepdims=True))
+            probs = exp / exp.sum(axis=-1, keepdims=True)
+        else:
+            epsilon = max(epsilon, 0)
+            best = valid & (values == values.max(axis=-1, keepdims=True))
+            probs = epsilon * valid / n_valid + (1 - epsilon) * best / best.sum(
+                axis=-1, keepdims=True
+            )
+    return np.where(n_valid > 0, probs, 0.0)
@@ -1,25 +1,41 @@
-import asyncio
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
+from src.modules.actions import MOVE_BITS
 from src.modules.game import Game
+from src.modules.shoe import ShoeBank
 from src.modules.player import Player
 from src.pydantic_types import QMovesI
+from src.q.modules.q_table import QRow
+from src.q.utils.policy import CompiledPolicy, compile_policy
+from src.utils.executor import run_tasks, spawn_seeds
+from src.utils.stats import EvalSummary, Welford, run_until_precise
 
 
 def select_action(
-    state: QMovesI, policy: List[str], epsilon: float, method: str
+    state: QMovesI, policy: Union[List[str], int], epsilon: float, method: str
 ) -> str:
     """
     Get the best action according to a state, policy, epsilon value, and method.
     - Can use epsilon = -1 to serve as greedy.
     - Can use epsilon = 1 to serve as random.
+    policy is either a list of valid moves, or the bitmask from
+    Player.get_valid_moves_mask().
+    state can also be a row of a QTable, which selects over its array directly.
     """
     assert method in ["epsilon", "thompson"], "invalid method selected"
 
+    if isinstance(state, QRow):
+        if not isinstance(policy, int):
+            policy = sum(MOVE_BITS[k] for k in policy)
+        return state.select(policy, epsilon, method)
+
     # masking of invalid states
-    q_dict = {k: v for k, v in state.items() if k in policy}
+    if isinstance(policy, int):
+        q_dict = {k: v for k, v in state.items() if policy & MOVE_BITS[k]}
+    else:
+        q_dict = {k: v for k, v in state.items() if k in policy}
 
     # softmax
     if method == "thompson":
@@ -43,11 +59,39 @@ def select_action(
     return move
 
 
+def action_probabilities(
+    state: QMovesI, policy: Union[List[str], int], epsilon: float, method: str
+) -> Dict[str, float]:
+    """
+    Probability select_action() gives to each valid move, ie the behavior policy
+    logged with each decision for off-policy evaluation.
+    """
+    assert method in ["epsilon", "thompson"], "invalid method selected"
+
+    if isinstance(policy, int):
+        q_dict = {k: v for k, v in state.items() if policy & MOVE_BITS[k]}
+    else:
+        q_dict = {k: v for k, v in state.items() if k in policy}
+
+    if method == "thompson":
+        exp = np.exp(np.array(list(q_dict.values())))
+        return dict(zip(q_dict.keys(), (exp / exp.sum()).tolist()))
+
+    epsilon = max(epsilon, 0)
+    best = max(q_dict.values())
+    n_best = sum(v == best for v in q_dict.values())
+    return {
+        k: epsilon / len(q_dict) + (1 - epsilon) * (v == best) / n_best
+        for k, v in q_dict.items()
+    }
+
+
 def play_round(
     game: Game, q: object, wagers: List[float], verbose: bool = False
 ) -> Tuple[List[List[str]], List[float]]:
     """
     wagers denotes the wager per player
+    q can be a Q dict / QTable, or a CompiledPolicy (constant time lookups).
 
     returns:
         - players_text: (n_players x 1)
@@ -67,17 +111,27 @@ def play_round(
         move = ""
         while not player.is_done():
             player_show, useable_ace = player.get_value()
-            policy = player.get_valid_moves()
-
-            state = q[(player_show, house_value, useable_ace)]
-
-            move = select_action(
-                state=state, policy=policy, epsilon=-1, method="epsilon"
-            )
+            policy = player.get_valid_moves_mask()
+
+            state = (player_show, house_value, useable_ace)
+
+            propensity = 1.0
+            if isinstance(q, CompiledPolicy):
+                move = q.select(state, policy, game.true_count)
+                if game.recorder is not None:
+                    propensity = 1 / q.n_best(state, policy, game.true_count)
+            else:
+                move = select_action(
+                    state=q[state], policy=policy, epsilon=-1, method="epsilon"
+                )
+                if game.recorder is not None:
+                    propensity = action_probabilities(
+                        state=q[state], policy=policy, epsilon=-1, method="epsilon"
+                    )[move]
             if verbose:
                 print([cards.card for cards in player.cards[0].cards], move)
 
-            game.step_player(i, move)
+            game.step_player(i, move, propensity)
 
     if (verbose) & (move not in ["surrender", "stay"]):
         print([cards.card for cards in player.cards[0].cards])
@@ -107,6 +161,8 @@ def play_n_rounds(
     # noqa: E501
     """
     rewards = [[] for _ in wagers]
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
 
     for i in range(n_rounds):
         _, players_winnings = play_round(game=game, q=q, wagers=wagers)
@@ -118,28 +174,115 @@ def play_n_rounds(
     return rewards
 
 
+def play_game(
+    q: CompiledPolicy,
+    wagers: List[float],
+    n_rounds: int,
+    game_hyperparams: object,
+    shoe_seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    a single game of n_rounds, on a fresh Game. Module level so it can be sent to a process pool.
+    if shoe_seed is passed, shoes come from ShoeBank(shoe_seed).
+    # noqa: E501
+    """
+    shoe_bank = None if shoe_seed is None else ShoeBank(seed=shoe_seed)
+    game = Game(**game_hyperparams, shoe_bank=shoe_bank)
+    return np.array(play_n_rounds(game=game, q=q, wagers=wagers, n_rounds=n_rounds))
+
+
 async def play_n_games(
     q: object,
     wagers: List[float],
     n_rounds: int,
     n_games: int,
     game_hyperparams: object,
-) -> List[List[List[float]]]:
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    shoe_seed: Optional[int] = None,
+) -> np.ndarray:
     """
-    Runs N games of M rounds each, async. Game module is instantiated separately for each game, as they're independent.
+    Runs N games of M rounds each. Game module is instantiated separately for each game, as they're independent.
     I'll assume equal wager per game, per player, per round.
+    Games are dispatched with src.utils.executor (executor = "serial", "thread" or "process").
+    shoe_seed : if passed, game i plays the shoes of a ShoeBank seeded from it, so
+        calls with the same shoe_seed (ie for different policies) see the same cards.
 
     returns:
         - rewards: (n_games x n_players x n_rounds)
     # noqa: E501
     """
 
-    async def task():
-        game = Game(**game_hyperparams)
-        return play_n_rounds(game=game, q=q, wagers=wagers, n_rounds=n_rounds)
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
+
+    shoe_seeds = [None] * n_games
+    if shoe_seed is not None:
+        shoe_seeds = spawn_seeds(n_games, shoe_seed)
+
+    rewards = await run_tasks(
+        play_game,
+        [(q, wagers, n_rounds, game_hyperparams, s) for s in shoe_seeds],
+        executor=executor,
+        n_workers=n_workers,
+        seed=seed,
+    )
+    return np.array(rewards)
 
-    tasks = []
-    for _ in range(n_games):
-        tasks.append(asyncio.create_task(task()))
 
-    return await asyncio.gather(*tasks)
+def play_game_stats(
+    q: CompiledPolicy,
+    wagers: List[float],
+    game_hyperparams: object,
+    bins: Optional[np.ndarray],
+    n_rounds: int,
+) -> Welford:
+    """
+    same as play_game(), but only returns the Welford accumulator of the per round
+    rewards (n_players,), rather than every reward.
+    """
+    game = Game(**game_hyperparams)
+    stats = Welford(n_players=len(wagers), bins=bins)
+    stats.update_batch(
+        np.array(play_n_rounds(game=game, q=q, wagers=wagers, n_rounds=n_rounds)).T
+    )
+    return stats
+
+
+async def evaluate_streaming(
+    q: object,
+    wagers: List[float],
+    game_hyperparams: object,
+    half_width: Optional[float] = None,
+    confidence: float = 0.95,
+    time_budget: Optional[float] = None,
+    max_rounds: int = 1_000_000,
+    chunk_rounds: int = 1_000,
+    bins: Optional[np.ndarray] = None,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> EvalSummary:
+    """
+    Plays games of chunk_rounds until the mean reward per round of every player is
+    known to +/- half_width (at confidence), time_budget seconds have passed, or
+    max_rounds are played. See src.utils.stats.run_until_precise.
+    """
+    if not isinstance(q, CompiledPolicy):
+        q = compile_policy(q)
+
+    return await run_until_precise(
+        play_game_stats,
+        (q, wagers, game_hyperparams, bins),
+        n_players=len(wagers),
+        chunk_rounds=chunk_rounds,
+        half_width=half_width,
+        confidence=confidence,
+        time_budget=time_budget,
+        max_rounds=max_rounds,
+        bins=bins,
+        executor=executor,
+        n_workers=n_workers,
+        seed=seed,
+    )
@@ -0,0 +1,108 @@
+import asyncio
+import inspect
+import multiprocessing as mp
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+
+"""
+Evaluation in a background process, while training keeps going.
+
+BackgroundEvaluator owns a (spawned) process pool. submit(step, fn, **kwargs) sends
+fn and its arguments, ie a snapshot of the network weights / Q table taken at that
+training step, to a worker and returns right away, with a Future of an EvalResult
+tagged with the step. Async evaluation functions (play_games, play_n_games, ...) are
+run with asyncio.run() inside the worker.
+
+Results come back through the future, an optional callback (called from the pool's
+result thread, so keep it short), or collect(), which hands back the finished
+results in step order.
+
+fn must be a module level function, and the arguments picklable. Workers are
+limited to 1 torch thread, so a single worker doesn't compete with the learner
+for every core.
+# noqa: E501
+"""
+
+
+@dataclass
+class EvalResult:
+    # training step the evaluated snapshot was taken at
+    step: int
+    # whatever fn returned
+    value: Any
+    # wall-clock seconds the evaluation took in the worker
+    seconds: float
+
+
+def _init_worker() -> None:
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(1)
+
+
+def _evaluate(step: int, fn: Callable, kwargs: dict) -> EvalResult:
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(1)
+    t0 = time.perf_counter()
+    value = fn(**kwargs)
+    if inspect.iscoroutine(value):
+        value = asyncio.run(value)
+    return EvalResult(step=step, value=value, seconds=time.perf_counter() - t0)
+
+
+class BackgroundEvaluator:
+    def __init__(self, n_workers: int = 1):
+        """n_workers : evaluations that can run at once, later ones are queued"""
+        assert n_workers > 0, "invalid n_workers"
+        self.pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        self.pending: List["Future[EvalResult]"] = []
+
+    def submit(
+        self,
+        step: int,
+        fn: Callable,
+        callback: Optional[Callable[[EvalResult], None]] = None,
+        **kwargs,
+    ) -> "Future[EvalResult]":
+        """
+        evaluates fn(**kwargs) in a worker, tagged with step.
+        callback : called with the EvalResult once it's done (not on failure).
+        """
+        future = self.pool.submit(_evaluate, step, fn, kwargs)
+        if callback is not None:
+            future.add_done_callback(
+                lambda f: callback(f.result()) if f.exception() is None else None
+            )
+        self.pending.append(future)
+        return future
+
+    def collect(self, wait: bool = False) -> List[EvalResult]:
+        """
+        finished results (in step order), which are no longer pending.
+        wait : block until every submitted evaluation is done.
+        Raises the exception of a failed evaluation, only that one stops being
+        pending: the other finished results are returned by the next collect().
+        """
+        done = [f for f in self.pending if wait or f.done()]
+        for f in done:
+            if f.exception() is not None:
+                self.pending.remove(f)
+                raise f.exception()
+        self.pending = [f for f in self.pending if f not in done]
+        return sorted((f.result() for f in done), key=lambda r: r.step)
+
+    def close(self, wait: bool = True) -> None:
+        """wait : let the pending evaluations finish, otherwise cancel queued ones"""
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __enter__(self) -> "BackgroundEvaluator":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
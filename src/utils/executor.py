@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+"""
+Pluggable executor for running independent games.
+
+Gameplay is CPU bound, synchronous python, so wrapping games in asyncio tasks runs
+them one after another. Instead, each game is a task dispatched to:
+    - "serial" : in the current process, one after another (the default)
+    - "thread" : a thread pool. Only helps if the work releases the GIL (ie torch).
+    - "process" : a process pool, which actually spreads games across cores.
+
+Game, Shoe and the action selection draw from the global numpy RNG, so each task
+reseeds it with its own seed, spawned from a single SeedSequence. Results are
+then reproducible for a given seed, regardless of the executor or number of workers.
+Process workers always get spawned seeds (from fresh entropy if no seed is
+passed), otherwise forked workers would all share the parent's RNG state.
+Threads share the global RNG, so their tasks aren't reseeded.
+# noqa: E501
+"""
+
+EXECUTORS = ["serial", "thread", "process"]
+
+
+def spawn_seeds(n: int, seed: Optional[int] = None) -> List[int]:
+    """n independent seeds, from a SeedSequence of seed (fresh entropy if None)"""
+    children = np.random.SeedSequence(seed).spawn(n)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+
+def _init_worker() -> None:
+    # each process already gets its own core, torch shouldn't oversubscribe it.
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(1)
+
+
+def _run(fn: Callable, args: tuple, seed: Optional[int]) -> Any:
+    if seed is not None:
+        np.random.seed(seed)
+        if "torch" in sys.modules:
+            sys.modules["torch"].manual_seed(seed)
+    return fn(*args)
+
+
+def default_workers(executor: str, n_workers: Optional[int] = None) -> int:
+    """number of tasks run at once: 1 for "serial", defaults to the number of cpus"""
+    if executor == "serial":
+        return 1
+    return n_workers or os.cpu_count() or 1
+
+
+def make_pool(executor: str, n_workers: Optional[int] = None) -> Optional[Executor]:
+    """
+    pool for run_tasks(..., pool=), to reuse across many calls. None for "serial".
+    The caller shuts it down (ie with the pool as a context manager).
+    """
+    assert executor in EXECUTORS, "invalid executor"
+    if executor == "serial":
+        return None
+    n_workers = default_workers(executor, n_workers)
+    if executor == "thread":
+        return ThreadPoolExecutor(max_workers=n_workers)
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker)
+
+
+async def run_tasks(
+    fn: Callable,
+    tasks: List[tuple],
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    pool: Optional[Executor] = None,
+) -> List[Any]:
+    """
+    Runs fn(*args) for each args in tasks, returning results in the same order.
+    fn must be a module level function (and args picklable) for "process".
+
+    - n_workers : pool size, defaults to the number of cpus.
+    - seed : seeds each task's RNG. If None, "serial" leaves the RNG untouched.
+    - pool : an existing pool of the executor (see make_pool()), left running.
+        Otherwise a pool is created for the call, and shut down after.
+    """
+    assert executor in EXECUTORS, "invalid executor"
+
+    seeds: List[Optional[int]] = [None] * len(tasks)
+    if (seed is not None and executor != "thread") or executor == "process":
+        seeds = spawn_seeds(len(tasks), seed)
+
+    if executor == "serial":
+        return [_run(fn, args, s) for args, s in zip(tasks, seeds)]
+
+    if pool is not None:
+        return await _gather(pool, fn, tasks, seeds)
+    with make_pool(executor, n_workers) as pool:
+        return await _gather(pool, fn, tasks, seeds)
+
+
+async def _gather(
+    pool: Executor, fn: Callable, tasks: List[tuple], seeds: List[Optional[int]]
+) -> List[Any]:
+    loop = asyncio.get_running_loop()
+    futures = [
+        loop.run_in_executor(pool, _run, fn, args, s) for args, s in zip(tasks, seeds)
+    ]
+    return await asyncio.gather(*futures)
@@ -0,0 +1,190 @@
+from dataclasses import dataclass
+from statistics import NormalDist
+from typing import Callable, Dict, Optional, Tuple, Union
+
+import numpy as np
+
+from src.modules.recorder import HandHistory
+
+"""
+Off-policy evaluation of a policy from logged hand histories.
+
+An episode is a single player's round (HandRecorder "rounds" row), with reward the
+sum of its winnings, and its decisions (HandRecorder "decisions" rows), each logged
+with the probability the behavior policy gave to the move (propensity).
+For a target policy pi, the importance weight of an episode is
+    w = prod_t pi(a_t | s_t) / propensity_t
+and the EV of pi (per round) is estimated by:
+    - "is" : importance sampling, mean(w * R). Unbiased.
+    - "wis" : weighted importance sampling, sum(w * R) / sum(w). Biased, lower variance.
+    - "dr" : doubly robust, using a model q(s, a) of the move values as control variate
+        R * w_T - sum_t (w_t * q(s_t, a_t) - w_{t-1} * v(s_t)),  v(s) = sum_a pi(a | s) q(s, a)
+        where w_t is the cumulative weight up to (and including) decision t.
+        Unbiased whatever q is, and lower variance the better q is.
+Split hands are treated as one sequence of decisions, in the order they were played.
+
+Policies / q models are either lookup tables over
+[player_total, house_value, useable_ace, mask(, action)] (see
+src.q.utils.policy.policy_probabilities, or QTable.values), or callables mapping the
+logged decisions to an (n_decisions, n_moves) array
+(see src.deep_learning.utils.action for Nets).
+# noqa: E501
+"""
+
+Table = Union[np.ndarray, Callable[[np.ndarray], np.ndarray]]
+
+
+@dataclass
+class OffPolicyEstimate:
+    # "is", "wis", "dr" (dr only if a q model was passed)
+    estimates: Dict[str, float]
+    std_error: Dict[str, float]
+    ci: Dict[str, Tuple[float, float]]
+    # effective sample size of the importance weights, (sum w)^2 / sum w^2
+    ess: float
+    n_episodes: int
+    # fraction of episodes the target policy could have played (w > 0)
+    support: float
+
+
+@dataclass
+class OffPolicyLog:
+    # HandRecorder "decisions" rows, sorted by episode
+    decisions: np.ndarray
+    # episode of each decision
+    episode: np.ndarray
+    # reward of each episode
+    rewards: np.ndarray
+
+    @classmethod
+    def from_history(
+        cls, history: HandHistory, seat: Optional[int] = None
+    ) -> "OffPolicyLog":
+        """loads the log into memory. seat : only keep the episodes of a single seat"""
+        rounds = np.concatenate(list(history.chunks("rounds")))
+        decisions = np.concatenate(list(history.chunks("decisions")))
+        if seat is not None:
+            rounds = rounds[rounds["seat"] == seat]
+            decisions = decisions[decisions["seat"] == seat]
+
+        round_keys = rounds["round"] * 128 + rounds["seat"]
+        decision_keys = decisions["round"] * 128 + decisions["seat"]
+        episode = np.searchsorted(round_keys, decision_keys)
+        # decisions of a round that was never settled (ie recorder closed mid round)
+        found = episode < len(round_keys)
+        found[found] = round_keys[episode[found]] == decision_keys[found]
+
+        decisions = decisions[found]
+        if np.isnan(decisions["propensity"]).any():
+            raise Exception("logged decisions are missing behavior probabilities")
+
+        return cls(
+            decisions=decisions,
+            episode=episode[found],
+            rewards=np.nansum(rounds["winnings"].astype(np.float64), axis=1),
+        )
+
+    @property
+    def n_episodes(self) -> int:
+        return len(self.rewards)
+
+    def _lookup(self, table: Table, with_mask: bool) -> np.ndarray:
+        """(n_decisions, n_moves) rows of a table / callable"""
+        d = self.decisions
+        if callable(table):
+            return np.asarray(table(d), dtype=np.float64)
+        ind = (d["player_total"], d["house_value"], d["useable_ace"].astype(int))
+        if with_mask:
+            ind += (d["mask"],)
+        return np.asarray(table[ind], dtype=np.float64)
+
+    def _episode_cumsum(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """inclusive and exclusive cumulative sums of x, restarting every episode"""
+        c = np.concatenate([[0], np.cumsum(x)])
+        start = np.searchsorted(self.episode, self.episode)
+        i = np.arange(len(x))
+        return c[i + 1] - c[start], c[i] - c[start]
+
+    def _cumulative_weights(self, ratios: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """w_t and w_{t-1} of each decision, in log space (ratios can be 0)"""
+        zero = ratios == 0
+        log_ratios = np.log(np.where(zero, 1, ratios))
+        log_incl, log_excl = self._episode_cumsum(log_ratios)
+        zero_incl, zero_excl = self._episode_cumsum(zero.astype(np.int64))
+        return (
+            np.where(zero_incl > 0, 0, np.exp(log_incl)),
+            np.where(zero_excl > 0, 0, np.exp(log_excl)),
+        )
+
+    def estimate(
+        self,
+        target: Table,
+        q_values: Optional[Table] = None,
+        confidence: float = 0.95,
+    ) -> OffPolicyEstimate:
+        """
+        target : action probabilities of the policy to evaluate, ie
+            policy_probabilities(q) -> (22, 12, 2, 32, n_moves), or a callable.
+        q_values : optional move values for "dr", ie QTable.values -> (22, 12, 2, n_moves),
+            or a callable. NaN (invalid moves) are ignored.
+        # noqa: E501
+        """
+        n = self.n_episodes
+        actions = self.decisions["action"].astype(np.int64)
+
+        probs = self._lookup(target, with_mask=True)
+        ratios = probs[np.arange(len(actions)), actions] / self.decisions[
+            "propensity"
+        ].astype(np.float64)
+        w_incl, w_excl = self._cumulative_weights(ratios)
+
+        # weight of each episode is the weight after its last decision (1 if none)
+        weights = np.ones(n)
+        weights[self.episode] = w_incl  # later decisions of an episode overwrite
+
+        values = {"is": weights * self.rewards}
+        estimates = {"is": values["is"].mean()}
+        std_error = {"is": values["is"].std(ddof=1) / np.sqrt(n)}
+
+        sum_w = weights.sum()
+        estimates["wis"] = values["is"].sum() / sum_w
+        std_error["wis"] = (
+            np.sqrt(np.sum(weights**2 * (self.rewards - estimates["wis"]) ** 2)) / sum_w
+        )
+
+        if q_values is not None:
+            q = self._lookup(q_values, with_mask=False)
+            q_taken = np.nan_to_num(q[np.arange(len(actions)), actions])
+            v = np.where(probs > 0, probs * np.nan_to_num(q), 0).sum(axis=1)
+            control = np.bincount(
+                self.episode, weights=w_incl * q_taken - w_excl * v, minlength=n
+            )
+            values["dr"] = values["is"] - control
+            estimates["dr"] = values["dr"].mean()
+            std_error["dr"] = values["dr"].std(ddof=1) / np.sqrt(n)
+
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        return OffPolicyEstimate(
+            estimates={k: float(v) for k, v in estimates.items()},
+            std_error={k: float(v) for k, v in std_error.items()},
+            ci={
+                k: (float(estimates[k] - z * se), float(estimates[k] + z * se))
+                for k, se in std_error.items()
+            },
+            ess=float(sum_w**2 / np.sum(weights**2)),
+            n_episodes=n,
+            support=float(np.mean(weights > 0)),
+        )
+
+    def screen(
+        self,
+        targets: Dict[str, Table],
+        q_values: Optional[Dict[str, Table]] = None,
+        confidence: float = 0.95,
+    ) -> Dict[str, OffPolicyEstimate]:
+        """estimates of many candidate policies, keyed like targets"""
+        q_values = q_values or {}
+        return {
+            name: self.estimate(target, q_values.get(name), confidence)
+            for name, target in targets.items()
+        }
@@ -0,0 +1,171 @@
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from src.utils.executor import default_workers, make_pool, run_tasks
+
+"""
+Streaming statistics for evaluations.
+
+Welford keeps a running mean / variance (and optionally a histogram) of per round
+rewards for each player, so evaluations don't need to hold every reward. Batches
+(ie a chunk of rounds, or the accumulator of another worker) are merged in with
+Chan's parallel update.
+
+run_until_precise() keeps playing chunks of rounds until the confidence interval
+of every player's mean is narrow enough, a time budget is spent, or max_rounds is hit.
+# noqa: E501
+"""
+
+
+@dataclass
+class Welford:
+    n_players: int = 1
+    # histogram bin edges, shared by every player. None to skip histograms.
+    bins: Optional[np.ndarray] = None
+    n: int = field(init=False, default=0)
+    mean: np.ndarray = field(init=False)
+    m2: np.ndarray = field(init=False)
+    histogram: Optional[np.ndarray] = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.mean = np.zeros(self.n_players)
+        self.m2 = np.zeros(self.n_players)
+        if self.bins is not None:
+            self.bins = np.asarray(self.bins, dtype=np.float64)
+            self.histogram = np.zeros((self.n_players, len(self.bins) - 1), dtype=int)
+
+    def _merge(self, n: int, mean: np.ndarray, m2: np.ndarray) -> None:
+        if not n:
+            return
+        n_total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / n_total
+        self.m2 = self.m2 + m2 + delta**2 * self.n * n / n_total
+        self.n = n_total
+
+    def update(self, rewards: np.ndarray) -> None:
+        """rewards of a single round, (n_players,)"""
+        self.update_batch(np.asarray(rewards, dtype=np.float64)[None, :])
+
+    def update_batch(self, rewards: np.ndarray) -> None:
+        """rewards of many rounds, (n_rounds, n_players)"""
+        rewards = np.asarray(rewards, dtype=np.float64)
+        if not len(rewards):
+            return
+        mean = rewards.mean(axis=0)
+        self._merge(len(rewards), mean, ((rewards - mean) ** 2).sum(axis=0))
+        if self.histogram is not None:
+            for i in range(self.n_players):
+                self.histogram[i] += np.histogram(rewards[:, i], bins=self.bins)[0]
+
+    def merge(self, other: "Welford") -> None:
+        self._merge(other.n, other.mean, other.m2)
+        if self.histogram is not None and other.histogram is not None:
+            self.histogram += other.histogram
+
+    @property
+    def variance(self) -> np.ndarray:
+        if self.n < 2:
+            return np.full(self.n_players, np.nan)
+        return self.m2 / (self.n - 1)
+
+    @property
+    def std_error(self) -> np.ndarray:
+        return np.sqrt(self.variance / max(self.n, 1))
+
+    def half_width(self, confidence: float = 0.95) -> np.ndarray:
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        return z * self.std_error
+
+    def ci(self, confidence: float = 0.95) -> Tuple[np.ndarray, np.ndarray]:
+        half_width = self.half_width(confidence)
+        return self.mean - half_width, self.mean + half_width
+
+
+@dataclass
+class EvalSummary:
+    mean: np.ndarray
+    std_error: np.ndarray
+    ci: Tuple[np.ndarray, np.ndarray]
+    n_rounds: int
+    elapsed: float
+    # "precision", "time_budget" or "max_rounds"
+    stopped_by: str
+    histogram: Optional[np.ndarray] = None
+
+
+async def run_until_precise(
+    fn: Callable[..., Welford],
+    args: tuple,
+    n_players: int,
+    chunk_rounds: int = 1_000,
+    half_width: Optional[float] = None,
+    confidence: float = 0.95,
+    time_budget: Optional[float] = None,
+    max_rounds: int = 1_000_000,
+    bins: Optional[np.ndarray] = None,
+    executor: str = "serial",
+    n_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> EvalSummary:
+    """
+    fn(*args, n_rounds) plays n_rounds and returns their Welford accumulator.
+
+    Chunks of chunk_rounds are dispatched n_workers at a time (1 at a time for
+    "serial", the number of cpus by default) with src.utils.executor, on a single
+    pool kept for the whole run, and merged as they finish. Stops once:
+        - half_width : every player's CI half width is <= half_width
+        - time_budget : seconds elapsed
+        - max_rounds : rounds played
+    whichever comes first.
+    """
+    start = time.perf_counter()
+    n_parallel = default_workers(executor, n_workers)
+    seeds = None if seed is None else np.random.SeedSequence(seed)
+
+    stats = Welford(n_players=n_players, bins=bins)
+    stopped_by = "max_rounds"
+    pool = make_pool(executor, n_parallel)
+    with pool or nullcontext():
+        while stats.n < max_rounds:
+            n_left = max_rounds - stats.n
+            chunks = [
+                min(chunk_rounds, n_left - i * chunk_rounds)
+                for i in range(min(n_parallel, -(-n_left // chunk_rounds)))
+            ]
+            batch_seed = None
+            if seeds is not None:
+                batch_seed = int(seeds.spawn(1)[0].generate_state(1)[0])
+            res = await run_tasks(
+                fn,
+                [args + (n,) for n in chunks],
+                executor=executor,
+                n_workers=n_workers,
+                seed=batch_seed,
+                pool=pool,
+            )
+            for chunk_stats in res:
+                stats.merge(chunk_stats)
+
+            if half_width is not None and stats.n > 1:
+                if np.all(stats.half_width(confidence) <= half_width):
+                    stopped_by = "precision"
+                    break
+            if time_budget is not None and time.perf_counter() - start >= time_budget:
+                stopped_by = "time_budget"
+                break
+
+    return EvalSummary(
+        mean=stats.mean,
+        std_error=stats.std_error,
+        ci=stats.ci(confidence),
+        n_rounds=stats.n,
+        elapsed=time.perf_counter() - start,
+        stopped_by=stopped_by,
+        histogram=stats.histogram,
+    )